@@ -0,0 +1,208 @@
+"""
+Hot/cold split of the match history.
+
+Matches older than ARCHIVE_AFTER_DAYS move, with their statistics, from
+Match/Statistic into the narrower ArchivedMatch/ArchivedStatistic tables
+under their original ids, so the hot tables and their indexes only hold
+recent games. A tournament moves as a whole once its newest match is old
+enough, which keeps every history group in one table. Archiving and ingest
+both lock the Tournament row first, and ingest refuses new matches for an
+archived tournament, so a tournament is all hot or all archived.
+
+Each batch runs in its own transaction: copy, fold into UserArchiveRollup,
+delete the hot rows. An interrupted run leaves nothing half-moved and the
+next run carries on with whatever is still hot.
+
+Readers that need every game (history, summaries, leaderboard, export)
+merge both sides; replay_rows() yields the union in replay order.
+"""
+
+import heapq
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+from .models import ArchivedMatch, ArchivedStatistic, Match, Statistic, Tournament, UserArchiveRollup
+
+BATCH_SIZE = 500
+ROLLUP_FIELDS = ['games_played', 'wins', 'goals_scored', 'goals_received', 'first_match', 'newest_match']
+
+
+def default_cutoff():
+    return timezone.now() - timedelta(days=getattr(settings, 'ARCHIVE_AFTER_DAYS', 365))
+
+
+def next_batch(cutoff, batch_size=BATCH_SIZE):
+    """
+    Ids of the next matches to archive: single matches started before the
+    cutoff, then whole tournaments whose newest match started before it.
+    A batch may exceed batch_size by the rest of its last tournament.
+    """
+    singles = list(
+        Match.objects
+        .filter(tournament__isnull=True, datetime_start__lt=cutoff)
+        .order_by('id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if singles:
+        return singles
+
+    tournaments = (
+        Match.objects
+        .filter(tournament__isnull=False)
+        .values('tournament_id')
+        .annotate(latest=Max('datetime_start'), matches=Count('id'))
+        .filter(latest__lt=cutoff)
+        .order_by('tournament_id')
+    )
+    tournament_ids, size = [], 0
+    for group in tournaments[:batch_size]:
+        tournament_ids.append(group['tournament_id'])
+        size += group['matches']
+        if size >= batch_size:
+            break
+    if not tournament_ids:
+        return []
+    return list(Match.objects.filter(tournament_id__in=tournament_ids).values_list('id', flat=True))
+
+
+def archive_matches(match_ids):
+    """Move the matches and their statistics to the archive. Returns (matches, statistics) moved."""
+    with transaction.atomic():
+        # Tournaments first, the lock ingest takes before adding to one; a
+        # match ingested since next_batch moves along with its tournament
+        tournament_ids = set(
+            Match.objects.filter(id__in=match_ids, tournament__isnull=False).values_list('tournament_id', flat=True)
+        )
+        if tournament_ids:
+            list(Tournament.objects.select_for_update().filter(id__in=tournament_ids).values_list('id', flat=True))
+        matches = list(Match.objects.select_for_update().filter(Q(id__in=match_ids) | Q(tournament_id__in=tournament_ids)))
+        if not matches:
+            return 0, 0
+        ids = [match.id for match in matches]
+        starts = {match.id: match.datetime_start for match in matches}
+        statistics = list(Statistic.objects.filter(match_id__in=ids).order_by('id'))
+
+        ArchivedMatch.objects.bulk_create([
+            ArchivedMatch(
+                id=match.id, datetime_start=match.datetime_start, datetime_end=match.datetime_end,
+                tournament_id=match.tournament_id, premature_end=match.premature_end,
+            )
+            for match in matches
+        ])
+        ArchivedStatistic.objects.bulk_create([
+            ArchivedStatistic(
+                id=stat.id, match_id=stat.match_id, user_id=stat.user_id,
+                goals_scored=stat.goals_scored, goals_received=stat.goals_received,
+                datetime_left=stat.datetime_left, won=stat.won,
+            )
+            for stat in statistics
+        ])
+
+        record_rollups([
+            (stat.user_id, stat.goals_scored, stat.goals_received, stat.won, starts[stat.match_id])
+            for stat in statistics if stat.user_id is not None
+        ])
+
+        Statistic.objects.filter(match_id__in=ids).delete()
+        Match.objects.filter(id__in=ids).delete()
+
+    return len(matches), len(statistics)
+
+
+def record_rollups(scores):
+    """Fold (user_id, goals_scored, goals_received, won, started) tuples into the rollups."""
+    if not scores:
+        return
+    user_ids = {user_id for user_id, *_ in scores}
+
+    UserArchiveRollup.objects.bulk_create(
+        [UserArchiveRollup(user_id=user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+    rollups = {
+        rollup.user_id: rollup
+        for rollup in UserArchiveRollup.objects.select_for_update().filter(user_id__in=user_ids)
+    }
+
+    for user_id, scored, received, won, started in scores:
+        rollup = rollups[user_id]
+        rollup.games_played += 1
+        rollup.goals_scored += scored
+        rollup.goals_received += received
+        if won:
+            rollup.wins += 1
+        if rollup.first_match is None or started < rollup.first_match:
+            rollup.first_match = started
+        if rollup.newest_match is None or started > rollup.newest_match:
+            rollup.newest_match = started
+
+    UserArchiveRollup.objects.bulk_update(rollups.values(), ROLLUP_FIELDS)
+
+
+def run(cutoff=None, batch_size=BATCH_SIZE, max_batches=None):
+    """Archive batch after batch until nothing is left. Yields (matches, statistics) per batch."""
+    cutoff = cutoff or default_cutoff()
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        match_ids = next_batch(cutoff, batch_size)
+        if not match_ids:
+            return
+        yield archive_matches(match_ids)
+        batches += 1
+
+
+def newest_archived(user):
+    """Start of the user's newest archived match, or None when nothing of theirs is archived."""
+    return UserArchiveRollup.objects.filter(user=user).values_list('newest_match', flat=True).first()
+
+
+def replay_rows(columns, chunk_size=2000):
+    """
+    Values of columns for every statistic, hot and archived, ordered by
+    (match start, match id, statistic id) like a replay of the hot table
+    alone. Both sides are streamed; memory stays flat.
+    """
+    def ordered(model):
+        return (
+            model.objects
+            .filter(user__isnull=False, match__isnull=False)
+            .order_by('match__datetime_start', 'match_id', 'id')
+            .values_list('match__datetime_start', 'match_id', 'id', *columns)
+            .iterator(chunk_size=chunk_size)
+        )
+
+    merged = heapq.merge(ordered(ArchivedStatistic), ordered(Statistic), key=lambda row: row[:3])
+    return (row[3:] for row in merged)
+
+
+def check():
+    """
+    Compare the rollups with the archived rows.
+    Returns a list of (user_id, field, stored, expected) mismatches.
+    """
+    expected = {
+        row['user_id']: row
+        for row in (
+            ArchivedStatistic.objects
+            .filter(user__isnull=False)
+            .values('user_id')
+            .annotate(
+                games_played=Count('id'), wins=Count('id', filter=Q(won=True)),
+                goals_scored=Sum('goals_scored'), goals_received=Sum('goals_received'),
+                first_match=Min('match__datetime_start'), newest_match=Max('match__datetime_start'),
+            )
+        )
+    }
+    stored = {rollup.user_id: rollup for rollup in UserArchiveRollup.objects.all()}
+
+    mismatches = []
+    for user_id in sorted(set(expected) | set(stored)):
+        want = expected.get(user_id, {})
+        have = stored.get(user_id)
+        for field in ROLLUP_FIELDS:
+            default = None if field in ('first_match', 'newest_match') else 0
+            value = getattr(have, field) if have is not None else default
+            if value != want.get(field, default):
+                mismatches.append((user_id, field, value, want.get(field, default)))
+    return mismatches
@@ -0,0 +1,197 @@
+import copy
+import hmac
+from datetime import timedelta
+import jwt
+from django.conf import settings
+from django.db.models import F
+from django.utils.timezone import now
+from rest_framework.authentication import BaseAuthentication, TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import BasePermission
+from .cache import LRUCache
+from .metrics import registry
+from .models import User
+
+# Per-process, so invalidation only reaches the worker that handled the
+# change; the TTL bounds how long other workers may serve a stale entry.
+token_cache = LRUCache(
+    maxsize=getattr(settings, 'TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_CACHE_TTL', 60),
+)
+
+# Users resolved from JWT claims, same per-worker caveat as token_cache
+user_cache = LRUCache(
+    maxsize=getattr(settings, 'USER_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'USER_CACHE_TTL', 30),
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that remembers validated tokens for TOKEN_CACHE_TTL
+    seconds. On a hit the user is a bare User carrying only id and username,
+    so only use it on views that never write the user back.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            return (cached_user(cached), key)
+
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, (user.id, user.username))
+        return (user, token)
+
+
+class IsInternalService(BasePermission):
+    """
+    Calls from the game server, which shares INTERNAL_API_SECRET with Django
+    and sends it in X-Internal-Token. Everything is refused while the secret
+    is unset.
+    """
+
+    message = 'Internal endpoint.'
+
+    def has_permission(self, request, view):
+        secret = getattr(settings, 'INTERNAL_API_SECRET', '')
+        token = request.headers.get('X-Internal-Token', '')
+        return bool(secret) and hmac.compare_digest(token.encode(), secret.encode())
+
+
+def cached_user(cached):
+    user_id, username = cached
+    user = User(id=user_id, username=username)
+    user._state.adding = False
+    return user
+
+
+async def atoken_user(request):
+    """
+    CachedTokenAuthentication for the async views, on the async ORM. The
+    user of the request's 'Token <key>' header, None without one; raises
+    AuthenticationFailed like the DRF class does.
+    """
+    auth = get_authorization_header(request).split()
+    if not auth or auth[0].lower() != b'token':
+        return None
+    if len(auth) != 2:
+        raise AuthenticationFailed('Invalid token header.')
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached_user(cached)
+    token = await Token.objects.select_related('user').filter(key=key).afirst()
+    if token is None:
+        raise AuthenticationFailed('Invalid token.')
+    if not token.user.is_active:
+        raise AuthenticationFailed('User inactive or deleted.')
+    token_cache.set(key, (token.user.id, token.user.username))
+    return token.user
+
+
+def issue_jwt(user):
+    issued = now()
+    payload = {
+        'user_id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'ver': user.token_version,
+        'iat': issued,
+        'exp': issued + timedelta(seconds=getattr(settings, 'JWT_TTL', settings.SESSION_COOKIE_AGE)),
+    }
+    return jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+
+
+def decode_jwt(token):
+    """The claims of a token issued by issue_jwt; raises AuthenticationFailed."""
+    try:
+        return jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationFailed({'error': 'Token expired.'})
+    except jwt.InvalidTokenError:
+        raise AuthenticationFailed({'error': 'Invalid token.'})
+
+
+def jwt_user_id(token):
+    """The user_id claim of a token issued by issue_jwt, expired or not; None for anything else."""
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'], options={'verify_exp': False})
+    except jwt.InvalidTokenError:
+        return None
+    return payload.get('user_id')
+
+
+def resolve_user(payload, session):
+    """
+    The User of verified claims. Tokens from before the user_id claim fall
+    back to the session username, like the views used to. Tokens whose ver
+    claim is behind the user's token_version were revoked. Cache hits are
+    copies, so views may change and save them.
+    """
+    user_id = payload.get('user_id')
+    user = user_cache.get(user_id) if user_id is not None else None
+    if user is None:
+        if user_id is not None:
+            user = User.objects.filter(id=user_id).first()
+        else:
+            username = session.get('user_data', {}).get('username')
+            user = User.objects.filter(username=username).first() if username else None
+        if user is None or not user.is_active:
+            raise AuthenticationFailed({'error': 'User not found'})
+        user_cache.set(user.id, user)
+    if payload.get('ver', 0) != user.token_version:
+        raise AuthenticationFailed({'error': 'Token revoked.'})
+    return copy.copy(user)
+
+
+class JWTAuthentication(BaseAuthentication):
+    """Authorization: Bearer <jwt> as issued by issue_jwt at login."""
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed({'error': 'Invalid token header.'})
+
+        payload = decode_jwt(auth[1].decode(errors='replace'))
+        return (resolve_user(payload, request.session), payload)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+def invalidate_token(key):
+    if key:
+        token_cache.delete(key)
+
+
+def invalidate_user(user_id):
+    token_cache.delete_where(lambda value: value[0] == user_id)
+    user_cache.delete(user_id)
+
+
+def revoke_jwts(user_id):
+    """
+    Invalidate every JWT issued to the user so far. Other workers notice
+    once their user_cache entry expires, within USER_CACHE_TTL.
+    """
+    User.objects.filter(id=user_id).update(token_version=F('token_version') + 1)
+    invalidate_user(user_id)
+
+
+@registry.collector
+def _token_cache_metrics():
+    stats = token_cache.stats()
+    return [
+        ('api_token_cache_size', 'gauge', 'Validated tokens held by this worker.', [({}, stats['size'])]),
+        ('api_token_cache_hits_total', 'counter', 'Token cache hits.', [({}, stats['hits'])]),
+        ('api_token_cache_misses_total', 'counter', 'Token cache misses.', [({}, stats['misses'])]),
+        ('api_token_cache_evictions_total', 'counter', 'Token cache evictions.', [({}, stats['evictions'])]),
+    ]
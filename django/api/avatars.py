@@ -0,0 +1,203 @@
+"""
+Avatar uploads: content-addressed originals and square WebP variants.
+
+An upload is stored once under the SHA-256 of its bytes,
+avatars/<digest>/original.<ext>, so the same picture uploaded twice (or by
+two users) is one file. The variants (AVATAR_SIZES, e.g. 256.webp) sit next
+to it and are rendered from a single decode on a small worker pool, off the
+request. Once they exist User.avatar points at the largest one, so every
+list and profile that serializes the avatar serves the thumbnail; the other
+sizes are its siblings, see urls().
+"""
+
+import hashlib
+import logging
+import posixpath
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .authentication import user_cache
+from .metrics import registry
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+ROOT = 'avatars'
+FORMAT, EXTENSION = 'WEBP', 'webp'
+
+
+class InvalidAvatar(Exception):
+    pass
+
+
+def sizes():
+    return sorted(getattr(settings, 'AVATAR_SIZES', (64, 128, 256)))
+
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def variant_name(digest, size):
+    return posixpath.join(ROOT, digest, f'{size}.{EXTENSION}')
+
+
+def parse(name):
+    """(digest, size) of a variant name, or None for anything else (originals, legacy uploads)."""
+    parts = (name or '').split('/')
+    if len(parts) != 3 or parts[0] != ROOT or not parts[2].endswith('.' + EXTENSION):
+        return None
+    size = parts[2][:-len(EXTENSION) - 1]
+    if not size.isdigit() or int(size) not in sizes():
+        return None
+    return parts[1], int(size)
+
+
+def urls(name):
+    """size -> URL of every variant for a stored avatar name; {} until the variants exist."""
+    parsed = parse(name)
+    if parsed is None:
+        return {}
+    return {str(size): default_storage.url(variant_name(parsed[0], size)) for size in sizes()}
+
+
+def inspect(data):
+    """
+    Read only the image header: the format and pixel count are checked
+    before anything is stored or decoded. Returns the file extension.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+            kind = image.format
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        raise InvalidAvatar('Not an image')
+    if kind not in ('JPEG', 'PNG', 'GIF', 'WEBP'):
+        raise InvalidAvatar('Unsupported image format')
+    if width * height > getattr(settings, 'AVATAR_MAX_PIXELS', 24_000_000):
+        raise InvalidAvatar('Image too large')
+    return 'jpg' if kind == 'JPEG' else kind.lower()
+
+
+def store_original(data):
+    """Save the upload under its digest unless it is already there. Returns (digest, name)."""
+    extension = inspect(data)
+    digest = digest_of(data)
+    name = posixpath.join(ROOT, digest, f'original.{extension}')
+    if not default_storage.exists(name):
+        saved = default_storage.save(name, ContentFile(data))
+        if saved != name:  # lost a race with an identical upload
+            default_storage.delete(saved)
+    return digest, name
+
+
+def decode(f, largest):
+    """Decode an image file once, upright and in RGB(A); JPEGs are downscaled towards largest while decoding."""
+    image = Image.open(f)
+    image.draft('RGB', (largest, largest))
+    image.load()
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+
+def encode(image, size):
+    """Center-crop and scale to a size x size square. Returns (the square, its WebP bytes)."""
+    image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, FORMAT, quality=getattr(settings, 'AVATAR_QUALITY', 80), method=4)
+    return image, buffer.getvalue()
+
+
+def render(digest, original):
+    """Decode the original once and write every missing variant. Returns the largest variant's name."""
+    wanted = [size for size in sizes() if not default_storage.exists(variant_name(digest, size))]
+    if wanted:
+        with default_storage.open(original, 'rb') as f:
+            image = decode(f, max(wanted))
+        # Largest first, each from the previous one
+        for size in sorted(wanted, reverse=True):
+            image, data = encode(image, size)
+            name = variant_name(digest, size)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(data))
+            registry.inc('api_avatar_variants_total')
+    return variant_name(digest, sizes()[-1])
+
+
+def process(user_id, digest, original):
+    """Render the variants and point the user at them if they still use this upload."""
+    try:
+        name = render(digest, original)
+        if User.objects.filter(id=user_id, avatar=original).update(avatar=name):
+            user_cache.delete(user_id)
+        return name
+    except Exception:
+        registry.inc('api_avatar_failures_total')
+        logger.exception('Avatar processing failed for user %s (%s)', user_id, original)
+        raise
+
+
+registry.describe('api_avatar_variants_total', 'counter', 'Avatar variants rendered.')
+registry.describe('api_avatar_failures_total', 'counter', 'Avatar uploads whose variants could not be rendered.')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def submit(user_id, digest, original):
+    """
+    process() on the worker pool. With AVATAR_WORKERS = 0 it runs in the
+    caller, which tests and the backfill command rely on.
+    """
+    workers = getattr(settings, 'AVATAR_WORKERS', 2)
+    if workers <= 0:
+        future = Future()
+        try:
+            future.set_result(process(user_id, digest, original))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='avatars')
+    return _executor.submit(_work, user_id, digest, original)
+
+
+def _work(user_id, digest, original):
+    try:
+        return process(user_id, digest, original)
+    finally:
+        close_old_connections()
+
+
+def upload(user, uploaded):
+    """
+    Store an uploaded avatar and point user.avatar (unsaved) at it: straight
+    at the variants when this picture was processed before, else at the
+    original. Returns the (digest, original) to submit() once the user is
+    saved, or None when the variants already exist.
+    """
+    digest, original = store_original(uploaded.read())
+    if all(default_storage.exists(variant_name(digest, size)) for size in sizes()):
+        user.avatar.name = variant_name(digest, sizes()[-1])
+        return None
+    user.avatar.name = original
+    return digest, original
+
+
+def backfill(user):
+    """Move a legacy avatar into the content-addressed layout. Returns the new name, or None if already done."""
+    if not user.avatar or parse(user.avatar.name) is not None:
+        return None
+    with default_storage.open(user.avatar.name, 'rb') as f:
+        data = f.read()
+    digest, original = store_original(data)
+    User.objects.filter(id=user.id).update(avatar=original)
+    return process(user.id, digest, original)
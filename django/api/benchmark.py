@@ -0,0 +1,205 @@
+"""
+Synthetic data generator and in-process endpoint driver for `manage.py bench`.
+
+Everything runs inside one transaction that the command rolls back, so it
+can be pointed at any database without leaving rows behind.
+"""
+
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import timedelta
+import django
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import now
+from . import leaderboard, search, summary
+from .models import Friend, Match, Statistic, Tournament, User
+
+PASSWORD = 'bench-password'
+
+
+def build_payload(user_ids, game_type, match_count, players_per_match, started=None, rng=random):
+    """A statistics payload shaped like the game server's saveStatistics body."""
+    started = started or now()
+    matches = []
+    for index in range(match_count):
+        start = started + timedelta(minutes=index)
+        end = start + timedelta(seconds=90)
+        players = rng.sample(user_ids, players_per_match)
+        scores = [rng.randint(0, 10) for _ in players]
+        matches.append({
+            'db': {
+                'datetimeStart': start.isoformat(),
+                'datetimeEnd': end.isoformat(),
+                'tournamentId': None,
+                'prematureEnd': False,
+            },
+            'scores': [
+                {
+                    'userId': user_id,
+                    'goalsScored': score,
+                    'goalsReceived': sum(scores) - score,
+                    'datetimeLeft': end.isoformat(),
+                    'won': score == max(scores),
+                }
+                for user_id, score in zip(players, scores)
+            ],
+        })
+    return {'type': game_type, 'matches': matches}
+
+
+def seed(users=1000, friends=20, singles=2000, tournaments=200, players=4, seed=42):
+    """
+    Bulk-insert a synthetic data set and rebuild the derived tables.
+    Returns the created users in id order.
+    """
+    rng = random.Random(seed)
+    password = make_password(PASSWORD)  # hashed once, shared by every user
+
+    created = User.objects.bulk_create(
+        [
+            User(username=f"bench_{i}", email=f"bench_{i}@example.com", password=password)
+            for i in range(users)
+        ],
+        batch_size=2000,
+    )
+    user_ids = [user.id for user in created]
+
+    edges = set()
+    for user_id in user_ids:
+        for friend_id in rng.sample(user_ids, min(friends, users - 1) + 1):
+            if friend_id != user_id:
+                edges.add((user_id, friend_id))
+    Friend.objects.bulk_create([Friend(user_id=a, friend_id=b) for a, b in edges], batch_size=2000)
+
+    started = now() - timedelta(days=365)
+    payloads = [
+        build_payload(user_ids, 0, 1, players, started + timedelta(hours=i), rng)
+        for i in range(singles)
+    ]
+    payloads += [
+        build_payload(user_ids, 1, 7, players, started + timedelta(hours=i, minutes=30), rng)
+        for i in range(tournaments)
+    ]
+
+    tournament_objects = Tournament.objects.bulk_create([Tournament() for _ in range(tournaments)])
+    match_objects = []
+    scores = []
+    tournament_iter = iter(tournament_objects)
+    for payload in payloads:
+        tournament = next(tournament_iter) if payload['type'] == 1 else None
+        for match in payload['matches']:
+            db = match['db']
+            match_objects.append(Match(
+                datetime_start=db['datetimeStart'], datetime_end=db['datetimeEnd'],
+                tournament=tournament, premature_end=db['prematureEnd'],
+            ))
+            scores.append(match['scores'])
+    match_objects = Match.objects.bulk_create(match_objects, batch_size=2000)
+
+    Statistic.objects.bulk_create(
+        [
+            Statistic(
+                match=match, user_id=score['userId'], goals_scored=score['goalsScored'],
+                goals_received=score['goalsReceived'], datetime_left=score['datetimeLeft'], won=score['won'],
+            )
+            for match, match_scores in zip(match_objects, scores) for score in match_scores
+        ],
+        batch_size=2000,
+    )
+
+    leaderboard.rebuild()
+    summary.rebuild()
+    search.rebuild(User.objects.filter(id__in=user_ids))
+    return created
+
+
+def measure(function, iterations):
+    """Latency percentiles and queries per call, then one traced call for peak memory."""
+    timings = []
+    queries = 0
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = function()
+            timings.append((time.perf_counter() - started) * 1000)
+        queries += len(captured)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.status_code}: {response.content[:200]!r}")
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ordered = sorted(timings)
+    return {
+        'requests': iterations,
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'p50_ms': round(ordered[int(len(ordered) * 0.50)], 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'p99_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+        'queries_per_request': round(queries / iterations, 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_endpoints(users, iterations=50, players=4, seed=42):
+    """Drive the api endpoints through the test client as a logged-in bench user."""
+    rng = random.Random(seed)
+    user = users[0]
+    user_ids = [other.id for other in users]
+    # localhost is always in ALLOWED_HOSTS, the test client's default host is not
+    client = Client(SERVER_NAME='localhost')
+
+    login = client.post('/api/login/', {'username': user.username, 'password': PASSWORD}, content_type='application/json')
+    if login.status_code != 200:
+        raise RuntimeError(f"Login failed: {login.content[:200]!r}")
+    auth_token = login.json()['token']
+    jwt_headers = {'HTTP_AUTHORIZATION': f"Bearer {login.json()['jwtToken']}"}
+
+    anonymous = Client(SERVER_NAME='localhost')
+
+    scenarios = {
+        'login_view': lambda: anonymous.post(
+            '/api/login/', {'username': rng.choice(users).username, 'password': PASSWORD}, content_type='application/json'
+        ),
+        'validate_token_view': lambda: anonymous.get(
+            '/api/user/validate/', HTTP_AUTHORIZATION=f"Token {auth_token}"
+        ),
+        'user_view list': lambda: anonymous.get('/api/users/', {'limit': 50}),
+        'user_view detail': lambda: anonymous.get(f"/api/users/{rng.choice(users).username}/"),
+        'fetch_friends': lambda: client.get('/api/friend/', **jwt_headers),
+        'search_users': lambda: client.get('/api/user/search/', {'query': f"bench_{rng.randint(1, 99)}"}, **jwt_headers),
+        'statistic_view GET': lambda: anonymous.get('/api/statistics/', {'userId': rng.choice(user_ids)}),
+        'statistic_view POST single': lambda: anonymous.post(
+            '/api/statistics/', build_payload(user_ids, 0, 1, players, rng=rng), content_type='application/json'
+        ),
+        'statistic_view POST tournament': lambda: anonymous.post(
+            '/api/statistics/', build_payload(user_ids, 1, 7, players, rng=rng), content_type='application/json'
+        ),
+    }
+
+    # The loop would exhaust the login and search buckets within a few iterations
+    with override_settings(RATE_LIMIT_ENABLED=False):
+        return {name: measure(function, iterations) for name, function in scenarios.items()}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created': now().isoformat(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+    }
@@ -0,0 +1,343 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Max, Q
+from django.utils.timezone import now
+from .models import Friend, FriendEvent
+
+POLL_INTERVAL = 1.0  # seconds between checks for new events
+HEARTBEAT_INTERVAL = 15.0
+STREAM_DURATION = 300.0  # clients reconnect with Last-Event-ID afterwards
+BATCH_SIZE = 100
+RETENTION = timedelta(minutes=10)
+PRUNE_EVERY = 200  # publishes per process between prunes
+TICKET_SALT = 'api.events'
+
+logger = logging.getLogger(__name__)
+
+_published = 0
+
+
+def _prune_due(count):
+    global _published
+    _published += count
+    if _published >= PRUNE_EVERY:
+        _published = 0
+        return True
+    return False
+
+
+def _after_publish(count):
+    if _prune_due(count):
+        FriendEvent.objects.filter(created_at__lt=now() - RETENTION).delete()
+
+
+def _presence_events(states):
+    return [
+        FriendEvent(kind=FriendEvent.PRESENCE, user_id=user_id, status=online, last_online=timestamp)
+        for user_id, (online, timestamp) in states.items()
+    ]
+
+
+def publish_presence(states):
+    """states is a user_id -> (online, timestamp) dict, as written by api.presence."""
+    FriendEvent.objects.bulk_create(_presence_events(states))
+    _after_publish(len(states))
+
+
+async def apublish_presence(states):
+    await FriendEvent.objects.abulk_create(_presence_events(states))
+    if _prune_due(len(states)):
+        await FriendEvent.objects.filter(created_at__lt=now() - RETENTION).adelete()
+
+
+def publish_friendship(user_id, friend_id, added):
+    FriendEvent.objects.create(
+        kind=FriendEvent.FRIEND_ADDED if added else FriendEvent.FRIEND_REMOVED,
+        user_id=user_id,
+        friend_id=friend_id,
+    )
+    _after_publish(1)
+
+
+def latest_id():
+    return FriendEvent.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def pending(user_id, friend_ids, after_id, until=None):
+    """
+    Events in (after_id, until] that concern the user: friends' presence and
+    the user's own friendship changes.
+    """
+    events = FriendEvent.objects.filter(id__gt=after_id)
+    if until is not None:
+        events = events.filter(id__lte=until)
+    return list(
+        events
+        .filter(
+            Q(kind=FriendEvent.PRESENCE, user_id__in=friend_ids)
+            | Q(kind__in=[FriendEvent.FRIEND_ADDED, FriendEvent.FRIEND_REMOVED], user_id=user_id)
+        )
+        .select_related('user', 'friend')
+        .order_by('id')[:BATCH_SIZE]
+    )
+
+
+def sign_ticket(user_id):
+    """A stream ticket for user_id, valid for STREAM_TICKET_MAX_AGE seconds and only for the event stream."""
+    return signing.TimestampSigner(salt=TICKET_SALT).sign(str(user_id))
+
+
+def ticket_user_id(ticket):
+    """The user id a ticket was issued for, or None if it is forged or expired."""
+    try:
+        user_id = signing.TimestampSigner(salt=TICKET_SALT).unsign(
+            ticket, max_age=getattr(settings, 'STREAM_TICKET_MAX_AGE', 30)
+        )
+    except signing.BadSignature:
+        return None
+    return int(user_id)
+
+
+def event_data(event):
+    if event.kind == FriendEvent.PRESENCE:
+        return {
+            "tid": event.user_id,
+            "username": event.user.username,
+            "status": event.status,
+            "last_online": event.last_online,
+        }
+    if event.kind == FriendEvent.FRIEND_ADDED:
+        return {
+            "tid": event.friend_id,
+            "username": event.friend.username,
+            "status": event.friend.status,
+            "last_online": event.friend.last_online,
+        }
+    return {"tid": event.friend_id}
+
+
+def format_event(event):
+    data = json.dumps(event_data(event), cls=DjangoJSONEncoder)
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+class Hub:
+    """
+    One poller per process for all of its streams. While anyone is
+    subscribed, a daemon thread reads the new events once per POLL_INTERVAL
+    and hands every batch to each subscriber's deliver callback, so idle
+    clients cost nothing and the query rate does not grow with them.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL, threaded=True):
+        self.interval = interval
+        self.threaded = threaded
+        self.cursor = None
+        self.subscribers = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def subscribe(self, deliver):
+        """
+        Register deliver(events). Returns the hub's cursor: deliver gets
+        every event after it, the subscriber reads anything before itself.
+        """
+        with self.condition:
+            if self.cursor is None:
+                self.cursor = latest_id()
+            self.subscribers.add(deliver)
+            if self.threaded and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='friend-events', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return self.cursor
+
+    def unsubscribe(self, deliver):
+        with self.condition:
+            self.subscribers.discard(deliver)
+
+    def poll(self):
+        """Read and fan out one batch; returns how many events it had."""
+        with self.condition:
+            cursor = self.cursor
+        events = list(
+            FriendEvent.objects.filter(id__gt=cursor).select_related('user', 'friend').order_by('id')[:BATCH_SIZE]
+        )
+        # Cursor and subscriber set are read together: a subscriber that
+        # joined during the query started below this batch and gets it
+        with self.condition:
+            if events:
+                self.cursor = events[-1].id
+            subscribers = list(self.subscribers)
+        if events:
+            for deliver in subscribers:
+                deliver(events)
+        return len(events)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.subscribers:
+                    self.condition.wait()
+            try:
+                count = self.poll()
+            except Exception:
+                # The thread serves every stream of the process: keep it alive
+                logger.exception("Polling friend events failed")
+                connection.close()
+                count = 0
+            if count < BATCH_SIZE:
+                time.sleep(self.interval)
+
+
+default_hub = Hub()
+
+
+class Subscription:
+    """
+    Cursor and friend set of one client's stream. feed() turns a batch of
+    events into SSE chunks, so the sync and async streams share it.
+    """
+
+    def __init__(self, user_id, friend_ids, cursor, duration, clock):
+        self.user_id = user_id
+        self.friend_ids = friend_ids
+        self.cursor = cursor
+        self.duration = duration
+        self.clock = clock
+        self.started = self.last_write = clock()
+
+    def open(self):
+        return self.clock() - self.started < self.duration
+
+    def remaining(self):
+        """Seconds until the next heartbeat is due or the stream ends."""
+        deadline = min(self.last_write + HEARTBEAT_INTERVAL, self.started + self.duration)
+        return max(0.0, deadline - self.clock())
+
+    def concerns(self, event):
+        """Whether the client gets event; follows its friendship events in order."""
+        if event.kind == FriendEvent.PRESENCE:
+            return event.user_id in self.friend_ids
+        if event.user_id != self.user_id:
+            return False
+        if event.kind == FriendEvent.FRIEND_ADDED:
+            self.friend_ids.add(event.friend_id)
+        else:
+            self.friend_ids.discard(event.friend_id)
+        return True
+
+    def catch_up(self, events):
+        """
+        SSE chunks for a batch of pending() rows, which were filtered with
+        the friend set of the query: stops after a friendship change so the
+        rows behind it are read again with the new set.
+        """
+        chunks = []
+        for event in events:
+            self.cursor = event.id
+            chunks.append(format_event(event))
+            if event.kind != FriendEvent.PRESENCE:
+                self.concerns(event)
+                break
+        if chunks:
+            self.last_write = self.clock()
+        return chunks
+
+    def feed(self, events):
+        """SSE chunks for a batch from the hub, or a heartbeat if one is due."""
+        chunks = [format_event(event) for event in events if event.id > self.cursor and self.concerns(event)]
+        if events:
+            self.cursor = max(self.cursor, events[-1].id)
+        if chunks:
+            self.last_write = self.clock()
+        elif self.clock() - self.last_write >= HEARTBEAT_INTERVAL:
+            self.last_write = self.clock()
+            chunks.append(": heartbeat\n\n")
+        return chunks
+
+
+def friends_of(user_id):
+    return set(Friend.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+
+
+RETRY = f"retry: {int(POLL_INTERVAL * 1000)}\n\n"
+
+
+def stream(user_id, last_id=None, duration=STREAM_DURATION, hub=None, clock=time.monotonic):
+    """
+    Server-sent events generator for one client. Events the client missed
+    (after Last-Event-ID) are read per user until they reach the hub's
+    cursor; from there on the client only waits for the hub's batches.
+    """
+    hub = hub or default_hub
+    inbox = queue.Queue()
+    until = hub.subscribe(inbox.put)
+    try:
+        cursor = until if last_id is None else last_id
+        subscription = Subscription(user_id, friends_of(user_id), cursor, duration, clock)
+        yield RETRY
+
+        while subscription.cursor < until:
+            chunks = subscription.catch_up(pending(user_id, subscription.friend_ids, subscription.cursor, until))
+            if not chunks:
+                break
+            yield from chunks
+
+        while subscription.open():
+            try:
+                events = inbox.get(timeout=subscription.remaining())
+            except queue.Empty:
+                events = []
+            yield from subscription.feed(events)
+    finally:
+        hub.unsubscribe(inbox.put)
+
+
+async def astream(user_id, last_id=None, duration=STREAM_DURATION, hub=None, clock=time.monotonic):
+    """
+    stream() for ASGI. The catch-up reads hop to the request's sync thread
+    and the hub's batches arrive on the event loop, so chunks go out as
+    they are produced instead of after duration.
+    """
+    hub = hub or default_hub
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def deliver(events):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(inbox.put_nowait, events)
+
+    until = await sync_to_async(hub.subscribe)(deliver)
+    try:
+        cursor = until if last_id is None else last_id
+        subscription = Subscription(user_id, await sync_to_async(friends_of)(user_id), cursor, duration, clock)
+        yield RETRY
+
+        read = sync_to_async(pending)
+        while subscription.cursor < until:
+            chunks = subscription.catch_up(await read(user_id, subscription.friend_ids, subscription.cursor, until))
+            if not chunks:
+                break
+            for chunk in chunks:
+                yield chunk
+
+        while subscription.open():
+            try:
+                events = await asyncio.wait_for(inbox.get(), subscription.remaining())
+            except asyncio.TimeoutError:
+                events = []
+            for chunk in subscription.feed(events):
+                yield chunk
+    finally:
+        hub.unsubscribe(deliver)
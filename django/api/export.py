@@ -0,0 +1,149 @@
+"""
+Streaming dumps of Match + Statistic rows for analysis.
+
+One row per Statistic with its match columns, ordered by statistic id so a
+dump can be resumed with after=<last statisticId>. Rows come from a
+server-side cursor and are encoded and optionally gzipped chunk by chunk,
+so memory stays flat whatever the row count. Archived matches (api.archive)
+keep their ids and are merged in.
+"""
+
+import csv
+import heapq
+import json
+import zlib
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import ArchivedMatch, ArchivedStatistic, Match, Statistic
+
+FORMATS = ('ndjson', 'csv')
+CHUNK_SIZE = 2000
+FLUSH_BYTES = 64 * 1024
+
+COLUMNS = [
+    ('statisticId', 'id'),
+    ('matchId', 'match_id'),
+    ('tournamentId', 'match__tournament_id'),
+    ('started', 'match__datetime_start'),
+    ('ended', 'match__datetime_end'),
+    ('prematureEnd', 'match__premature_end'),
+    ('userId', 'user_id'),
+    ('username', 'user__username'),
+    ('goalsScored', 'goals_scored'),
+    ('goalsReceived', 'goals_received'),
+    ('left', 'datetime_left'),
+    ('won', 'won'),
+]
+FIELDS = [key for key, _ in COLUMNS]
+
+
+def rows(user_id=None, tournament_id=None, after=None, chunk_size=CHUNK_SIZE):
+    """
+    Tuples in COLUMNS order. user_id keeps every statistic of the matches
+    that user played, opponents included; tournament_id those of one
+    tournament.
+    """
+    def ordered(match_model, statistic_model):
+        statistics = statistic_model.objects.filter(match__isnull=False)
+        if user_id is not None:
+            statistics = statistics.filter(match__in=match_model.objects.filter(statistic__user_id=user_id))
+        if tournament_id is not None:
+            statistics = statistics.filter(match__tournament_id=tournament_id)
+        if after is not None:
+            statistics = statistics.filter(id__gt=after)
+        return (
+            statistics
+            .order_by('id')
+            .values_list(*[column for _, column in COLUMNS])
+            .iterator(chunk_size=chunk_size)
+        )
+
+    return heapq.merge(
+        ordered(ArchivedMatch, ArchivedStatistic), ordered(Match, Statistic), key=lambda row: row[0]
+    )
+
+
+class _Line:
+    """File-like target for csv.writer that hands back each written line."""
+
+    def write(self, value):
+        return value
+
+
+def encode(rows, format='ndjson', header=True):
+    """Text chunks of roughly FLUSH_BYTES each; header only applies to CSV."""
+    if format == 'csv':
+        writer = csv.writer(_Line())
+        line = writer.writerow
+        first = writer.writerow(FIELDS) if header else ''
+    else:
+        encoder = DjangoJSONEncoder(separators=(',', ':'))
+        line = lambda row: encoder.encode(dict(zip(FIELDS, row))) + '\n'
+        first = ''
+
+    buffer = [first]
+    size = len(first)
+    for row in rows:
+        text = line(row)
+        buffer.append(text)
+        size += len(text)
+        if size >= FLUSH_BYTES:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if size:
+        yield ''.join(buffer)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(format='ndjson', compress=False, header=True, **filters):
+    chunks = encode(rows(**filters), format, header)
+    if compress:
+        return gzipped(chunks)
+    return (chunk.encode() for chunk in chunks)
+
+
+async def astream(format='ndjson', compress=False, header=True, **filters):
+    """
+    stream() for ASGI. Every chunk is produced by one hop to the request's
+    sync thread, so the server-side cursor stays on its connection and only
+    one chunk is in memory at a time.
+    """
+    chunks = stream(format, compress, header, **filters)
+    step = sync_to_async(next)
+    try:
+        while True:
+            chunk = await step(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Closes the cursors when the client goes away mid-dump
+        await sync_to_async(chunks.close)()
+
+
+def resume_point(path, format='ndjson'):
+    """
+    (statisticId of the last complete row, byte length up to the end of that
+    row) of an uncompressed export, so an interrupted dump can be cut back
+    and continued with after=.
+    """
+    last, length, offset = None, 0, 0
+    with open(path, 'rb') as f:
+        for text in f:
+            offset += len(text)
+            if text.endswith(b'\n'):
+                last, length = text, offset
+    if last is None:
+        return None, 0
+    if format == 'csv':
+        value = next(csv.reader([last.decode()]))[0]
+        return (None if value == FIELDS[0] else int(value)), length
+    return json.loads(last)['statisticId'], length
@@ -0,0 +1,180 @@
+"""
+Read-only fast paths for the serializers on the hottest GET endpoints.
+
+A CompiledSerializer walks a DRF serializer's fields once and turns each of
+them into a (key, column, converter) accessor that works on .values() rows,
+so no model instances or field objects are touched per row. The converters
+mirror the DRF to_representation of each field type and render() mirrors
+JSONRenderer, so the bytes are identical to the DRF serializers (see tests).
+"""
+
+import datetime
+import json
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from rest_framework import fields as drf_fields
+from rest_framework import relations
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+from .serializers import UserSerializer, FriendSerializer, MatchSerializer
+
+
+def _datetime(value, request=None):
+    # DateTimeField.enforce_timezone + ISO 8601 output
+    if isinstance(value, str):
+        return value
+    field_timezone = timezone.get_current_timezone() if settings.USE_TZ else None
+    if field_timezone is not None:
+        if timezone.is_aware(value):
+            value = value.astimezone(field_timezone)
+        else:
+            value = timezone.make_aware(value, field_timezone)
+    elif timezone.is_aware(value):
+        value = timezone.make_naive(value, datetime.timezone.utc)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _file(value, request=None):
+    if not value:
+        return None
+    url = default_storage.url(value)
+    if request is not None:
+        return request.build_absolute_uri(url)
+    return url
+
+
+def _identity(value, request=None):
+    return value
+
+
+def _int(value, request=None):
+    return int(value)
+
+
+def _str(value, request=None):
+    return str(value)
+
+
+def _converter(field):
+    if isinstance(field, drf_fields.DateTimeField):
+        if getattr(field, 'format', api_settings.DATETIME_FORMAT).lower() != drf_fields.ISO_8601:
+            raise TypeError("Only ISO 8601 datetimes can be compiled")
+        return _datetime
+    if isinstance(field, drf_fields.FileField):
+        if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+            return _str
+        return _file
+    if isinstance(field, drf_fields.BooleanField):
+        return _identity
+    if isinstance(field, drf_fields.IntegerField):
+        return _int
+    if isinstance(field, drf_fields.CharField):
+        return _str
+    if isinstance(field, (relations.PrimaryKeyRelatedField, drf_fields.ReadOnlyField)):
+        return _identity
+    raise TypeError(f"Cannot compile {type(field).__name__}")
+
+
+class CompiledSerializer:
+    def __init__(self, serializer_class, method_fields=None, fields=None):
+        """
+        method_fields maps a SerializerMethodField name to (columns, function)
+        where function builds the value from the row. fields optionally limits
+        the output to a subset, keeping the serializer's own key order.
+        """
+        self.serializer_class = serializer_class
+        self.method_fields = method_fields or {}
+        self.columns = []
+        self.accessors = []
+        self.m2m = []
+        self._subsets = {}
+
+        for name, field in serializer_class().fields.items():
+            if field.write_only or (fields is not None and name not in fields):
+                continue
+            if isinstance(field, drf_fields.SerializerMethodField):
+                columns, function = self.method_fields[name]
+                self.columns += columns
+                self.accessors.append((name, None, function))
+            elif isinstance(field, relations.ManyRelatedField):
+                self.m2m.append((name, field.source))
+                self.accessors.append((name, name, _identity))
+            else:
+                column = field.source.replace('.', '__')
+                self.columns.append(column)
+                self.accessors.append((name, column, _converter(field)))
+
+    def subset(self, fields):
+        key = frozenset(fields)
+        if key not in self._subsets:
+            self._subsets[key] = CompiledSerializer(self.serializer_class, self.method_fields, key)
+        return self._subsets[key]
+
+    def rows(self, queryset):
+        """Fetch the rows for a queryset: one values() query plus one per many-to-many field."""
+        # The primary key is always fetched, for m2m lookups and cursors
+        pk = queryset.model._meta.pk.attname
+        columns = self.columns if pk in self.columns else self.columns + [pk]
+        rows = list(queryset.values(*columns))
+        if self.m2m and rows:
+            by_pk = {row[pk]: row for row in rows}
+            for name, source in self.m2m:
+                for row in rows:
+                    row[name] = []
+                field = queryset.model._meta.get_field(source)
+                through = field.remote_field.through
+                owner = field.m2m_field_name()
+                target = field.m2m_reverse_field_name()
+                links = (
+                    through.objects
+                    .filter(**{f'{owner}__in': list(by_pk)})
+                    .order_by('pk')
+                    .values_list(f'{owner}_id', f'{target}_id')
+                )
+                for owner_id, target_id in links:
+                    by_pk[owner_id][name].append(target_id)
+        return rows
+
+    def to_representation(self, row, request=None):
+        data = {}
+        for name, column, convert in self.accessors:
+            if column is None:
+                data[name] = convert(row)
+                continue
+            value = row[column]
+            data[name] = None if value is None else convert(value, request)
+        return data
+
+    def many(self, rows, request=None):
+        return [self.to_representation(row, request) for row in rows]
+
+
+def render(data):
+    """Same bytes as rest_framework.renderers.JSONRenderer for the default settings."""
+    separators = (',', ':') if api_settings.COMPACT_JSON else (', ', ': ')
+    ret = json.dumps(
+        data, cls=encoders.JSONEncoder,
+        ensure_ascii=not api_settings.UNICODE_JSON,
+        allow_nan=not api_settings.STRICT_JSON, separators=separators,
+    )
+    return ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode()
+
+
+def _friend(row):
+    return {
+        "tid": row['friend_id'],
+        "username": row['friend__username'],
+        "status": row['friend__status'],
+        "last_online": row['friend__last_online'],
+    }
+
+
+user_serializer = CompiledSerializer(UserSerializer)
+match_serializer = CompiledSerializer(MatchSerializer)
+friend_serializer = CompiledSerializer(FriendSerializer, method_fields={
+    'friend': (['friend_id', 'friend__username', 'friend__status', 'friend__last_online'], _friend),
+})
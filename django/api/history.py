@@ -0,0 +1,184 @@
+from django.db.models import Case, When, F, Max, Q, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_datetime
+from . import archive
+from .models import ArchivedMatch, ArchivedStatistic, Match, Statistic
+
+
+def match_groups(user, before=None, limit=None, source=Match):
+    """
+    Return the (tournament_id, match_id, latest) keys of the user's history
+    groups, newest first. A group is either a whole tournament or a single
+    match outside of one; grouping and ordering happen in the database.
+    before is a cursor() and keeps only the groups after it in that order.
+    source is Match or ArchivedMatch.
+    """
+    groups = (
+        source.objects
+        .filter(statistic__user=user)
+        .annotate(single_id=Case(
+            When(tournament__isnull=True, then=F('id')),
+            default=None,
+            output_field=IntegerField(),
+        ))
+        .values('tournament_id', 'single_id')
+        .annotate(latest=Max('datetime_start'))
+        # The missing id of a group sorts as 0, the same on every database
+        .annotate(tournament_key=Coalesce('tournament_id', 0), single_key=Coalesce('single_id', 0))
+        .order_by('-latest', '-tournament_key', '-single_key')
+    )
+
+    if before is not None:
+        latest, tournament_key, single_key = before
+        # (latest, tournament_key, single_key) < before, spelled out for the ORM
+        groups = groups.filter(
+            Q(latest__lt=latest)
+            | Q(latest=latest, tournament_key__lt=tournament_key)
+            | Q(latest=latest, tournament_key=tournament_key, single_key__lt=single_key)
+        )
+    if limit is not None:
+        groups = groups[:limit]
+
+    return list(groups)
+
+
+def cursor(group):
+    """The position of a group in the history order, which also is the next page's before."""
+    return (group['latest'], group['tournament_id'] or 0, group['single_id'] or 0)
+
+
+def format_cursor(position):
+    latest, tournament_key, single_key = position
+    return f'{latest.isoformat()},{tournament_key},{single_key}'
+
+
+def parse_cursor(text):
+    """
+    The cursor of format_cursor, None when malformed. A bare timestamp, the
+    cursor of older clients, starts after every group that ended then.
+    """
+    latest, *keys = text.split(',')
+    latest = parse_datetime(latest)
+    if latest is None or len(keys) not in (0, 2):
+        return None
+    try:
+        keys = [int(key) for key in keys] or [0, 0]
+    except ValueError:
+        return None
+    return (latest, *keys)
+
+
+def group_key(group):
+    if group['tournament_id'] is not None:
+        return ('t', group['tournament_id'])
+    return ('m', group['single_id'])
+
+
+def needs_archive(user, groups, fetch):
+    """
+    Whether archived groups can make it onto the page: the user has archived
+    matches and the hot groups don't fill the page with newer ones. Costs
+    one primary key lookup; users without archived games never touch the
+    archive tables.
+    """
+    newest = archive.newest_archived(user)
+    if newest is None:
+        return False
+    if fetch is None or len(groups) < fetch:
+        return True
+    return newest >= groups[-1]['latest']
+
+
+def match_history(user, before=None, limit=None):
+    """
+    Build one page of the user's match history in the statistic_view shape:
+    [{tournamentId, matches: [{matchId, started, ended, prematureEnd, scores}]}]
+
+    Hot and archived groups are merged, so archiving doesn't change a page.
+    Returns the page and the cursor() for the next one (None on the last page).
+    """
+    fetch = None if limit is None else limit + 1
+    groups = match_groups(user, before, fetch)
+    archived_keys = set()
+
+    if needs_archive(user, groups, fetch):
+        archived = match_groups(user, before, fetch, ArchivedMatch)
+        if archived:
+            archived_keys = {group_key(group) for group in archived}
+            groups = sorted(groups + archived, key=cursor, reverse=True)[:fetch]
+
+    next_before = None
+    if limit is not None and len(groups) > limit:
+        groups = groups[:limit]
+        next_before = cursor(groups[-1])
+
+    if not groups:
+        return [], None
+
+    entries = {}
+    hot = [group for group in groups if group_key(group) not in archived_keys]
+    cold = [group for group in groups if group_key(group) in archived_keys]
+    if hot:
+        entries.update(group_entries(user, hot, Match, Statistic))
+    if cold:
+        entries.update(group_entries(user, cold, ArchivedMatch, ArchivedStatistic))
+
+    result = []
+    for group in groups:
+        key = group_key(group)
+        if key in entries:
+            result.append(entries[key])
+
+    return result, next_before
+
+
+def group_entries(user, groups, match_model, statistic_model):
+    """The history entries of the groups, keyed by group_key, read from one pair of tables."""
+    tournament_ids = [group['tournament_id'] for group in groups if group['tournament_id'] is not None]
+    single_ids = [group['single_id'] for group in groups if group['single_id'] is not None]
+
+    user_matches = match_model.objects.filter(statistic__user=user).filter(
+        Q(tournament_id__in=tournament_ids) | Q(id__in=single_ids)
+    )
+
+    rows = (
+        statistic_model.objects
+        .filter(match__in=user_matches)
+        .order_by('-match__datetime_start', 'match_id', 'id')
+        .values(
+            'match_id', 'match__datetime_start', 'match__datetime_end',
+            'match__premature_end', 'match__tournament_id',
+            'user_id', 'user__username', 'goals_scored', 'goals_received',
+            'datetime_left', 'won',
+        )
+    )
+
+    # Rows arrive newest match first, so a single pass keeps every order intact
+    entries = {}
+    matches = {}
+    for row in rows:
+        match_id = row['match_id']
+        if match_id not in matches:
+            tournament_id = row['match__tournament_id']
+            key = ('t', tournament_id) if tournament_id is not None else ('m', match_id)
+            if key not in entries:
+                entries[key] = {'tournamentId': tournament_id, 'matches': []}
+            matches[match_id] = {
+                'matchId': match_id,
+                'started': row['match__datetime_start'],
+                'ended': row['match__datetime_end'],
+                'prematureEnd': row['match__premature_end'],
+                'scores': [],
+            }
+            entries[key]['matches'].append(matches[match_id])
+
+        matches[match_id]['scores'].append({
+            'username': row['user__username'],
+            'tid': row['user_id'],
+            'scored': row['goals_scored'],
+            'received': row['goals_received'],
+            'left': row['datetime_left'],
+            'won': row['won'],
+        })
+
+    return entries
@@ -0,0 +1,106 @@
+import logging
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from .models import ArchivedMatch, User, Match, Statistic, Tournament
+from .serializers import MatchSerializer, StatisticSerializer
+from . import leaderboard, summary
+
+logger = logging.getLogger(__name__)
+
+TOURNAMENT_TYPE = 1
+
+
+class IngestError(Exception):
+    """Raised when a statistics payload does not validate; carries serializer-style errors."""
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def lock_tournaments(tournament_ids):
+    """
+    Lock the stored tournaments a payload adds matches to, so archive.run
+    cannot move them meanwhile. Raises IngestError for unknown tournaments
+    and for archived ones: a tournament lives in one table, hot or archived.
+    """
+    if not tournament_ids:
+        return set()
+    rows = dict(
+        Tournament.objects.select_for_update()
+        .filter(id__in=tournament_ids)
+        .annotate(archived=Exists(ArchivedMatch.objects.filter(tournament_id=OuterRef('id'))))
+        .values_list('id', 'archived')
+    )
+    errors = [f'Unknown tournament id: {tournament_id}' for tournament_id in sorted(tournament_ids - set(rows))]
+    errors += [f'Tournament {tournament_id} is archived' for tournament_id in sorted(rows) if rows[tournament_id]]
+    if errors:
+        raise IngestError({'tournamentId': errors})
+    return set(rows)
+
+
+def ingest_statistics(game_type, matches):
+    """
+    Write one statistics payload from the game server (a single match or a
+    whole tournament) with a constant number of queries.
+
+    Everything is validated up front, referenced users are checked in a single
+    query and the Tournament, Matches and Statistics are inserted with
+    bulk_create inside one transaction, which also locks the stored
+    tournaments the payload adds to. Returns the saved Statistic instances.
+    """
+    match_serializer = MatchSerializer(data=[data['db'] for data in matches], many=True)
+    if not match_serializer.is_valid():
+        raise IngestError(match_serializer.errors)
+
+    # matchId is the position of the match in the payload until the matches exist
+    scores = [
+        {
+            **score,
+            'matchId': index,
+            'datetimeLeft': score.get('datetimeLeft'),
+            'won': score.get('won', False)
+        }
+        for index, matchData in enumerate(matches) for score in matchData['scores']
+    ]
+
+    stat_serializer = StatisticSerializer(data=scores, many=True)
+    if not stat_serializer.is_valid():
+        raise IngestError(stat_serializer.errors)
+
+    match_rows = match_serializer.validated_data
+    stat_rows = stat_serializer.validated_data
+
+    user_ids = {row['user']['id'] for row in stat_rows}
+    known_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    if user_ids - known_users:
+        raise IngestError({'userId': [f'Unknown user id: {user_id}' for user_id in sorted(user_ids - known_users)]})
+
+    with transaction.atomic():
+        tournament = Tournament.objects.create() if game_type == TOURNAMENT_TYPE else None
+        known_tournaments = set()
+        if tournament is None:
+            known_tournaments = lock_tournaments({row['tournamentId'] for row in match_rows if row.get('tournamentId')})
+
+        match_instances = []
+        for row in match_rows:
+            row = dict(row)
+            tournament_id = row.pop('tournamentId', None)
+            if tournament is not None:
+                tournament_id = tournament.id
+            match_instances.append(Match(tournament_id=tournament_id or None, **row))
+        match_instances = Match.objects.bulk_create(match_instances)
+
+        stat_instances = []
+        for row in stat_rows:
+            row = dict(row)
+            match = match_instances[row.pop('match')['id']]
+            user_id = row.pop('user')['id']
+            stat_instances.append(Statistic(match=match, user_id=user_id, **row))
+        stat_instances = Statistic.objects.bulk_create(stat_instances)
+
+        leaderboard.record_statistics(stat_instances)
+        summary.record_statistics(stat_instances, known_tournaments)
+
+    logger.debug("Ingested %d matches and %d statistics", len(match_instances), len(stat_instances))
+    return stat_instances
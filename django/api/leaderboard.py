@@ -0,0 +1,165 @@
+from itertools import groupby
+from django.db import transaction
+from django.db.models import Q
+from . import archive
+from .models import LeaderboardEntry
+
+INITIAL_RATING = 1000
+K_FACTOR = 32
+
+ENTRY_FIELDS = ['rating', 'games_played', 'wins', 'losses', 'goals_scored', 'goals_received']
+
+
+def new_entry(user_id):
+    return LeaderboardEntry(
+        user_id=user_id, rating=INITIAL_RATING, games_played=0, wins=0,
+        losses=0, goals_scored=0, goals_received=0,
+    )
+
+
+def pair_score(won, other_won):
+    return 0.5 if won == other_won else (1 if won else 0)
+
+
+def apply_match(entries, scores):
+    """
+    Fold one match into the entries (a user_id -> LeaderboardEntry dict).
+
+    scores is a list of (user_id, goals_scored, goals_received, won). Ratings
+    move by a multiplayer Elo step: each player is compared against every
+    other player of the match, so the ratings before the match are used for
+    all of them. A pair scores 1/0 when one of them won and the other did
+    not, 0.5 each otherwise, so the changes of a match add up to zero up to
+    rounding, also in matches without a winner.
+    """
+    ratings = {user_id: entries[user_id].rating for user_id, *_ in scores}
+    winners = {user_id for user_id, *_, won in scores if won}
+
+    for user_id, scored, received, won in scores:
+        entry = entries[user_id]
+        entry.games_played += 1
+        entry.goals_scored += scored
+        entry.goals_received += received
+        if won:
+            entry.wins += 1
+        else:
+            entry.losses += 1
+
+        opponents = [other for other in ratings if other != user_id]
+        if not opponents:
+            continue
+
+        actual = sum(pair_score(user_id in winners, other in winners) for other in opponents) / len(opponents)
+        expected = sum(
+            1 / (1 + 10 ** ((ratings[other] - ratings[user_id]) / 400))
+            for other in opponents
+        ) / len(opponents)
+        entry.rating += round(K_FACTOR * (actual - expected))
+
+
+def record_statistics(statistics):
+    """
+    Update the leaderboard for freshly ingested Statistic instances.
+
+    Runs a fixed number of queries no matter how many matches the payload
+    holds: create missing rows, lock the affected rows, write them back.
+    Must be called inside the ingest transaction.
+    """
+    if not statistics:
+        return
+
+    user_ids = {stat.user_id for stat in statistics}
+
+    LeaderboardEntry.objects.bulk_create(
+        [new_entry(user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+    entries = {
+        entry.user_id: entry
+        for entry in LeaderboardEntry.objects.select_for_update().filter(user_id__in=user_ids)
+    }
+
+    ordered = sorted(statistics, key=lambda stat: (stat.match.datetime_start, stat.match_id))
+    for _, match_stats in groupby(ordered, key=lambda stat: stat.match_id):
+        apply_match(entries, [
+            (stat.user_id, stat.goals_scored, stat.goals_received, stat.won)
+            for stat in match_stats
+        ])
+
+    LeaderboardEntry.objects.bulk_update(entries.values(), ENTRY_FIELDS)
+
+
+def rebuild(chunk_size=2000):
+    """
+    Replay every statistic, archived ones included, in match order and
+    replace the leaderboard. Returns the number of entries.
+    """
+    rows = archive.replay_rows(
+        ('match_id', 'user_id', 'goals_scored', 'goals_received', 'won'), chunk_size
+    )
+
+    entries = {}
+    for _, match_rows in groupby(rows, key=lambda row: row[0]):
+        scores = [row[1:] for row in match_rows]
+        for user_id, *_ in scores:
+            if user_id not in entries:
+                entries[user_id] = new_entry(user_id)
+        apply_match(entries, scores)
+
+    with transaction.atomic():
+        LeaderboardEntry.objects.all().delete()
+        LeaderboardEntry.objects.bulk_create(entries.values(), batch_size=chunk_size)
+
+    return len(entries)
+
+
+def ranked():
+    return LeaderboardEntry.objects.select_related('user').order_by('-rating', 'user_id')
+
+
+def rank_of(entry):
+    """1-based rank; ties on rating are broken by user id like the ordering in ranked()."""
+    return LeaderboardEntry.objects.filter(
+        Q(rating__gt=entry.rating) | Q(rating=entry.rating, user_id__lt=entry.user_id)
+    ).count() + 1
+
+
+def top(offset=0, limit=20):
+    return [
+        serialize(entry, offset + index + 1)
+        for index, entry in enumerate(ranked()[offset:offset + limit])
+    ]
+
+
+def around(entry, count=5):
+    """Up to count players directly above and below the entry, with the entry itself in the middle."""
+    rank = rank_of(entry)
+
+    above = list(
+        LeaderboardEntry.objects.select_related('user')
+        .filter(Q(rating__gt=entry.rating) | Q(rating=entry.rating, user_id__lt=entry.user_id))
+        .order_by('rating', '-user_id')[:count]
+    )
+    below = list(
+        LeaderboardEntry.objects.select_related('user')
+        .filter(Q(rating__lt=entry.rating) | Q(rating=entry.rating, user_id__gt=entry.user_id))
+        .order_by('-rating', 'user_id')[:count]
+    )
+
+    result = [serialize(other, rank - index - 1) for index, other in enumerate(above)][::-1]
+    result.append(serialize(entry, rank))
+    result += [serialize(other, rank + index + 1) for index, other in enumerate(below)]
+    return result
+
+
+def serialize(entry, rank):
+    return {
+        'rank': rank,
+        'tid': entry.user_id,
+        'username': entry.user.username,
+        'rating': entry.rating,
+        'gamesPlayed': entry.games_played,
+        'wins': entry.wins,
+        'losses': entry.losses,
+        'goalsScored': entry.goals_scored,
+        'goalsReceived': entry.goals_received,
+    }
@@ -0,0 +1,112 @@
+"""
+The login pipeline behind login_view.
+
+The user and their auth token come back from one joined query, the 2FA
+device from one more query only when the user has 2FA, and the password
+hash is checked on a bounded worker pool so a burst of logins cannot tie
+up every request thread with bcrypt.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.db import IntegrityError, transaction
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from rest_framework.authtoken.models import Token
+from .metrics import registry
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class PoolBusy(Exception):
+    """Raised when every hashing slot is taken; the caller should retry later."""
+
+
+class HashPool:
+    """
+    A thread or process pool for password checks with a hard bound on the
+    checks running plus waiting. bcrypt releases the GIL, so threads scale
+    across cores; a process pool also isolates pure-Python hashers.
+    """
+
+    def __init__(self, workers, backlog, kind='thread', timeout=10):
+        executor_class = ProcessPoolExecutor if kind == 'process' else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+        self.timeout = timeout
+
+    def check(self, password, encoded):
+        if not self.slots.acquire(blocking=False):
+            registry.inc('api_login_hash_rejected_total')
+            raise PoolBusy()
+        started = time.perf_counter()
+        try:
+            future = self.executor.submit(check_password, password, encoded)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the check is done, not until we stop waiting for it
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()  # only drops a check that is still queued
+            raise PoolBusy()
+        finally:
+            registry.observe('api_login_hash_seconds', time.perf_counter() - started, buckets=HASH_BUCKETS)
+
+
+registry.describe('api_login_hash_seconds', 'histogram', 'Password checks including the wait for a pool worker.')
+registry.describe('api_login_hash_rejected_total', 'counter', 'Logins turned away because the hashing pool was full.')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HashPool(
+                workers=getattr(settings, 'LOGIN_HASH_WORKERS', 2),
+                backlog=getattr(settings, 'LOGIN_HASH_BACKLOG', 16),
+                kind=getattr(settings, 'LOGIN_HASH_EXECUTOR', 'thread'),
+                timeout=getattr(settings, 'LOGIN_HASH_TIMEOUT', 10),
+            )
+        return _pool
+
+
+def load_user(username):
+    """The user with their auth token joined in, or None."""
+    return User.objects.select_related('auth_token').filter(username=username).first()
+
+
+def login_device(user):
+    """
+    The TOTP device to verify against: the confirmed one, else the first
+    unconfirmed one, which gets confirmed here as the old login did.
+    """
+    device = TOTPDevice.objects.filter(user=user).order_by('-confirmed', 'id').first()
+    if device is not None and not device.confirmed:
+        device.confirmed = True
+        device.save(update_fields=['confirmed'])
+    return device
+
+
+def auth_token(user):
+    try:
+        return user.auth_token
+    except Token.DoesNotExist:
+        pass
+    try:
+        with transaction.atomic():
+            return Token.objects.create(user=user)
+    except IntegrityError:  # created by a concurrent login
+        return Token.objects.get(user=user)
@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move matches older than ARCHIVE_AFTER_DAYS (or --older-than-days) with their statistics into the '
+        'archive tables, batch by batch. Safe to interrupt and rerun; --check verifies the per-user rollups.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, help='Defaults to ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--batch-size', type=int, default=archive.BATCH_SIZE, help='Matches per transaction')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches')
+        parser.add_argument('--check', action='store_true', help='Compare the rollups with the archived rows instead')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = archive.check()
+            for user_id, field, stored, expected in mismatches:
+                self.stdout.write(f"user {user_id}: {field} is {stored}, expected {expected}")
+            if mismatches:
+                raise CommandError(f"{len(mismatches)} mismatching rollup fields")
+            self.stdout.write(self.style.SUCCESS('Rollups consistent'))
+            return
+
+        cutoff = None
+        if options['older_than_days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+
+        started = time.perf_counter()
+        total_matches = total_statistics = 0
+        batches = archive.run(cutoff, options['batch_size'], options['max_batches'])
+        for number, (matches, statistics) in enumerate(batches, 1):
+            total_matches += matches
+            total_statistics += statistics
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"batch {number}: {matches} matches, {statistics} statistics "
+                f"({total_matches / elapsed:.0f} matches/s, {total_statistics / elapsed:.0f} statistics/s)"
+            )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total_matches} matches and {total_statistics} statistics in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,68 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a synthetic data set, drive the main api endpoints in-process and write '
+        'latency percentiles, query counts and peak memory to a JSON report. '
+        'Everything is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--friends', type=int, default=20, help='Friend edges per user')
+        parser.add_argument('--singles', type=int, default=2000, help='Single matches')
+        parser.add_argument('--tournaments', type=int, default=200, help='Tournaments of 7 matches')
+        parser.add_argument('--players', type=int, default=4, help='Players per match')
+        parser.add_argument('--iterations', type=int, default=50, help='Requests per endpoint')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='bench_report.json', help='Where to write the JSON report')
+        parser.add_argument('--compare', help='Previous report to print deltas against')
+
+    def handle(self, *args, **options):
+        params = {
+            name: options[name]
+            for name in ('users', 'friends', 'singles', 'tournaments', 'players', 'iterations', 'seed')
+        }
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            users = benchmark.seed(
+                users=params['users'], friends=params['friends'], singles=params['singles'],
+                tournaments=params['tournaments'], players=params['players'], seed=params['seed'],
+            )
+            seed_seconds = round(time.perf_counter() - started, 2)
+            self.stdout.write(f"Seeded in {seed_seconds}s")
+
+            endpoints = benchmark.run_endpoints(users, params['iterations'], params['players'], params['seed'])
+            transaction.set_rollback(True)
+
+        report = {
+            'meta': benchmark.metadata(),
+            'params': params,
+            'seed_seconds': seed_seconds,
+            'endpoints': endpoints,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['endpoints']
+
+        for name, result in endpoints.items():
+            line = (
+                f"{name:>32}: p50 {result['p50_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+                f"{result['queries_per_request']:6.1f} q/req  {result['peak_memory_kb']:8.1f}KB"
+            )
+            if previous and name in previous:
+                before = previous[name]
+                line += f"  (p50 {result['p50_ms'] - before['p50_ms']:+.2f}ms, q/req {result['queries_per_request'] - before['queries_per_request']:+.1f})"
+            self.stdout.write(line)
+
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
@@ -0,0 +1,68 @@
+import copy
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from api.models import User, Tournament
+from api.serializers import MatchSerializer, StatisticSerializer
+from api.ingest import ingest_statistics
+from api.benchmark import build_payload
+
+
+def legacy_ingest(game_type, matches):
+    """The serializer-driven write path statistic_view used before api.ingest."""
+    if game_type == 1:
+        tournament_id = Tournament.objects.create().id
+        for match_data in matches:
+            match_data['db']['tournamentId'] = tournament_id
+
+    serializer = MatchSerializer(data=[data['db'] for data in matches], many=True)
+    serializer.is_valid(raise_exception=True)
+    for index, instance in enumerate(serializer.save()):
+        for score in matches[index]['scores']:
+            score['matchId'] = instance.id
+
+    scores = [
+        {**score, 'datetimeLeft': score.get('datetimeLeft'), 'won': score.get('won', False)}
+        for match_data in matches for score in match_data['scores']
+    ]
+    serializer = StatisticSerializer(data=scores, many=True)
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+
+class Command(BaseCommand):
+    help = 'Compare queries per statistics payload between the legacy serializer path and the bulk ingest path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--matches', type=int, default=7, help='Matches per tournament payload')
+        parser.add_argument('--players', type=int, default=4, help='Players per match')
+
+    def handle(self, *args, **options):
+        payloads = {
+            'single match': (0, 1),
+            'tournament': (1, options['matches']),
+        }
+
+        # Everything runs inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'bench_ingest_{i}', email=f'bench_ingest_{i}@example.com')
+                for i in range(options['players'] * 2)
+            ])
+            user_ids = [user.id for user in users]
+
+            for label, (game_type, match_count) in payloads.items():
+                payload = build_payload(user_ids, game_type, match_count, options['players'])
+                results = {}
+                for name, ingest in (('legacy', legacy_ingest), ('bulk', ingest_statistics)):
+                    with CaptureQueriesContext(connection) as queries:
+                        ingest(payload['type'], copy.deepcopy(payload['matches']))
+                    results[name] = len(queries)
+
+                rows = match_count * options['players']
+                self.stdout.write(
+                    f"{label:>12}: {match_count} matches / {rows} scores -> "
+                    f"legacy {results['legacy']} queries, bulk {results['bulk']} queries"
+                )
+
+            transaction.set_rollback(True)
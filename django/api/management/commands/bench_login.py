@@ -0,0 +1,82 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from rest_framework.authtoken.models import Token
+from api import login
+from api.models import User
+
+PASSWORD = 'bench-password'
+
+
+def legacy_login(username, password):
+    """The lookups login_view did before api.login, hashing on the calling thread."""
+    user = User.objects.get(username=username)
+    check_password(password, user.password)
+    if user.has_2fa:
+        device = TOTPDevice.objects.filter(user=user, confirmed=True).first()
+        if not device:
+            TOTPDevice.objects.filter(user=user, confirmed=False).first()
+    return Token.objects.get_or_create(user=user)[0]
+
+
+def pipeline_login(username, password):
+    user = login.load_user(username)
+    login.pool().check(password, user.password)
+    if user.has_2fa:
+        login.login_device(user)
+    return login.auth_token(user)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure password-check throughput (logins/s per core) through the login hash pool and '
+        'compare queries per login of the old and new pipelines. Uses the production hasher.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=200, help='Password checks per pool size')
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--hasher', help='Hasher algorithm, the first PASSWORD_HASHERS entry by default')
+
+    def handle(self, *args, **options):
+        cores = os.cpu_count() or 1
+        encoded = make_password(PASSWORD, hasher=options['hasher'] or 'default')
+
+        for workers in sorted({1, max(1, cores // 2), cores, cores * 2}):
+            pool = login.HashPool(workers=workers, backlog=options['logins'])
+            # Request threads submitting concurrently, as under a login burst
+            with ThreadPoolExecutor(max_workers=workers * 2) as clients:
+                started = time.perf_counter()
+                list(clients.map(lambda _: pool.check(PASSWORD, encoded), range(options['logins'])))
+                elapsed = time.perf_counter() - started
+            pool.executor.shutdown()
+            rate = options['logins'] / elapsed
+            self.stdout.write(f"{workers:>3} workers: {rate:8.1f} logins/s  {rate / min(workers, cores):8.1f} logins/s/core")
+
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f"bench_login_{i}", email=f"bench_login_{i}@example.com", password=encoded)
+                for i in range(options['users'])
+            ])
+            for name, function in (('legacy', legacy_login), ('pipeline', pipeline_login)):
+                Token.objects.filter(user__in=users).delete()
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    for user in users:
+                        function(user.username, PASSWORD)
+                    elapsed = time.perf_counter() - started
+                # The first pass creates the tokens, the second one reuses them
+                with CaptureQueriesContext(connection) as repeat:
+                    for user in users:
+                        function(user.username, PASSWORD)
+                self.stdout.write(
+                    f"{name:>8}: {len(captured) / len(users):.2f} queries/login (new token)  "
+                    f"{len(repeat) / len(users):.2f} queries/login (existing token)  "
+                    f"{elapsed / len(users) * 1000:.1f}ms/login"
+                )
+            transaction.set_rollback(True)
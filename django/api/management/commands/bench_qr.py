@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from api import qr
+
+SECRET = 'JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP'
+
+
+def config_url(i):
+    return f'otpauth://totp/bench_qr_{i}?secret={SECRET}&algorithm=SHA1&digits=6&period=30'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure 2FA QR renders per second for each format, uncached (a new provisioning URI '
+        'per render) and cached (the same URI again), and the size of the data URI setup_2fa returns.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--renders', type=int, default=200)
+
+    def handle(self, *args, **options):
+        renders = options['renders']
+        for fmt in qr.FORMATS:
+            qr.qr_cache.clear()
+            started = time.perf_counter()
+            for i in range(renders):
+                uri = qr.render(config_url(i), fmt)
+            cold = renders / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for _ in range(renders):
+                qr.render(config_url(0), fmt)
+            warm = renders / (time.perf_counter() - started)
+
+            self.stdout.write(
+                f"{fmt}: {cold:8.1f} renders/s uncached  {warm:10.1f} renders/s cached  {len(uri):6d} bytes"
+            )
+        qr.qr_cache.clear()
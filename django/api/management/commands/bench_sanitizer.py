@@ -0,0 +1,80 @@
+import html
+import random
+import re
+import time
+from django.core.management.base import BaseCommand
+from api.sanitizer import bleachThe, bleach_many
+
+CONTEXTS = ('default', 'url', 'query')
+
+# Mostly plain names and emails like the views see, plus some hostile input
+SAMPLES = [
+    'player_42', '  Ada Lovelace  ', 'ada@example.com', 'https://cdn.intra.42.fr/users/ada.jpg',
+    "Robert'); DROP TABLE api_user;--", '<script>alert(1)</script>hello', 'a /* b */ c', 'tab\tand\nnewline',
+    'ünïcødé name', 'x' * 64,
+]
+
+
+def legacy_bleach(input_string, context='default'):
+    """bleachThe before the table-driven rewrite, kept as the reference output."""
+    try:
+        if input_string is None:
+            return ""
+
+        if not isinstance(input_string, str):
+            raise ValueError("Input must be a string")
+
+        sanitized = input_string.strip()
+
+        if context == 'url':
+            allowed_pattern = re.compile(r"[^a-zA-Z0-9\s\.\,\@\!\?\-\_\(\)\[\]\{\}\+\=\~\*/\:;&=%]")
+            sanitized = allowed_pattern.sub("", sanitized)
+        elif context == 'query':
+            allowed_pattern = re.compile(r"[^a-zA-Z0-9\s\.\,\@\!\?\-\_\(\)\[\]\{\}\+\=\~\*/\:\;&]")
+            sanitized = allowed_pattern.sub("", sanitized)
+        else:
+            sanitized = re.sub(r"<script>.*?</script>", "", sanitized, flags=re.IGNORECASE)
+            sanitized = html.escape(sanitized)
+            sanitized = re.sub(r"/\*.*?\*/", "", sanitized, flags=re.DOTALL)
+            sanitized = re.sub(r"--.*$", "", sanitized, flags=re.MULTILINE)
+            sanitized = re.sub(r";.*$", "", sanitized, flags=re.MULTILINE)
+            allowed_pattern = re.compile(r"[^a-zA-Z0-9\s\.\,\@\!\?\-\_\(\)\[\]\{\}\+\=\~\*]")
+            sanitized = allowed_pattern.sub("", sanitized)
+
+        sanitized = re.sub(r"\s+", " ", sanitized)
+
+        return sanitized
+    except Exception:
+        return ""
+
+
+class Command(BaseCommand):
+    help = 'Strings per second through the old and the table-driven sanitizer, per context.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strings', type=int, default=200000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        strings = [rng.choice(SAMPLES) for _ in range(options['strings'])]
+
+        for context in CONTEXTS:
+            results = {}
+            for name, function in (
+                ('legacy', lambda: [legacy_bleach(value, context) for value in strings]),
+                ('bleachThe', lambda: [bleachThe(value, context) for value in strings]),
+                ('bleach_many', lambda: bleach_many(strings, context)),
+            ):
+                started = time.perf_counter()
+                output = function()
+                results[name] = len(strings) / (time.perf_counter() - started)
+                if name == 'legacy':
+                    expected = output
+                elif output != expected:
+                    self.stderr.write(f"{name} output differs from the legacy sanitizer in context {context}")
+
+            self.stdout.write(
+                f"{context:>8}: " + '  '.join(f"{name} {rate:,.0f}/s" for name, rate in results.items())
+                + f"  ({results['bleachThe'] / results['legacy']:.1f}x)"
+            )
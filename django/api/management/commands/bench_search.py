@@ -0,0 +1,87 @@
+import random
+import string
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from api import search
+from api.models import Friend, User
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'to', 'zen', 'pho', 'lin', 'dar', 'vex', 'qua', 'bri']
+
+
+def synthetic_name(rng, index):
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return f"{name}{rng.choice(string.digits)}_{index}"
+
+
+def legacy_search(user, query):
+    """The search_users query before the index: icontains plus a separate friend lookup."""
+    users = User.objects.filter(username__icontains=query).exclude(id=user.id)
+    friends = Friend.objects.filter(user=user).values_list('friend__id', flat=True)
+    users = users.exclude(id__in=friends)
+    if not users.exists():
+        return []
+    return [{'id': user.id, 'username': user.username} for user in users]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Seed synthetic users in a rolled-back transaction and compare search latency percentiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--friends', type=int, default=50, help='Friends of the searching user')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            User.objects.bulk_create(
+                [
+                    User(username=synthetic_name(rng, i), email=f"bench_search_{i}@example.com", password='')
+                    for i in range(options['users'])
+                ],
+                batch_size=5000,
+            )
+            users = User.objects.filter(email__startswith='bench_search_')
+            search.rebuild(users, chunk_size=5000)
+            me = users.order_by('id').first()
+            Friend.objects.bulk_create([
+                Friend(user=me, friend_id=friend_id)
+                for friend_id in users.exclude(id=me.id).order_by('?').values_list('id', flat=True)[:options['friends']]
+            ])
+            self.stdout.write(f"Seeded and indexed {options['users']} users in {time.perf_counter() - started:.1f}s")
+
+            queries = []
+            for _ in range(options['queries']):
+                syllable = rng.choice(SYLLABLES)
+                queries.append(rng.choice([syllable[:1], syllable, syllable + rng.choice(SYLLABLES)]))
+
+            engines = {
+                'legacy icontains': lambda query: legacy_search(me, query),
+                'search index': lambda query: search.search(me, query)[0],
+            }
+            for label, engine in engines.items():
+                timings = []
+                query_count = 0
+                for query in queries:
+                    with CaptureQueriesContext(connection) as captured:
+                        started = time.perf_counter()
+                        engine(query)
+                        timings.append((time.perf_counter() - started) * 1000)
+                    query_count += len(captured)
+                self.stdout.write(
+                    f"{label:>16}: p50 {percentile(timings, 0.50):.2f}ms  "
+                    f"p95 {percentile(timings, 0.95):.2f}ms  p99 {percentile(timings, 0.99):.2f}ms  "
+                    f"{query_count / len(queries):.1f} queries/search"
+                )
+
+            transaction.set_rollback(True)
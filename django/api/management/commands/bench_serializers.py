@@ -0,0 +1,68 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+from rest_framework.renderers import JSONRenderer
+from api.fastserializers import user_serializer, friend_serializer, match_serializer, render
+from api.models import Friend, Match, User
+from api.serializers import UserSerializer, FriendSerializer, MatchSerializer
+
+
+def objects_per_second(function, count, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+class Command(BaseCommand):
+    help = 'Compare objects/second of the DRF serializers and the compiled fast paths (fetch + serialize + render).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--objects', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        count = options['objects']
+        renderer = JSONRenderer()
+
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f"bench_serializer_{i}", email=f"bench_serializer_{i}@example.com", password='')
+                for i in range(count)
+            ])
+            owner = users[0]
+            Friend.objects.bulk_create([Friend(user=owner, friend=user) for user in users[1:]])
+            started = now()
+            Match.objects.bulk_create([Match(datetime_start=started, datetime_end=started) for _ in range(count)])
+
+            user_ids = [user.id for user in users]
+            cases = [
+                (
+                    'UserSerializer',
+                    lambda: renderer.render(UserSerializer(User.objects.filter(id__in=user_ids).prefetch_related('groups', 'user_permissions'), many=True).data),
+                    lambda: render(user_serializer.many(user_serializer.rows(User.objects.filter(id__in=user_ids)))),
+                ),
+                (
+                    'FriendSerializer',
+                    lambda: renderer.render(FriendSerializer(Friend.objects.filter(user=owner).select_related('friend'), many=True).data),
+                    lambda: render(friend_serializer.many(friend_serializer.rows(Friend.objects.filter(user=owner)))),
+                ),
+                (
+                    'MatchSerializer',
+                    lambda: renderer.render(MatchSerializer(Match.objects.all(), many=True).data),
+                    lambda: render(match_serializer.many(match_serializer.rows(Match.objects.all()))),
+                ),
+            ]
+
+            for label, drf, fast in cases:
+                drf_rate = objects_per_second(drf, count, options['repeat'])
+                fast_rate = objects_per_second(fast, count, options['repeat'])
+                self.stdout.write(
+                    f"{label:>16}: DRF {drf_rate:,.0f} obj/s, compiled {fast_rate:,.0f} obj/s ({fast_rate / drf_rate:.1f}x)"
+                )
+
+            transaction.set_rollback(True)
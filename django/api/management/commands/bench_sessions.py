@@ -0,0 +1,73 @@
+import time
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from api.models import User
+
+PASSWORD = 'bench-password'
+
+MODES = {
+    # The settings before SESSION_MODE existed
+    'legacy': {'SESSION_ENGINE': 'django.contrib.sessions.backends.db', 'SESSION_SAVE_EVERY_REQUEST': True},
+    'db': {'SESSION_ENGINE': 'django.contrib.sessions.backends.db'},
+    'cache': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db'},
+    'signed': {'SESSION_ENGINE': 'api.sessions'},
+}
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = (
+        'Log in once per session mode and count database writes and session queries per '
+        'request on a session-reading endpoint. Runs in a rolled-back transaction; the '
+        'session cache is a local-memory cache during the run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--refresh-interval', type=int, default=300)
+
+    def handle(self, *args, **options):
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'sessions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench-sessions'},
+        }
+
+        with transaction.atomic():
+            user = User.objects.create(
+                username='bench_sessions', email='bench_sessions@example.com', password=make_password(PASSWORD)
+            )
+
+            for mode, mode_settings in MODES.items():
+                with override_settings(
+                    CACHES=caches, RATE_LIMIT_ENABLED=False,
+                    SESSION_REFRESH_INTERVAL=options['refresh_interval'],
+                    **{'SESSION_SAVE_EVERY_REQUEST': False, **mode_settings},
+                ):
+                    client = Client(SERVER_NAME='localhost')
+                    login = client.post(
+                        '/api/login/', {'username': user.username, 'password': PASSWORD}, content_type='application/json'
+                    )
+                    headers = {'HTTP_AUTHORIZATION': f"Bearer {login.json()['jwtToken']}"}
+
+                    writes = session_queries = 0
+                    started = time.perf_counter()
+                    for _ in range(options['requests']):
+                        with CaptureQueriesContext(connection) as captured:
+                            client.get('/api/user/data/', **headers)
+                        for query in captured:
+                            sql = query['sql'].lstrip().upper()
+                            writes += sql.startswith(WRITES)
+                            session_queries += 'DJANGO_SESSION' in sql
+                    elapsed = time.perf_counter() - started
+
+                self.stdout.write(
+                    f"{mode:>8}: {writes / options['requests']:.3f} writes/req  "
+                    f"{session_queries / options['requests']:.3f} session queries/req  "
+                    f"{elapsed / options['requests'] * 1000:.2f}ms/req"
+                )
+
+            transaction.set_rollback(True)
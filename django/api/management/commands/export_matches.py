@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from api import export
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream Match + Statistic rows (all, one user\'s matches or one tournament) as NDJSON or CSV. '
+        'With --resume an interrupted uncompressed export is cut back to its last complete row and continued.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='ndjson')
+        parser.add_argument('--user', type=int, help='User id')
+        parser.add_argument('--tournament', type=int, help='Tournament id')
+        parser.add_argument('--after', type=int, help='Only rows with a larger statisticId')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', help='File to write, stdout by default')
+        parser.add_argument('--resume', action='store_true', help='Continue the export already in --output')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        after = options['after']
+        header = True
+        mode = 'wb'
+
+        if options['resume']:
+            if not options['output'] or options['gzip']:
+                raise CommandError('--resume needs an uncompressed --output file')
+            if os.path.exists(options['output']):
+                after, length = export.resume_point(options['output'], options['format'])
+                with open(options['output'], 'r+b') as f:
+                    f.truncate(length)
+                header = length == 0
+                mode = 'ab'
+
+        started = time.perf_counter()
+        chunks = export.stream(
+            options['format'], options['gzip'], header,
+            user_id=options['user'], tournament_id=options['tournament'], after=after,
+            chunk_size=options['chunk_size'],
+        )
+
+        written = 0
+        target = open(options['output'], mode) if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                target.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                target.close()
+
+        if options['output']:
+            resumed = f" after statisticId {after}" if after is not None else ''
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} bytes{resumed} to {options['output']} in {time.perf_counter() - started:.2f}s"
+            ))
@@ -0,0 +1,55 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent requests at a running server and report throughput, latency percentiles '
+        'and errors per concurrency level. To compare the sync and async paths, run it once against '
+        '`ASYNC_VIEWS=false gunicorn backend.wsgi -w 4` and once against the ASGI deployment the '
+        'Dockerfile starts, with the same worker count, e.g. '
+        '`manage.py load_test --base-url http://localhost:8000 --token <key> --concurrency 8,64,256`. '
+        'Requests run on client threads; keep them on another machine than the server when you can.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://localhost:8000')
+        parser.add_argument('--path', default='/api/user/validate/')
+        parser.add_argument('--token', help='Auth token sent as "Authorization: Token <key>"')
+        parser.add_argument('--concurrency', default='1,8,32,128', help='Comma separated client counts')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per concurrency level')
+        parser.add_argument('--timeout', type=float, default=10)
+
+    def handle(self, *args, **options):
+        url = options['base_url'].rstrip('/') + options['path']
+        headers = {'Authorization': f"Token {options['token']}"} if options['token'] else {}
+        local = threading.local()
+
+        def fetch(_):
+            # One keep-alive session per client thread
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            started = time.perf_counter()
+            try:
+                ok = local.session.get(url, headers=headers, timeout=options['timeout']).status_code < 400
+            except requests.RequestException:
+                ok = False
+            return (time.perf_counter() - started) * 1000, ok
+
+        for concurrency in (int(level) for level in options['concurrency'].split(',')):
+            with ThreadPoolExecutor(max_workers=concurrency) as clients:
+                started = time.perf_counter()
+                results = list(clients.map(fetch, range(options['requests'])))
+                elapsed = time.perf_counter() - started
+
+            ordered = sorted(timing for timing, _ in results)
+            errors = sum(1 for _, ok in results if not ok)
+            self.stdout.write(
+                f"{concurrency:>4} clients: {len(results) / elapsed:8.1f} req/s  "
+                f"p50 {ordered[len(ordered) // 2]:8.2f}ms  "
+                f"p99 {ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]:8.2f}ms  "
+                f"{errors} errors"
+            )
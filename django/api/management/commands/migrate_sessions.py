@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+
+class Command(BaseCommand):
+    help = (
+        'Prepare existing database sessions for a SESSION_MODE switch. For "cache" the live sessions '
+        'are copied into the session cache so the first requests after the switch skip the database; '
+        '"signed" needs no copy, api.sessions converts database sessions on their next request.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--clear-expired', action='store_true', help='Delete expired database sessions first')
+
+    def handle(self, *args, **options):
+        if options['clear_expired']:
+            deleted, _ = Session.objects.filter(expire_date__lte=now()).delete()
+            self.stdout.write(f"Deleted {deleted} expired sessions")
+
+        if settings.SESSION_MODE == 'signed':
+            self.stdout.write(self.style.SUCCESS('Signed sessions convert on first use, nothing to copy'))
+            return
+        if settings.SESSION_MODE != 'cache':
+            raise CommandError(f"Nothing to migrate for SESSION_MODE={settings.SESSION_MODE!r}")
+
+        current = now()
+        copied = 0
+        sessions = (
+            Session.objects.filter(expire_date__gt=current)
+            .values_list('session_key', 'session_data', 'expire_date')
+            .iterator(chunk_size=options['chunk_size'])
+        )
+        for session_key, session_data, expire_date in sessions:
+            store = cached_db.SessionStore(session_key)
+            store._cache.set(store.cache_key, store.decode(session_data), int((expire_date - current).total_seconds()))
+            copied += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Copied {copied} sessions into the '{settings.SESSION_CACHE_ALIAS}' cache"))
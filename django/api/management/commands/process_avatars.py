@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from api import avatars
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = 'Move existing avatars into the content-addressed layout and render their variants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only this user id')
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(avatar='').exclude(avatar__isnull=True).order_by('id')
+        if options['user'] is not None:
+            users = users.filter(id=options['user'])
+
+        started = time.perf_counter()
+        done = skipped = failed = 0
+        for user in users.only('id', 'avatar').iterator():
+            try:
+                name = avatars.backfill(user)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"user {user.id}: {user.avatar.name}: {e}")
+                continue
+            if name is None:
+                skipped += 1
+            else:
+                done += 1
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {done} avatars, {skipped} already done, {failed} failed in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,34 @@
+import pstats
+from django.core.management.base import BaseCommand, CommandError
+from api import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge the sampled request profiles into one report and refresh the summary.txt of each endpoint, '
+        'or print a signed X-Profile-Token with --sign.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', help='Only merge the dumps of this URL name')
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key')
+        parser.add_argument('--limit', type=int, default=40)
+        parser.add_argument('--output', help='Also write the merged profile to this .prof file')
+        parser.add_argument('--sign', metavar='URL_NAME', help="Print a header value profiling URL_NAME ('*' for any)")
+
+    def handle(self, *args, **options):
+        if options['sign']:
+            self.stdout.write(profiling.sign(options['sign']))
+            return
+
+        paths = profiling.dumps(options['view'])
+        if not paths:
+            raise CommandError(f"No profiles in {profiling.directory()}")
+
+        endpoints = profiling.write_summaries(options['view'], options['sort'], options['limit'])
+        self.stdout.write(f"{len(paths)} profiles of {', '.join(endpoints)}")
+        self.stdout.write(profiling.summarize(paths, options['sort'], options['limit']))
+
+        if options['output']:
+            pstats.Stats(*[str(path) for path in paths]).dump_stats(options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Merged profile written to {options['output']}"))
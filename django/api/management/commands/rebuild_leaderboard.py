@@ -0,0 +1,16 @@
+import time
+from django.core.management.base import BaseCommand
+from api import leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the leaderboard from all existing Statistic rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = leaderboard.rebuild(chunk_size=options['chunk_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt leaderboard for {count} users in {elapsed:.2f}s"))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from api import summary
+
+
+class Command(BaseCommand):
+    help = 'Recompute every UserStatsSummary from the Statistic rows, or only check them with --check.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--check', action='store_true', help='Report mismatches instead of rebuilding')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        if options['check']:
+            mismatches = summary.check(chunk_size=options['chunk_size'])
+            for user_id, field, stored, expected in mismatches:
+                self.stdout.write(f"user {user_id}: {field} is {stored}, expected {expected}")
+            if mismatches:
+                raise CommandError(f"{len(mismatches)} mismatching summary fields")
+            self.stdout.write(self.style.SUCCESS(f"Summaries consistent ({time.perf_counter() - started:.2f}s)"))
+            return
+
+        count = summary.rebuild(chunk_size=options['chunk_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} summaries in {elapsed:.2f}s"))
@@ -0,0 +1,106 @@
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Process-local counters and histograms rendered in the Prometheus text
+    format by /api/metrics/. Other modules can add collectors for stats they
+    already keep (token cache, presence batches, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def collector(self, function):
+        """
+        Register a function returning (name, kind, help, [(labels dict, value)])
+        tuples, read at scrape time. Usable as a decorator.
+        """
+        self._collectors.append(function)
+        return function
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        families = {}
+
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, []).append(f"{name}{_labels(labels)} {_number(value)}")
+            for (name, labels), histogram in self._histograms.items():
+                lines = families.setdefault(name, [])
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(float(bound))),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(histogram['sum'])}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+
+        for function in self._collectors:
+            for name, kind, help_text, samples in function():
+                self._meta.setdefault(name, (kind, help_text))
+                families.setdefault(name, []).extend(
+                    f"{name}{_labels(tuple(sorted(labels.items())))} {_number(value)}"
+                    for labels, value in samples
+                )
+
+        output = []
+        for name in sorted(families):
+            kind, help_text = self._meta.get(name, ('untyped', ''))
+            if help_text:
+                output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(families[name])
+        return '\n'.join(output) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,220 @@
+import functools
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware as DjangoSessionMiddleware
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.utils.functional import SimpleLazyObject
+from django_otp.middleware import OTPMiddleware as DjangoOTPMiddleware
+from .metrics import registry
+from . import sessions
+
+logger = logging.getLogger(__name__)
+
+
+def session_exempt(view):
+    """Mark a view whose response must never save the session (see SessionMiddleware)."""
+    view.session_exempt = True
+    return view
+
+
+class SessionMiddleware(DjangoSessionMiddleware):
+    """
+    Django's SessionMiddleware with two changes: sessions a view read but did
+    not change get their expiry slid at most once per SESSION_REFRESH_INTERVAL
+    (see api.sessions.refresh), and views marked with session_exempt never
+    save the session. session_exempt is used for the endpoints the game
+    server calls on every socket event.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'session_exempt', False):
+            request.session_exempt = True
+
+    def process_response(self, request, response):
+        if getattr(request, 'session_exempt', False):
+            return response
+        session = getattr(request, 'session', None)
+        if (
+            session is not None and session.accessed and not session.modified
+            and settings.SESSION_COOKIE_NAME in request.COOKIES and response.status_code < 500
+        ):
+            sessions.refresh(session)
+        return super().process_response(request, response)
+
+
+_IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+
+
+def sql_shape(sql):
+    """The statement with IN lists collapsed, so lookups differing only in their values compare equal."""
+    return _IN_LIST.sub('(%s, ...)', sql)
+
+
+class RequestStats:
+    """Database execute wrapper collecting the queries of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.shapes = Counter()
+        self.view_finished = None
+        self.render_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.queries += 1
+            self.shapes[sql_shape(sql)] += 1
+
+    def repeated(self, threshold):
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+# The RequestStats of the request being handled. A context variable rather
+# than a wrapper on one thread's connection: under ASGI the ORM runs on
+# executor threads, and sync_to_async carries the context over to them.
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+class QueryMetricsMiddleware:
+    """
+    Records query count, SQL time, render time and response size per view.
+    They are sent back in a Server-Timing header and aggregated into the
+    registry served by /api/metrics/. Statements repeated at least
+    N_PLUS_ONE_THRESHOLD times in one request are logged as N+1 patterns.
+
+    Render time only covers deferred renders (DRF Response); views returning
+    an HttpResponse serialize inside the view.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'N_PLUS_ONE_THRESHOLD', 5)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Connections opened before this module was imported missed the signal
+        install_query_recorder(connection)
+        stats = request.query_stats = RequestStats()
+        started = time.perf_counter()
+        token = _request_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        stats = request.query_stats = RequestStats()
+        started = time.perf_counter()
+        token = _request_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    def finish(self, request, response, stats, duration):
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name else 'unmatched'
+        size = None if response.streaming else len(response.content)
+
+        registry.observe('api_request_duration_seconds', duration, view=view, method=request.method)
+        registry.observe('api_request_sql_seconds', stats.sql_time, view=view, method=request.method)
+        registry.inc('api_requests_total', view=view, method=request.method, status=response.status_code)
+        registry.inc('api_request_queries_total', stats.queries, view=view, method=request.method)
+        registry.inc('api_request_render_seconds_total', stats.render_time, view=view, method=request.method)
+        if size is not None:
+            registry.inc('api_response_bytes_total', size, view=view, method=request.method)
+
+        timings = [
+            f'db;dur={stats.sql_time * 1000:.2f};desc="{stats.queries} queries"',
+            f'render;dur={stats.render_time * 1000:.2f}',
+            f'total;dur={duration * 1000:.2f}',
+        ]
+        repeated = stats.repeated(self.threshold)
+        if repeated:
+            registry.inc('api_n_plus_one_total', view=view, method=request.method)
+            timings.append(f'nplusone;desc="{len(repeated)} repeated statements"')
+            for shape, count in repeated:
+                logger.warning("Possible N+1 in %s %s: %d x %s", request.method, view, count, shape)
+        response['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def process_template_response(self, request, response):
+        stats = getattr(request, 'query_stats', None)
+        if stats is not None:
+            stats.view_finished = time.perf_counter()
+
+            def rendered(response):
+                stats.render_time = time.perf_counter() - stats.view_finished
+
+            response.add_post_render_callback(rendered)
+        return response
+
+
+class OTPMiddleware(DjangoOTPMiddleware):
+    """
+    django_otp's OTPMiddleware, usable in an async middleware chain. The
+    original is sync-only, which under ASGI would push every request
+    through the single thread that runs sync code.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None:
+            request.user = SimpleLazyObject(functools.partial(self._verify_user, request, user))
+        return await self.get_response(request)
+
+
+registry.describe('api_request_duration_seconds', 'histogram', 'Time spent handling the request, middleware included.')
+registry.describe('api_request_sql_seconds', 'histogram', 'Time spent in database queries per request.')
+registry.describe('api_requests_total', 'counter', 'Handled requests.')
+registry.describe('api_request_queries_total', 'counter', 'Database queries run while handling requests.')
+registry.describe('api_request_render_seconds_total', 'counter', 'Time spent rendering deferred responses.')
+registry.describe('api_response_bytes_total', 'counter', 'Bytes of non-streaming response bodies.')
+registry.describe('api_n_plus_one_total', 'counter', 'Requests that repeated one SQL statement N_PLUS_ONE_THRESHOLD times or more.')
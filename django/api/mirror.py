@@ -0,0 +1,272 @@
+"""
+Local mirror of remote avatars (the 42 intra image.link).
+
+register() turns an allowed remote URL into a local path without fetching
+anything. The first request for that path downloads the image once over a
+pooled HTTP session, stores a MIRROR_SIZE WebP square under mirror/ and
+serves it; later requests are served from disk with a long max-age. Every
+MIRROR_REVALIDATE seconds the upstream copy is revalidated with
+If-None-Match/If-Modified-Since, so an unchanged picture costs a 304. When
+the upstream is down a stale copy is served; with no copy at all the client
+is redirected to the remote URL, which is what it got before.
+
+Entries beyond MIRROR_MAX_ENTRIES or MIRROR_MAX_BYTES are evicted least
+recently used first; last_access is only written once per
+MIRROR_TOUCH_INTERVAL so hits stay read-only.
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+from datetime import timedelta
+from io import BytesIO
+from urllib.parse import urlsplit
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Sum
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from . import avatars
+from .metrics import registry
+from .models import RemoteAvatar
+
+logger = logging.getLogger(__name__)
+
+ROOT = 'mirror'
+
+
+class FetchError(Exception):
+    pass
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """One keep-alive session per process; connections to the avatar CDN are reused across requests."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=getattr(settings, 'MIRROR_POOL_SIZE', 10))
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def key_of(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+
+def allowed(url):
+    parts = urlsplit(url)
+    return parts.scheme in ('http', 'https') and parts.hostname in getattr(settings, 'MIRROR_ALLOWED_HOSTS', ())
+
+
+def register(url):
+    """Local path serving the remote avatar, or None when its host is not mirrored."""
+    if not url or not allowed(url):
+        return None
+    key = key_of(url)
+    RemoteAvatar.objects.get_or_create(key=key, defaults={'url': url})
+    return f'/api/avatars/remote/{key}/'
+
+
+def download(entry):
+    """
+    Conditional GET of the entry's URL. Returns the body, or None when the
+    upstream answered 304. Raises FetchError on anything else.
+    """
+    headers = {}
+    if entry.file:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    limit = getattr(settings, 'MIRROR_MAX_DOWNLOAD', 5 * 1024 * 1024)
+    timeout = getattr(settings, 'MIRROR_TIMEOUT', (3, 10))
+
+    try:
+        with session().get(entry.url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                return None
+            if response.status_code != 200:
+                raise FetchError(f'upstream answered {response.status_code}')
+            body = BytesIO()
+            for chunk in response.iter_content(64 * 1024):
+                body.write(chunk)
+                if body.tell() > limit:
+                    raise FetchError('upstream image too large')
+            entry.etag = response.headers.get('ETag', '')[:255]
+            entry.last_modified = response.headers.get('Last-Modified', '')[:64]
+            return body.getvalue()
+    except requests.RequestException as e:
+        raise FetchError(str(e))
+
+
+def store(entry, data):
+    size = getattr(settings, 'MIRROR_SIZE', 256)
+    try:
+        avatars.inspect(data)
+        _, encoded = avatars.encode(avatars.decode(BytesIO(data), size), size)
+    except Exception as e:
+        raise FetchError(f'not a usable image: {e}')
+    name = f'{ROOT}/{entry.key}.{avatars.EXTENSION}'
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    entry.file = default_storage.save(name, ContentFile(encoded))
+    entry.size = len(encoded)
+    entry.fetched_at = timezone.now()
+
+
+# Striped per process: keys hash onto a fixed set of locks, so the set never grows
+LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def _stripe(key):
+    return int(key[:8], 16) % LOCK_STRIPES
+
+
+def _lock_for(key):
+    return _locks[_stripe(key)]
+
+
+def due(entry, now):
+    interval = timedelta(seconds=getattr(settings, 'MIRROR_REVALIDATE', 86400))
+    return entry.checked_at is None or now - entry.checked_at >= interval
+
+
+def refresh(entry):
+    """
+    Fetch or revalidate the entry when it has no copy or its copy is due.
+    Returns the result label for metrics.
+    """
+    now = timezone.now()
+    if entry.file and not due(entry, now):
+        return 'hit'
+
+    # One fetch per entry per process; concurrent requests wait and reuse it
+    with _lock_for(entry.key):
+        entry.refresh_from_db()
+        if entry.file and not due(entry, now):
+            return 'hit'
+        result = fetch(entry)
+        entry.checked_at = now
+        entry.last_access = now
+        entry.save()
+
+    if result == 'fetched':
+        evict()
+    return result
+
+
+def fetch(entry):
+    """
+    Download and store a new copy, or revalidate the current one. Touches
+    no database, so it may run on any thread. Returns the result label.
+    """
+    try:
+        data = download(entry)
+        if data is not None:
+            store(entry, data)
+        return 'revalidated' if data is None else 'fetched'
+    except FetchError as e:
+        logger.warning('Mirroring %s failed: %s', entry.url, e)
+        return 'stale' if entry.file else 'error'
+
+
+_async_locks = weakref.WeakKeyDictionary()
+
+
+def _async_lock_for(key):
+    loop = asyncio.get_running_loop()
+    stripes = _async_locks.get(loop)
+    if stripes is None:
+        stripes = _async_locks[loop] = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+    return stripes[_stripe(key)]
+
+
+async def arefresh(entry):
+    """
+    refresh() for the event loop. The upstream request (up to MIRROR_TIMEOUT)
+    and the re-encode run on a thread of their own instead of the request's
+    sync thread; the database work stays on the latter.
+    """
+    now = timezone.now()
+    if entry.file and not due(entry, now):
+        return 'hit'
+
+    async with _async_lock_for(entry.key):
+        await entry.arefresh_from_db()
+        if entry.file and not due(entry, now):
+            return 'hit'
+        result = await sync_to_async(fetch, thread_sensitive=False)(entry)
+        entry.checked_at = now
+        entry.last_access = now
+        await entry.asave()
+
+    if result == 'fetched':
+        await sync_to_async(evict)()
+    return result
+
+
+def read(entry):
+    """The stored copy's bytes, or None when another worker evicted it meanwhile."""
+    try:
+        with default_storage.open(entry.file, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def touch(entry):
+    now = timezone.now()
+    interval = timedelta(seconds=getattr(settings, 'MIRROR_TOUCH_INTERVAL', 3600))
+    if entry.last_access is None or now - entry.last_access >= interval:
+        RemoteAvatar.objects.filter(key=entry.key).update(last_access=now)
+
+
+def evict():
+    """Drop least recently used copies until the mirror is within its count and byte bounds. Returns how many."""
+    max_entries = getattr(settings, 'MIRROR_MAX_ENTRIES', 10000)
+    max_bytes = getattr(settings, 'MIRROR_MAX_BYTES', 256 * 1024 * 1024)
+    stored = RemoteAvatar.objects.exclude(file='')
+    totals = stored.aggregate(count=Count('key'), total=Sum('size'))
+    count, total = totals['count'], totals['total'] or 0
+    if count <= max_entries and total <= max_bytes:
+        return 0
+
+    # Read the oldest copies only until enough are picked, then write once
+    victims = []
+    rows = stored.order_by('last_access', 'key').values_list('key', 'file', 'size')
+    for key, name, size in rows.iterator(chunk_size=100):
+        if count <= max_entries and total <= max_bytes:
+            break
+        victims.append((key, name))
+        count -= 1
+        total -= size
+
+    for _, name in victims:
+        default_storage.delete(name)
+    # The rows stay registered; the next request fetches them again
+    RemoteAvatar.objects.filter(key__in=[key for key, _ in victims]).update(
+        file='', size=0, etag='', last_modified='', checked_at=None
+    )
+    registry.inc('api_avatar_mirror_evictions_total', len(victims))
+    return len(victims)
+
+
+def etag(entry):
+    """Our validator for clients; changes whenever a new copy is stored."""
+    return f'"{entry.key}-{int(entry.fetched_at.timestamp())}"'
+
+
+registry.describe('api_avatar_mirror_total', 'counter', 'Mirrored avatar requests by result.')
+registry.describe('api_avatar_mirror_evictions_total', 'counter', 'Mirrored avatars evicted to stay within bounds.')
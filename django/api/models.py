@@ -38,6 +38,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(default=True)  # Required by Django
     is_staff = models.BooleanField(default=False)  # Required by Django
     has_2fa = models.BooleanField(default=False)
+    token_version = models.PositiveIntegerField(default=0)  # in every JWT; bumped at logout to revoke them
 
     objects = UserManager()
 
@@ -92,3 +93,138 @@ class Friend(models.Model):
 
     def __str__(self):
         return f"{self.user.username} is friends with {self.friend.username}"
+
+
+class LeaderboardEntry(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="leaderboard")
+    rating = models.IntegerField(default=1000)
+    games_played = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+    goals_scored = models.PositiveIntegerField(default=0)
+    goals_received = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-rating", "user"], name="leaderboard_rank_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.rating}"
+
+
+class UserStatsSummary(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="stats_summary")
+    games_played = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    goals_scored = models.PositiveIntegerField(default=0)
+    goals_received = models.PositiveIntegerField(default=0)
+    current_streak = models.PositiveIntegerField(default=0)
+    best_streak = models.PositiveIntegerField(default=0)
+    tournament_wins = models.PositiveIntegerField(default=0)
+    last_played = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Summary {self.user_id}: {self.wins}/{self.games_played}"
+
+
+class FriendEvent(models.Model):
+    """Presence and friendship changes, read by the friend event streams of every worker."""
+    PRESENCE = "presence"
+    FRIEND_ADDED = "friend_added"
+    FRIEND_REMOVED = "friend_removed"
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=16)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="friend_events")
+    friend = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    status = models.BooleanField(null=True)
+    last_online = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"FriendEvent {self.id}: {self.kind} {self.user_id}"
+
+
+class UsernameSearchEntry(models.Model):
+    """Lowercased username used for indexed prefix search (see api.search)."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="search_entry")
+    name = models.CharField(max_length=255, db_index=True)
+
+    def __str__(self):
+        return self.name
+
+
+class UsernameTrigram(models.Model):
+    """One row per distinct trigram of a lowercased username, for substring search."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="search_trigrams")
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        unique_together = ("gram", "user")
+
+    def __str__(self):
+        return f"{self.gram} -> {self.user_id}"
+
+
+class ArchivedMatch(models.Model):
+    """A Match moved out of the hot table by api.archive; keeps its original id."""
+    id = models.IntegerField(primary_key=True)
+    datetime_start = models.DateTimeField(db_index=True)
+    datetime_end = models.DateTimeField()
+    tournament = models.ForeignKey(Tournament, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    premature_end = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived match {self.id} ({self.datetime_start})"
+
+
+class ArchivedStatistic(models.Model):
+    """A Statistic moved out of the hot table with its match; same field names, so queries carry over."""
+    id = models.IntegerField(primary_key=True)
+    match = models.ForeignKey(ArchivedMatch, on_delete=models.CASCADE, related_name="statistics", related_query_name="statistic")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, related_name="+")
+    goals_scored = models.PositiveSmallIntegerField(default=0)
+    goals_received = models.PositiveSmallIntegerField(default=0)
+    datetime_left = models.DateTimeField()
+    won = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "match"], name="archived_stat_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"Archived statistic {self.id}: Match {self.match_id}, User {self.user_id}"
+
+
+class UserArchiveRollup(models.Model):
+    """Per-user totals over the archived matches, kept in step by api.archive."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="archive_rollup")
+    games_played = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    goals_scored = models.PositiveIntegerField(default=0)
+    goals_received = models.PositiveIntegerField(default=0)
+    first_match = models.DateTimeField(null=True, blank=True)
+    newest_match = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Archive rollup {self.user_id}: {self.wins}/{self.games_played}"
+
+
+class RemoteAvatar(models.Model):
+    """A remote (42 intra) avatar mirrored locally by api.mirror, keyed by a hash of its URL."""
+    key = models.CharField(max_length=64, primary_key=True)
+    url = models.URLField(max_length=1024)
+    file = models.CharField(max_length=255, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    last_access = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.key} -> {self.url}"
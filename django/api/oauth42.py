@@ -0,0 +1,359 @@
+"""
+HTTP client for the 42 intra OAuth flow behind login_with_42_callback.
+
+All calls share one pooled requests.Session per process, so logins reuse
+warm TLS connections, and every call is bounded by OAUTH_TIMEOUT
+(connect, read). Failures are retried at most OAUTH_RETRIES times with
+full-jitter backoff: failures to connect always (nothing reached the
+provider), anything else (timeouts, dropped connections, 429, 5xx) only
+for the idempotent profile GET, because an authorization code is
+single-use.
+
+A circuit breaker counts consecutive provider failures. After
+OAUTH_BREAKER_THRESHOLD of them, calls fail fast with ProviderUnavailable
+for OAUTH_BREAKER_RESET seconds; then one trial call decides whether to
+close it again.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .metrics import registry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class OAuthError(Exception):
+    """The provider refused or returned something unusable; status is what the callback answers with."""
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+class ProviderUnavailable(OAuthError):
+    def __init__(self, message='42 login is temporarily unavailable'):
+        super().__init__(message, 503)
+
+
+class CircuitBreaker:
+    """Closed, open for reset_timeout seconds after threshold consecutive failures, then half-open for one trial."""
+
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """True to go ahead, 'trial' for the one half-open call (which must end with end_trial()), False when open."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return 'trial'
+            return False
+
+    def end_trial(self):
+        """Free the half-open trial when its call ended without success() or failure(), e.g. cancelled."""
+        with self._lock:
+            self.trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning('42 OAuth circuit opened after %d failures', self.failures)
+                self.opened_at = self.clock()
+            self.trial = False
+
+
+_session = None
+_breaker = None
+_lock = threading.Lock()
+
+
+def session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=getattr(settings, 'OAUTH_POOL_SIZE', 10))
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def breaker():
+    global _breaker
+    with _lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                getattr(settings, 'OAUTH_BREAKER_THRESHOLD', 5),
+                getattr(settings, 'OAUTH_BREAKER_RESET', 30),
+            )
+        return _breaker
+
+
+def reset():
+    """Forget the breaker state, e.g. between tests."""
+    global _breaker
+    with _lock:
+        _breaker = None
+
+
+def backoff(attempt):
+    """Full jitter: uniform in [0, base * 2**attempt], capped."""
+    base = getattr(settings, 'OAUTH_BACKOFF', 0.2)
+    return random.uniform(0, min(2.0, base * 2 ** attempt))
+
+
+def never_sent(error):
+    """Whether a connection error happened before the request could reach the provider."""
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+def _begin(endpoint):
+    """(breaker, whether this call is its half-open trial); raises ProviderUnavailable while it is open."""
+    circuit = breaker()
+    allowed = circuit.allow()
+    if not allowed:
+        registry.inc('api_oauth_upstream_total', endpoint=endpoint, outcome='short_circuit')
+        raise ProviderUnavailable()
+    return circuit, allowed == 'trial'
+
+
+def _record(endpoint, started, outcome):
+    registry.observe(
+        'api_oauth_upstream_seconds', time.perf_counter() - started,
+        buckets=LATENCY_BUCKETS, endpoint=endpoint,
+    )
+    registry.inc('api_oauth_upstream_total', endpoint=endpoint, outcome=outcome)
+
+
+def _healthy(response):
+    return response.status_code < 500 and response.status_code != 429
+
+
+def _give_up(circuit, error, response):
+    circuit.failure()
+    if error is not None:
+        raise ProviderUnavailable(f'42 API unreachable: {error.__class__.__name__}')
+    return response
+
+
+def _response_outcome(response, idempotent):
+    return str(response.status_code), idempotent and response.status_code in RETRY_STATUSES
+
+
+def _requests_outcome(error, idempotent):
+    """(metrics outcome, retry) for a requests exception."""
+    if isinstance(error, requests.ConnectionError):
+        outcome = 'timeout' if isinstance(error, requests.ConnectTimeout) else 'connect_error'
+        return outcome, idempotent or never_sent(error)
+    if isinstance(error, requests.Timeout):  # read timeout: the provider may have acted on it
+        return 'timeout', idempotent
+    return 'error', False
+
+
+def call(endpoint, method, path, idempotent, **kwargs):
+    """One provider call with retries, breaker and metrics. Returns the response of the last attempt."""
+    circuit, trial = _begin(endpoint)
+    url = settings.OAUTH2_PROVIDER['BASE_DOMAIN'] + path
+    retries = getattr(settings, 'OAUTH_RETRIES', 2)
+    timeout = getattr(settings, 'OAUTH_TIMEOUT', (3.05, 10))
+    try:
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            response = error = None
+            try:
+                response = session().request(method, url, timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+                outcome, retry = _requests_outcome(e, idempotent)
+            else:
+                outcome, retry = _response_outcome(response, idempotent)
+            _record(endpoint, started, outcome)
+
+            if error is None and _healthy(response):
+                circuit.success()
+                return response
+            if not retry or attempt == retries:
+                break
+            time.sleep(backoff(attempt))
+
+        return _give_up(circuit, error, response)
+    finally:
+        # Anything unexpected must not leave the breaker waiting for this trial forever
+        if trial:
+            circuit.end_trial()
+
+
+def _token_call(code, redirect_uri):
+    return ('token', 'POST', '/oauth/token', False), {'data': {
+        'grant_type': 'authorization_code',
+        'client_id': settings.OAUTH2_PROVIDER['CLIENT_ID'],
+        'client_secret': settings.OAUTH2_PROVIDER['CLIENT_SECRET'],
+        'code': code,
+        'redirect_uri': redirect_uri,
+    }}
+
+
+def _access_token(response):
+    if response.status_code >= 400:
+        raise OAuthError('Failed to obtain access token', response.status_code)
+    try:
+        access_token = response.json().get('access_token')
+    except ValueError:
+        access_token = None
+    if not access_token:
+        raise OAuthError('Missing access token in response', 400)
+    return access_token
+
+
+def _profile_call(access_token):
+    return ('me', 'GET', '/v2/me', True), {'headers': {'Authorization': f'Bearer {access_token}'}}
+
+
+def _profile(response):
+    if response.status_code >= 400:
+        raise OAuthError('Failed to fetch user information', response.status_code)
+    try:
+        return response.json()
+    except ValueError:
+        raise OAuthError('Failed to fetch user information')
+
+
+def exchange_code(code, redirect_uri):
+    """The access token for an authorization code."""
+    args, kwargs = _token_call(code, redirect_uri)
+    return _access_token(call(*args, **kwargs))
+
+
+def fetch_profile(access_token):
+    """The /v2/me document of the token's owner."""
+    args, kwargs = _profile_call(access_token)
+    return _profile(call(*args, **kwargs))
+
+
+# The async views (see backend/asgi.py) use an httpx.AsyncClient per event
+# loop with the same timeouts, retry rules and circuit breaker. Without
+# httpx they run the sync client on a worker thread instead.
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        connect, read = getattr(settings, 'OAUTH_TIMEOUT', (3.05, 10))
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=getattr(settings, 'OAUTH_POOL_SIZE', 10)),
+        )
+    return client
+
+
+def _httpx_outcome(error, idempotent):
+    """(metrics outcome, retry) for an httpx exception."""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):  # nothing was sent
+        return ('connect_error' if isinstance(error, httpx.ConnectError) else 'timeout'), True
+    if isinstance(error, httpx.TimeoutException):
+        return 'timeout', idempotent
+    if isinstance(error, httpx.TransportError):
+        return 'connect_error', idempotent
+    return 'error', False
+
+
+async def acall(endpoint, method, path, idempotent, **kwargs):
+    """call() for the event loop."""
+    circuit, trial = _begin(endpoint)
+    url = settings.OAUTH2_PROVIDER['BASE_DOMAIN'] + path
+    retries = getattr(settings, 'OAUTH_RETRIES', 2)
+    try:
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            response = error = None
+            try:
+                response = await async_client().request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+                outcome, retry = _httpx_outcome(e, idempotent)
+            else:
+                outcome, retry = _response_outcome(response, idempotent)
+            _record(endpoint, started, outcome)
+
+            if error is None and _healthy(response):
+                circuit.success()
+                return response
+            if not retry or attempt == retries:
+                break
+            await asyncio.sleep(backoff(attempt))
+
+        return _give_up(circuit, error, response)
+    finally:
+        # Cancellation (client gone) or e.g. httpx.InvalidURL: free the trial, see call()
+        if trial:
+            circuit.end_trial()
+
+
+async def aexchange_code(code, redirect_uri):
+    if httpx is None:
+        return await sync_to_async(exchange_code, thread_sensitive=False)(code, redirect_uri)
+    args, kwargs = _token_call(code, redirect_uri)
+    return _access_token(await acall(*args, **kwargs))
+
+
+async def afetch_profile(access_token):
+    if httpx is None:
+        return await sync_to_async(fetch_profile, thread_sensitive=False)(access_token)
+    args, kwargs = _profile_call(access_token)
+    return _profile(await acall(*args, **kwargs))
+
+
+registry.describe('api_oauth_upstream_seconds', 'histogram', 'Latency of single 42 API attempts.')
+registry.describe('api_oauth_upstream_total', 'counter', '42 API attempts by outcome (HTTP status, timeout, connect_error, short_circuit).')
+
+
+@registry.collector
+def _breaker_metrics():
+    state = breaker().state if _breaker is not None else 'closed'
+    return [('api_oauth_circuit_open', 'gauge', '1 while the 42 OAuth circuit breaker fails fast.', [({}, int(state == 'open'))])]
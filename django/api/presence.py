@@ -0,0 +1,112 @@
+import threading
+from django.db.models import Case, When, Value, BooleanField, DateTimeField
+from .models import User
+from . import events
+from .metrics import registry
+
+UPDATE_BATCH_SIZE = 500
+
+
+class PresenceMetrics:
+    def __init__(self):
+        self.batches = 0
+        self.received = 0
+        self.coalesced = 0
+        self.rows_written = 0
+        self._lock = threading.Lock()
+
+    def record(self, received, coalesced, rows_written):
+        with self._lock:
+            self.batches += 1
+            self.received += received
+            self.coalesced += coalesced
+            self.rows_written += rows_written
+
+    def as_dict(self):
+        return {
+            'batches': self.batches,
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'rowsWritten': self.rows_written,
+        }
+
+
+metrics = PresenceMetrics()
+
+
+@registry.collector
+def _presence_metrics():
+    return [
+        ('api_presence_batches_total', 'counter', 'Presence batches applied.', [({}, metrics.batches)]),
+        ('api_presence_transitions_total', 'counter', 'Presence transitions received.', [({}, metrics.received)]),
+        ('api_presence_coalesced_total', 'counter', 'Presence transitions dropped by coalescing, superseded by a newer one for the same user.', [({}, metrics.coalesced)]),
+        ('api_presence_rows_written_total', 'counter', 'User rows updated by presence batches.', [({}, metrics.rows_written)]),
+    ]
+
+
+def coalesce(transitions):
+    """
+    Keep only the newest transition per user; a connect/disconnect flap inside
+    one batch window collapses into its final state.
+    Returns a user_id -> (online, timestamp) dict.
+    """
+    latest = {}
+    for transition in transitions:
+        user_id = transition['userId']
+        current = latest.get(user_id)
+        if current is None or transition['timestamp'] >= current[1]:
+            latest[user_id] = (transition['online'], transition['timestamp'])
+    return latest
+
+
+def _batches(states):
+    """(user ids, UPDATE of their presence columns) per UPDATE_BATCH_SIZE users."""
+    user_ids = list(states)
+    for start in range(0, len(user_ids), UPDATE_BATCH_SIZE):
+        batch = user_ids[start:start + UPDATE_BATCH_SIZE]
+        yield batch, {
+            'status': Case(
+                *[When(id=user_id, then=Value(states[user_id][0])) for user_id in batch],
+                output_field=BooleanField(),
+            ),
+            'last_online': Case(
+                *[When(id=user_id, then=Value(states[user_id][1])) for user_id in batch],
+                output_field=DateTimeField(),
+            ),
+        }
+
+
+def apply(states):
+    """
+    Write the states with one UPDATE per batch touching only status and
+    last_online, and publish them to the friend event streams. Ids of
+    users that no longer exist are dropped first; their events would fail
+    the foreign key after the UPDATE has gone through.
+    """
+    known = set(User.objects.filter(id__in=list(states)).values_list('id', flat=True))
+    states = {user_id: state for user_id, state in states.items() if user_id in known}
+    if not states:
+        return 0
+    written = 0
+    for batch, columns in _batches(states):
+        written += User.objects.filter(id__in=batch).update(**columns)
+    events.publish_presence(states)
+    return written
+
+
+async def aapply(states):
+    """apply() on the async ORM, for the async views."""
+    written = 0
+    for batch, columns in _batches(states):
+        written += await User.objects.filter(id__in=batch).aupdate(**columns)
+    await events.apublish_presence(states)
+    return written
+
+
+def record_transitions(transitions):
+    """Coalesce and apply a batch of validated transitions. Returns the per-batch counters."""
+    states = coalesce(transitions)
+    written = apply(states) if states else 0
+    coalesced = len(transitions) - len(states)
+    metrics.record(len(transitions), coalesced, written)
+    return {'received': len(transitions), 'coalesced': coalesced, 'rowsWritten': written}
@@ -0,0 +1,168 @@
+"""
+Sampled cProfile runs of live API requests.
+
+With PROFILE_ENABLED a request is profiled when its URL name wins the
+PROFILE_SAMPLE_RATES draw or when it carries an X-Profile-Token header
+signed for that URL name (see sign() and `manage.py profile_report --sign`).
+Dumps are written to PROFILE_DIR/<url name>/ and only the newest
+PROFILE_KEEP of each endpoint are kept. Summarizing them is left to
+`manage.py profile_report`, which also refreshes each endpoint's
+summary.txt, so sampled requests only pay for the dump.
+
+cProfile follows one thread. Under ASGI the profile is taken on the event
+loop: async views are covered whole, sync views only up to the hand-off to
+their sync thread, and other requests' coroutines running meanwhile show
+up too. One request per thread is profiled at a time.
+"""
+
+import contextlib
+import cProfile
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from pathlib import Path
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, get_resolver
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'HTTP_X_PROFILE_TOKEN'
+SALT = 'api.profiling'
+ANY_VIEW = '*'
+
+_sequence = itertools.count()
+
+
+def directory():
+    return Path(getattr(settings, 'PROFILE_DIR', Path(settings.BASE_DIR) / 'profiles'))
+
+
+def sign(url_name=ANY_VIEW):
+    """A header value that profiles requests to url_name ('*' for any) for PROFILE_TOKEN_MAX_AGE seconds."""
+    return signing.TimestampSigner(salt=SALT).sign(url_name)
+
+
+def token_allows(token, url_name):
+    try:
+        signed_for = signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILE_TOKEN_MAX_AGE', 300)
+        )
+    except signing.BadSignature:
+        return False
+    return signed_for in (url_name, ANY_VIEW)
+
+
+def dumps(url_name=None):
+    """Profile dumps on disk, oldest first, for one endpoint or all of them."""
+    root = directory()
+    pattern = f"{url_name}/*.prof" if url_name else '*/*.prof'
+    return sorted(root.glob(pattern), key=lambda path: path.name)
+
+
+def summarize(paths, sort='cumulative', limit=30):
+    stream = io.StringIO()
+    stats = pstats.Stats(*[str(path) for path in paths], stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def save(profiler, url_name):
+    """Write one dump and drop the oldest ones past PROFILE_KEEP."""
+    endpoint = directory() / url_name
+    endpoint.mkdir(parents=True, exist_ok=True)
+    # Names sort chronologically: microsecond timestamp, then pid and a counter
+    path = endpoint / f"{time.time_ns() // 1000}-{os.getpid()}-{next(_sequence)}.prof"
+    profiler.dump_stats(path)
+
+    kept = dumps(url_name)
+    for old in kept[:-getattr(settings, 'PROFILE_KEEP', 50)]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+def write_summaries(url_name=None, sort='cumulative', limit=30):
+    """Rewrite summary.txt of every endpoint with dumps, or of one. Returns the endpoints."""
+    endpoints = sorted({path.parent.name for path in dumps(url_name)})
+    for endpoint in endpoints:
+        (directory() / endpoint / 'summary.txt').write_text(summarize(dumps(endpoint), sort, limit))
+    return endpoints
+
+
+_active = threading.local()
+
+
+class ProfilingMiddleware:
+    """Profiles the rest of the middleware chain, the view and the render of sampled requests."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILE_ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.rates = getattr(settings, 'PROFILE_SAMPLE_RATES', {})
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        url_name = self.sampled(request)
+        if url_name is None:
+            return self.get_response(request)
+        with self.profiling() as profiler:
+            response = self.get_response(request)
+        self.save(profiler, url_name)
+        return response
+
+    async def __acall__(self, request):
+        url_name = self.sampled(request)
+        if url_name is None:
+            return await self.get_response(request)
+        with self.profiling() as profiler:
+            response = await self.get_response(request)
+        await sync_to_async(self.save, thread_sensitive=False)(profiler, url_name)
+        return response
+
+    def sampled(self, request):
+        """The URL name of a request picked for profiling, else None."""
+        token = request.META.get(HEADER)
+        if (not self.rates and not token) or getattr(_active, 'profiling', False):
+            return None
+        try:
+            url_name = get_resolver(getattr(request, 'urlconf', None)).resolve(request.path_info).url_name
+        except Resolver404:
+            return None
+        if not url_name:
+            return None
+        rate = self.rates.get(url_name, self.rates.get(ANY_VIEW, 0))
+        if (rate and random.random() < rate) or (token and token_allows(token, url_name)):
+            return url_name
+        return None
+
+    @contextlib.contextmanager
+    def profiling(self):
+        profiler = cProfile.Profile()
+        _active.profiling = True
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            _active.profiling = False
+
+    @staticmethod
+    def save(profiler, url_name):
+        try:
+            save(profiler, url_name)
+        except OSError:
+            logger.exception("Could not write the profile of %s", url_name)
@@ -0,0 +1,106 @@
+"""
+QR codes of TOTP provisioning URIs (device.config_url) for setup_2fa.
+
+Encoding a URI, mostly picking the mask, and drawing it take tens of
+milliseconds, and the 2FA page asks again on every visit and retry. Renders
+are kept per worker in an LRU keyed by the SHA-256 of the URI and the
+format, so an unchanged device is encoded once. Entries remember the device
+they were made for and are dropped when it is deleted or gets a new key
+(see signals.py); a renamed user simply gets a new URI and thus a new key.
+
+Two formats, both returned as data URIs:
+
+  png  what setup_2fa always returned, drawn by Pillow.
+  svg  one horizontal stroke per run of dark modules in a row. No Pillow,
+       about 3KB of text (under 1KB gzipped) and sharp at any size.
+"""
+
+import base64
+import hashlib
+import io
+import time
+from itertools import groupby
+from urllib.parse import quote
+import qrcode
+from django.conf import settings
+from .cache import LRUCache
+from .metrics import registry
+
+FORMATS = ('png', 'svg')
+
+qr_cache = LRUCache(maxsize=getattr(settings, 'QR_CACHE_SIZE', 1024))
+
+
+def digest_of(config_url):
+    return hashlib.sha256(config_url.encode()).hexdigest()
+
+
+def encode(config_url):
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(config_url)
+    qr.make(fit=True)
+    return qr
+
+
+def png(qr):
+    buffer = io.BytesIO()
+    qr.make_image(fill="black", back_color="white").save(buffer, format="PNG")
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def svg(qr):
+    rows = qr.get_matrix()  # quiet zone included
+    size = len(rows)
+    path = []
+    for y, row in enumerate(rows):
+        x, end = 0, None
+        for dark, run in groupby(row):
+            length = sum(1 for _ in run)
+            if dark:
+                # Strokes run along the middle of the row; moves are relative to the previous run's end
+                path.append(f'M{x} {y}.5h{length}' if end is None else f'm{x - end} 0h{length}')
+                end = x + length
+            x += length
+    markup = (
+        f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 {size} {size}' shape-rendering='crispEdges'>"
+        f"<path fill='white' d='M0 0h{size}v{size}H0z'/><path stroke='black' d='{''.join(path)}'/></svg>"
+    )
+    return 'data:image/svg+xml,' + quote(markup, safe=" /:='.")
+
+
+RENDERERS = {'png': png, 'svg': svg}
+
+
+def render(config_url, fmt='png', device=None):
+    """Data URI of config_url's QR code in fmt, cached. Entries for a device can be dropped with forget()."""
+    key = (digest_of(config_url), fmt)
+    cached = qr_cache.get(key)
+    if cached is not None:
+        return cached[1]
+
+    started = time.perf_counter()
+    uri = RENDERERS[fmt](encode(config_url))
+    registry.observe('api_qr_render_seconds', time.perf_counter() - started, format=fmt)
+    owner = (device.pk, device.key) if device is not None else None
+    qr_cache.set(key, (owner, uri))
+    return uri
+
+
+def forget(device_id, keep_key=None):
+    """Drop the device's renders, except those of its current key. Returns how many were dropped."""
+    return qr_cache.delete_where(
+        lambda value: value[0] is not None and value[0][0] == device_id and value[0][1] != keep_key
+    )
+
+
+registry.describe('api_qr_render_seconds', 'histogram', 'Time to encode and draw one 2FA QR code, cache misses only.')
+
+
+@registry.collector
+def _qr_cache_metrics():
+    stats = qr_cache.stats()
+    return [
+        ('api_qr_cache_size', 'gauge', 'Rendered 2FA QR codes held by this worker.', [({}, stats['size'])]),
+        ('api_qr_cache_hits_total', 'counter', 'QR cache hits.', [({}, stats['hits'])]),
+        ('api_qr_cache_misses_total', 'counter', 'QR cache misses.', [({}, stats['misses'])]),
+    ]
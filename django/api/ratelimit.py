@@ -0,0 +1,188 @@
+"""
+Token buckets shared by every worker on the host.
+
+The buckets live in a small SQLite file (RATE_LIMIT_DB) next to the app, so
+all gunicorn workers see the same counts; each check is a single UPSERT on
+the bucket's primary key, which SQLite applies atomically. The DRF throttle
+classes at the bottom plug the buckets into views with @throttle_classes.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# Buckets untouched for this long are full again and can be dropped
+PRUNE_AFTER = 86400
+PRUNE_EVERY = 1000
+
+_CONSUME = """
+INSERT INTO buckets (key, tokens, updated, allowed) VALUES (:key, :capacity - 1, :now, 1)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = min(:capacity, tokens + (:now - updated) * :rate)
+        - (min(:capacity, tokens + (:now - updated) * :rate) >= 1),
+    updated = :now,
+    allowed = min(:capacity, tokens + (:now - updated) * :rate) >= 1
+RETURNING tokens, allowed
+"""
+
+
+def parse_rate(rate):
+    """'10/min' -> (capacity 10, refill of 10 tokens per 60 seconds as tokens/second)."""
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period]
+
+
+class BucketStore:
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._local = threading.local()
+        self._calls = 0
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, allowed INTEGER NOT NULL)'
+            )
+            self._local.connection = connection
+        return connection
+
+    def consume(self, key, rate):
+        """
+        Take one token from the bucket. Returns (allowed, seconds until a
+        token is available again).
+        """
+        capacity, refill = parse_rate(rate)
+        now = self.clock()
+        tokens, allowed = self.connection().execute(
+            _CONSUME, {'key': key, 'capacity': capacity, 'rate': refill, 'now': now}
+        ).fetchone()
+
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            self.connection().execute('DELETE FROM buckets WHERE updated < ?', (now - PRUNE_AFTER,))
+
+        if allowed:
+            return True, 0
+        return False, (1 - tokens) / refill
+
+    def reset(self):
+        self.connection().execute('DELETE FROM buckets')
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store():
+    path = str(getattr(settings, 'RATE_LIMIT_DB', 'ratelimit.sqlite3'))
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = BucketStore(path)
+        return _stores[path]
+
+
+def check(scope, keys):
+    """
+    Consume a token from the bucket of every (kind, value) key of the scope,
+    rated by RATE_LIMITS[f'{scope}_{kind}']. Returns (allowed, retry_after).
+    The limiter fails open when the bucket file cannot be used.
+    """
+    started = time.perf_counter()
+    allowed, wait = True, 0
+    try:
+        buckets = store()
+        for kind, value in keys:
+            rate = settings.RATE_LIMITS.get(f"{scope}_{kind}")
+            if rate is None or value in (None, ''):
+                continue
+            key_allowed, key_wait = buckets.consume(f"{scope}:{kind}:{value}", rate)
+            if not key_allowed:
+                allowed, wait = False, max(wait, key_wait)
+                registry.inc('api_rate_limit_rejections_total', scope=scope, key=kind)
+    except sqlite3.Error:
+        logger.exception("Rate limit store unavailable, letting %s through", scope)
+
+    registry.inc('api_rate_limit_checks_total', scope=scope, result='allowed' if allowed else 'rejected')
+    registry.observe('api_rate_limit_seconds', time.perf_counter() - started, buckets=LATENCY_BUCKETS, scope=scope)
+    return allowed, wait
+
+
+registry.describe('api_rate_limit_checks_total', 'counter', 'Requests checked against a rate limit scope.')
+registry.describe('api_rate_limit_rejections_total', 'counter', 'Rejections per scope and key kind (ip, user).')
+registry.describe('api_rate_limit_seconds', 'histogram', 'Time spent checking the rate limit buckets.')
+
+
+class BucketThrottle(BaseThrottle):
+    """
+    Throttle a view on an IP bucket and, where the request names one, a
+    user bucket. Subclasses set scope and may restrict methods.
+    """
+    scope = None
+    methods = None
+
+    def user_key(self, request):
+        return None
+
+    def allow_request(self, request, view):
+        if not getattr(settings, 'RATE_LIMIT_ENABLED', True):
+            return True
+        if self.methods is not None and request.method not in self.methods:
+            return True
+        keys = [('ip', self.get_ident(request)), ('user', self.user_key(request))]
+        allowed, self.retry_after = check(self.scope, keys)
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+def _data_username(request):
+    try:
+        username = request.data.get('username')
+    except Exception:  # unparsable body, the view reports it
+        return None
+    return username.strip().lower() if isinstance(username, str) else None
+
+
+class LoginThrottle(BucketThrottle):
+    scope = 'login'
+
+    def user_key(self, request):
+        return _data_username(request)
+
+
+class TwoFactorThrottle(BucketThrottle):
+    scope = '2fa'
+
+    def user_key(self, request):
+        return _data_username(request)
+
+
+class SearchThrottle(BucketThrottle):
+    scope = 'search'
+
+    def user_key(self, request):
+        # The authenticated user, not the session: a JWT works without one
+        user = getattr(request, 'user', None)
+        return user.pk if user is not None and user.is_authenticated else None
+
+
+class SignupThrottle(BucketThrottle):
+    scope = 'signup'
+    methods = ('POST',)
@@ -0,0 +1,127 @@
+import base64
+import json
+from django.db import transaction
+from django.db.models import Count, Q
+from .models import Friend, UsernameSearchEntry, UsernameTrigram
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+
+PREFIX = 0
+SUBSTRING = 1
+
+
+def trigrams(name):
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def index_users(users):
+    """(Re)build the search rows of the given users with a fixed number of queries."""
+    users = list(users)
+    user_ids = [user.id for user in users]
+    with transaction.atomic():
+        UsernameSearchEntry.objects.filter(user_id__in=user_ids).delete()
+        UsernameTrigram.objects.filter(user_id__in=user_ids).delete()
+        UsernameSearchEntry.objects.bulk_create(
+            [UsernameSearchEntry(user_id=user.id, name=user.username.lower()) for user in users]
+        )
+        UsernameTrigram.objects.bulk_create([
+            UsernameTrigram(user_id=user.id, gram=gram)
+            for user in users for gram in trigrams(user.username.lower())
+        ])
+
+
+def rebuild(users, chunk_size=2000):
+    """Rebuild the whole index from a User queryset. Returns the number of users indexed."""
+    with transaction.atomic():
+        UsernameSearchEntry.objects.all().delete()
+        UsernameTrigram.objects.all().delete()
+
+    count = 0
+    batch = []
+    for user in users.only('id', 'username').iterator(chunk_size=chunk_size):
+        batch.append(user)
+        if len(batch) == chunk_size:
+            index_users(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        index_users(batch)
+        count += len(batch)
+    return count
+
+
+def encode_cursor(tier, name, user_id):
+    raw = json.dumps([tier, name, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """Returns (tier, name, user_id); raises ValueError on anything malformed."""
+    try:
+        tier, name, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if tier not in (PREFIX, SUBSTRING) or not isinstance(name, str) or not isinstance(user_id, int):
+        raise ValueError("Invalid cursor")
+    return tier, name, user_id
+
+
+def _candidates(user, query):
+    # Exclusion of the caller and their friends happens inside the same statement
+    return (
+        UsernameSearchEntry.objects
+        .exclude(user_id=user.id)
+        .exclude(user_id__in=Friend.objects.filter(user=user).values('friend_id'))
+        .order_by('name', 'user_id')
+        .values_list('user_id', 'user__username', 'name')
+    )
+
+
+def _after(queryset, name, user_id):
+    return queryset.filter(Q(name__gt=name) | Q(name=name, user_id__gt=user_id))
+
+
+def search(user, query, limit=DEFAULT_LIMIT, cursor=None):
+    """
+    Rank users whose name starts with the query first, then users that only
+    contain it; each tier is ordered by name. Substring matches of three or
+    more characters are narrowed through the trigram table before the
+    contains check. Returns (results, next_cursor).
+    """
+    query = query.lower()
+    tier, name, user_id = decode_cursor(cursor) if cursor else (PREFIX, None, None)
+
+    rows = []
+    if tier == PREFIX:
+        prefix = _candidates(user, query).filter(name__startswith=query)
+        if name is not None:
+            prefix = _after(prefix, name, user_id)
+        rows = [(PREFIX, row) for row in prefix[:limit + 1]]
+        name = user_id = None
+
+    if len(rows) <= limit:
+        substring = _candidates(user, query).filter(name__contains=query).exclude(name__startswith=query)
+        grams = trigrams(query)
+        if grams:
+            matching = (
+                UsernameTrigram.objects
+                .filter(gram__in=grams)
+                .values('user_id')
+                .annotate(hits=Count('gram'))
+                .filter(hits=len(grams))
+                .values('user_id')
+            )
+            substring = substring.filter(user_id__in=matching)
+        if name is not None:
+            substring = _after(substring, name, user_id)
+        rows += [(SUBSTRING, row) for row in substring[:limit + 1 - len(rows)]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        tier, (last_id, _, last_name) = rows[-1]
+        next_cursor = encode_cursor(tier, last_name, last_id)
+
+    results = [{'id': row_id, 'username': username} for _, (row_id, username, _) in rows]
+    return results, next_cursor
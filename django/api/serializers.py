@@ -78,4 +78,9 @@ class FriendSerializer(serializers.ModelSerializer):
             "username": obj.friend.username,
             "status": obj.friend.status,
             "last_online": obj.friend.last_online,
-        }
\ No newline at end of file
+        }
+
+class PresenceTransitionSerializer(serializers.Serializer):
+    userId = serializers.IntegerField(min_value=1)
+    online = serializers.BooleanField()
+    timestamp = serializers.DateTimeField()
@@ -0,0 +1,65 @@
+"""
+Session helpers and the signed-cookie session engine.
+
+SESSION_MODE in settings picks the engine: 'db' (the old behaviour),
+'cache' (Django's cached_db: reads from the session cache, writes through
+to the database) or 'signed' (this module: the whole session, in practice
+just user_data, lives in a signed cookie). In every mode a session is only
+written when a view changes it; api.middleware.SessionMiddleware refreshes
+the expiry at most once per SESSION_REFRESH_INTERVAL instead of the save
+SESSION_SAVE_EVERY_REQUEST used to force on every hit.
+"""
+
+import time
+from django.conf import settings
+from django.contrib.sessions.backends import db, signed_cookies
+from django.core import signing
+
+REFRESHED_KEY = '_refreshed'
+
+
+def refresh(session, clock=time.time):
+    """
+    Slide the expiry of a loaded, non-empty session when the last refresh is
+    older than SESSION_REFRESH_INTERVAL. Marks it modified so the session
+    middleware saves it and reissues the cookie. Returns whether it did.
+    """
+    if not session.keys():
+        return False
+    now = int(clock())
+    if now - session.get(REFRESHED_KEY, 0) < getattr(settings, 'SESSION_REFRESH_INTERVAL', 300):
+        return False
+    session[REFRESHED_KEY] = now
+    return True
+
+
+class SessionStore(signed_cookies.SessionStore):
+    """
+    Signed-cookie sessions that still accept a database session key, so
+    switching SESSION_MODE to 'signed' keeps users logged in: the stored
+    session is loaded once and reissued as a signed cookie.
+    Unlike database sessions, a copied cookie stays valid until it expires
+    even after logout.
+    """
+
+    def load(self):
+        try:
+            return signing.loads(
+                self.session_key,
+                serializer=self.serializer,
+                max_age=self.get_session_cookie_age(),
+                salt='django.contrib.sessions.backends.signed_cookies',
+            )
+        except Exception:
+            pass
+
+        if self.session_key:
+            legacy = db.SessionStore(self.session_key)
+            data = legacy.load()
+            if data:
+                legacy.delete(self.session_key)
+                self.modified = True
+                return data
+
+        self.create()
+        return {}
@@ -0,0 +1,47 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from rest_framework.authtoken.models import Token
+from .authentication import invalidate_token, user_cache
+from .models import User
+from . import qr, search
+
+
+@receiver(post_delete, sender=Token)
+def drop_cached_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_init, sender=User)
+def remember_indexed_username(sender, instance, **kwargs):
+    # __dict__ so deferred usernames are not loaded just for this
+    instance._indexed_username = instance.__dict__.get('username')
+
+
+@receiver(post_save, sender=User)
+def index_username(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    username = instance.__dict__.get('username')
+    if username is None or (not created and username == instance._indexed_username):
+        return
+    search.index_users([instance])
+    instance._indexed_username = username
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    user_cache.delete(instance.pk)
+
+
+@receiver(post_save, sender=TOTPDevice)
+def drop_replaced_qr_codes(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'key' not in update_fields:
+        return
+    qr.forget(instance.pk, keep_key=instance.key)
+
+
+@receiver(post_delete, sender=TOTPDevice)
+def drop_qr_codes(sender, instance, **kwargs):
+    qr.forget(instance.pk)
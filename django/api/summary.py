@@ -0,0 +1,211 @@
+from itertools import groupby
+from django.db import transaction
+from . import archive
+from .models import ArchivedMatch, ArchivedStatistic, Match, Statistic, UserStatsSummary
+
+SUMMARY_FIELDS = [
+    'games_played', 'wins', 'goals_scored', 'goals_received',
+    'current_streak', 'best_streak', 'tournament_wins', 'last_played',
+]
+
+
+def new_summary(user_id):
+    return UserStatsSummary(
+        user_id=user_id, games_played=0, wins=0, goals_scored=0, goals_received=0,
+        current_streak=0, best_streak=0, tournament_wins=0, last_played=None,
+    )
+
+
+def apply_match(summaries, scores, ended, is_final):
+    """
+    Fold one match into the summaries (a user_id -> UserStatsSummary dict).
+
+    scores is a list of (user_id, goals_scored, goals_received, won); matches
+    must be applied in start order for the streaks to be right. Winning the
+    last match of a tournament counts as a tournament win.
+    """
+    for user_id, scored, received, won in scores:
+        summary = summaries[user_id]
+        summary.games_played += 1
+        summary.goals_scored += scored
+        summary.goals_received += received
+        if won:
+            summary.wins += 1
+            summary.current_streak += 1
+            summary.best_streak = max(summary.best_streak, summary.current_streak)
+            if is_final:
+                summary.tournament_wins += 1
+        else:
+            summary.current_streak = 0
+        if summary.last_played is None or ended > summary.last_played:
+            summary.last_played = ended
+
+
+def stored_finals(tournament_ids, new_match_ids):
+    """
+    The last match stored before this payload of each tournament, hot or
+    archived, as tournament_id -> (datetime_start, match_id).
+    """
+    finals = {}
+    if not tournament_ids:
+        return finals
+    for model in (ArchivedMatch, Match):
+        matches = (
+            model.objects
+            .filter(tournament_id__in=tournament_ids)
+            .exclude(id__in=new_match_ids)
+            .values_list('tournament_id', 'datetime_start', 'id')
+        )
+        for tournament_id, started, match_id in matches:
+            if tournament_id not in finals or (started, match_id) > finals[tournament_id]:
+                finals[tournament_id] = (started, match_id)
+    return finals
+
+
+def final_winners(match_ids):
+    """User ids of the winners of each match, hot or archived, as a list with one entry per win."""
+    if not match_ids:
+        return []
+    winners = []
+    for model in (ArchivedStatistic, Statistic):
+        winners += model.objects.filter(
+            match_id__in=match_ids, won=True, user__isnull=False
+        ).values_list('user_id', flat=True)
+    return winners
+
+
+def record_statistics(statistics, stored_tournaments=None):
+    """
+    Update the summaries for freshly ingested Statistic instances with a
+    fixed number of queries. Must be called inside the ingest transaction.
+    stored_tournaments are the ids of the tournaments that existed before
+    this payload, None when unknown.
+    """
+    if not statistics:
+        return
+
+    # A payload may add matches to a stored tournament, so its final is the
+    # last match of the payload and the stored matches together. A stored
+    # final it moves past no longer counts as a tournament win.
+    payload_finals = {}
+    for stat in statistics:
+        match = stat.match
+        if match.tournament_id is not None:
+            current = payload_finals.get(match.tournament_id)
+            if current is None or (match.datetime_start, match.id) > current:
+                payload_finals[match.tournament_id] = (match.datetime_start, match.id)
+    referenced = set(payload_finals) if stored_tournaments is None else set(payload_finals) & set(stored_tournaments)
+    previous = stored_finals(referenced, {stat.match_id for stat in statistics})
+    final_ids = set()
+    replaced_ids = set()
+    for tournament_id, final in payload_finals.items():
+        stored = previous.get(tournament_id)
+        if stored is None or final > stored:
+            final_ids.add(final[1])
+            if stored is not None:
+                replaced_ids.add(stored[1])
+    dethroned = final_winners(replaced_ids)
+
+    user_ids = {stat.user_id for stat in statistics} | set(dethroned)
+
+    UserStatsSummary.objects.bulk_create(
+        [new_summary(user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+    summaries = {
+        summary.user_id: summary
+        for summary in UserStatsSummary.objects.select_for_update().filter(user_id__in=user_ids)
+    }
+
+    for user_id in dethroned:
+        summary = summaries[user_id]
+        summary.tournament_wins = max(0, summary.tournament_wins - 1)
+
+    ordered = sorted(statistics, key=lambda stat: (stat.match.datetime_start, stat.match_id))
+    for match_id, match_stats in groupby(ordered, key=lambda stat: stat.match_id):
+        match_stats = list(match_stats)
+        apply_match(summaries, [
+            (stat.user_id, stat.goals_scored, stat.goals_received, stat.won)
+            for stat in match_stats
+        ], match_stats[0].match.datetime_end, match_id in final_ids)
+
+    UserStatsSummary.objects.bulk_update(summaries.values(), SUMMARY_FIELDS)
+
+
+def final_match_ids():
+    """
+    Id of the last match of every tournament. Both tables are compared, so
+    a tournament split between them by older data still has one final.
+    """
+    finals = {}
+    for model in (ArchivedMatch, Match):
+        matches = (
+            model.objects
+            .filter(tournament__isnull=False)
+            .values_list('tournament_id', 'datetime_start', 'id')
+            .iterator()
+        )
+        for tournament_id, started, match_id in matches:
+            if tournament_id not in finals or (started, match_id) > finals[tournament_id]:
+                finals[tournament_id] = (started, match_id)
+    return {match_id for _, match_id in finals.values()}
+
+
+def compute(chunk_size=2000):
+    """Recompute every summary in memory from the raw statistics, hot and archived."""
+    final_ids = final_match_ids()
+    rows = archive.replay_rows(
+        ('match_id', 'match__datetime_end', 'user_id', 'goals_scored', 'goals_received', 'won'), chunk_size
+    )
+
+    summaries = {}
+    for match_id, match_rows in groupby(rows, key=lambda row: row[0]):
+        match_rows = list(match_rows)
+        scores = [row[2:] for row in match_rows]
+        for user_id, *_ in scores:
+            if user_id not in summaries:
+                summaries[user_id] = new_summary(user_id)
+        apply_match(summaries, scores, match_rows[0][1], match_id in final_ids)
+
+    return summaries
+
+
+def rebuild(chunk_size=2000):
+    """Replace all summaries with a recomputation. Returns the number of summaries."""
+    summaries = compute(chunk_size)
+    with transaction.atomic():
+        UserStatsSummary.objects.all().delete()
+        UserStatsSummary.objects.bulk_create(summaries.values(), batch_size=chunk_size)
+    return len(summaries)
+
+
+def check(chunk_size=2000):
+    """
+    Compare the stored summaries with the raw rows.
+    Returns a list of (user_id, field, stored, expected) mismatches.
+    """
+    expected = compute(chunk_size)
+    stored = {summary.user_id: summary for summary in UserStatsSummary.objects.iterator(chunk_size=chunk_size)}
+
+    mismatches = []
+    for user_id in sorted(set(expected) | set(stored)):
+        want = expected.get(user_id) or new_summary(user_id)
+        have = stored.get(user_id) or new_summary(user_id)
+        for field in SUMMARY_FIELDS:
+            if getattr(have, field) != getattr(want, field):
+                mismatches.append((user_id, field, getattr(have, field), getattr(want, field)))
+    return mismatches
+
+
+def serialize(summary):
+    return {
+        'tid': summary.user_id,
+        'gamesPlayed': summary.games_played,
+        'wins': summary.wins,
+        'losses': summary.games_played - summary.wins,
+        'goalsScored': summary.goals_scored,
+        'goalsReceived': summary.goals_received,
+        'currentStreak': summary.current_streak,
+        'bestStreak': summary.best_streak,
+        'tournamentWins': summary.tournament_wins,
+        'lastPlayed': summary.last_played,
+    }
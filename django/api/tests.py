@@ -1,5 +1,6 @@
 from django.test import TestCase
 from .models import User, Match, Statistic
+from .serializers import UserSerializer, FriendSerializer, MatchSerializer
 from datetime import datetime
 
 class UserModelTest(TestCase):
@@ -20,7 +21,7 @@ class UserModelTest(TestCase):
         self.assertTrue(self.user.status)  # Default is True
 
     def test_user_str(self):
-        self.assertEqual(str(self.user), f"User {self.user.id}: testuser")
+        self.assertEqual(str(self.user), "testuser")
 
 
 class MatchModelTest(TestCase):
@@ -37,7 +38,7 @@ class MatchModelTest(TestCase):
     def test_match_str(self):
         self.assertEqual(
             str(self.match),
-            f"Match {self.match.id} ({self.match.datetime_start} - {self.match.datetime_end})",
+            f"Match {self.match.id} ({self.match.datetime_start} - {self.match.datetime_end}, None - False)",
         )
 
 
@@ -70,6 +71,1732 @@ class StatisticModelTest(TestCase):
     def test_statistic_str(self):
         self.assertEqual(
             str(self.statistic),
-            f"Statistic {self.statistic.id}: Match {self.match.id}, User {self.user.username}",
+            f"Statistic {self.statistic.id}: Match {self.match}, User {self.user.id}",
         )
 
+
+
+class StatisticIngestTest(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create(username=f"player{i}", email=f"player{i}@example.com")
+            for i in range(4)
+        ]
+
+    def payload(self, game_type, match_count):
+        return {
+            'type': game_type,
+            'matches': [
+                {
+                    'db': {
+                        'datetimeStart': '2024-10-21T17:26:32Z',
+                        'datetimeEnd': '2024-10-21T17:28:32Z',
+                        'tournamentId': None,
+                        'prematureEnd': False,
+                    },
+                    'scores': [
+                        {
+                            'userId': user.id,
+                            'goalsScored': index,
+                            'goalsReceived': 3 - index,
+                            'datetimeLeft': '2024-10-21T17:28:32Z',
+                            'won': index == 3,
+                        }
+                        for index, user in enumerate(self.users)
+                    ],
+                }
+                for _ in range(match_count)
+            ],
+        }
+
+    def test_tournament_ingest(self):
+        response = self.client.post('/api/statistics/', self.payload(1, 3), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()), 12)
+        self.assertEqual(Match.objects.filter(tournament__isnull=False).count(), 3)
+        self.assertEqual(Statistic.objects.count(), 12)
+        self.assertEqual(Statistic.objects.filter(won=True).count(), 3)
+
+    def test_query_count_is_independent_of_payload_size(self):
+        from .ingest import ingest_statistics
+        # user check, savepoint, tournament, matches, statistics,
+        # leaderboard and summary insert/lock/update, release
+        with self.assertNumQueries(12):
+            ingest_statistics(1, self.payload(1, 7)['matches'])
+
+    def test_unknown_user_writes_nothing(self):
+        payload = self.payload(1, 2)
+        payload['matches'][1]['scores'][0]['userId'] = 9999
+        response = self.client.post('/api/statistics/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Match.objects.count(), 0)
+        self.assertEqual(Statistic.objects.count(), 0)
+
+
+class MatchHistoryTest(TestCase):
+    def setUp(self):
+        from .ingest import ingest_statistics
+        self.user = User.objects.create(username="history", email="history@example.com")
+        self.other = User.objects.create(username="rival", email="rival@example.com")
+
+        def match(minute):
+            stamp = f'2024-10-21T17:{minute:02d}:00Z'
+            return {
+                'db': {'datetimeStart': stamp, 'datetimeEnd': stamp, 'tournamentId': None, 'prematureEnd': False},
+                'scores': [
+                    {'userId': self.user.id, 'goalsScored': 3, 'goalsReceived': 1, 'datetimeLeft': stamp, 'won': True},
+                    {'userId': self.other.id, 'goalsScored': 1, 'goalsReceived': 3, 'datetimeLeft': stamp},
+                ],
+            }
+
+        ingest_statistics(0, [match(1)])
+        ingest_statistics(1, [match(2), match(4)])
+        ingest_statistics(0, [match(3)])
+        ingest_statistics(0, [match(5)])
+
+    def get(self, **params):
+        return self.client.get('/api/statistics/', {'userId': self.user.id, **params})
+
+    def test_groups_are_newest_first(self):
+        data = self.get().json()
+        self.assertEqual([len(group['matches']) for group in data], [1, 2, 1, 1])
+        self.assertIsNotNone(data[1]['tournamentId'])
+        self.assertIsNone(data[0]['tournamentId'])
+        started = [group['matches'][0]['started'] for group in data]
+        self.assertEqual(started, sorted(started, reverse=True))
+        tournament = data[1]['matches']
+        self.assertGreater(tournament[0]['started'], tournament[1]['started'])
+        self.assertEqual({score['tid'] for score in tournament[0]['scores']}, {self.user.id, self.other.id})
+
+    def test_cursor_pagination(self):
+        first = self.get(limit=2)
+        self.assertEqual(len(first.json()), 2)
+        second = self.get(limit=2, before=first['X-Next-Before'])
+        self.assertEqual(len(second.json()), 2)
+        self.assertNotIn('X-Next-Before', second)
+        self.assertEqual(first.json() + second.json(), self.get().json())
+
+    def test_page_boundary_inside_a_tie(self):
+        from .ingest import ingest_statistics
+        stamp = '2024-10-21T18:00:00Z'
+        tied = {
+            'db': {'datetimeStart': stamp, 'datetimeEnd': stamp, 'tournamentId': None, 'prematureEnd': False},
+            'scores': [{'userId': self.user.id, 'goalsScored': 1, 'goalsReceived': 0, 'datetimeLeft': stamp, 'won': True}],
+        }
+        # three single matches and a tournament, all last played at the same time
+        for _ in range(3):
+            ingest_statistics(0, [tied])
+        ingest_statistics(1, [tied])
+
+        everything = self.get().json()
+        self.assertEqual(len(everything), 8)
+        for limit in (1, 2, 3):
+            pages, before = [], None
+            while True:
+                response = self.get(limit=limit, **({'before': before} if before else {}))
+                pages += response.json()
+                before = response.get('X-Next-Before')
+                if before is None:
+                    break
+            self.assertEqual(pages, everything)
+
+    def test_timestamp_cursor_still_accepted(self):
+        older = self.get(before='2024-10-21T17:03:00Z').json()
+        self.assertEqual([group['matches'][0]['started'] for group in older], ['2024-10-21T17:01:00Z'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get(before='yesterday').status_code, 400)
+        self.assertEqual(self.get(before='2024-10-21T17:03:00Z,1').status_code, 400)
+        self.assertEqual(self.get(before='2024-10-21T17:03:00Z,a,b').status_code, 400)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        from .ingest import ingest_statistics
+        self.users = [
+            User.objects.create(username=f"ranked{i}", email=f"ranked{i}@example.com")
+            for i in range(4)
+        ]
+        stamp = '2024-10-21T17:26:32Z'
+        # ranked3 beats everyone, ranked2 beats ranked1 and ranked0, ...
+        for winner in range(1, 4):
+            for loser in range(winner):
+                ingest_statistics(0, [{
+                    'db': {'datetimeStart': stamp, 'datetimeEnd': stamp, 'tournamentId': None, 'prematureEnd': False},
+                    'scores': [
+                        {'userId': self.users[winner].id, 'goalsScored': 5, 'goalsReceived': 2, 'datetimeLeft': stamp, 'won': True},
+                        {'userId': self.users[loser].id, 'goalsScored': 2, 'goalsReceived': 5, 'datetimeLeft': stamp},
+                    ],
+                }])
+
+    def test_top(self):
+        data = self.client.get('/api/leaderboard/', {'limit': 2}).json()
+        self.assertEqual(data['total'], 4)
+        self.assertEqual([player['username'] for player in data['players']], ['ranked3', 'ranked2'])
+        self.assertEqual(data['players'][0]['wins'], 3)
+        self.assertEqual(data['players'][0]['gamesPlayed'], 3)
+
+    def test_rank_and_around(self):
+        rank = self.client.get('/api/leaderboard/rank/', {'userId': self.users[1].id}).json()
+        self.assertEqual(rank['rank'], 3)
+        around = self.client.get('/api/leaderboard/around/', {'userId': self.users[1].id, 'count': 1}).json()
+        self.assertEqual([player['rank'] for player in around['players']], [2, 3, 4])
+        self.assertEqual(around['players'][1]['tid'], self.users[1].id)
+
+    def test_rebuild_matches_incremental_updates(self):
+        from . import leaderboard
+        from .models import LeaderboardEntry
+        fields = ['user_id'] + leaderboard.ENTRY_FIELDS
+        incremental = list(LeaderboardEntry.objects.order_by('user_id').values(*fields))
+        leaderboard.rebuild()
+        self.assertEqual(list(LeaderboardEntry.objects.order_by('user_id').values(*fields)), incremental)
+
+    def test_rating_changes_are_zero_sum(self):
+        from . import leaderboard
+        for outcome in ([True, False, False, False], [False] * 4):
+            entries = {user.id: leaderboard.new_entry(user.id) for user in self.users}
+            for entry, rating in zip(entries.values(), (1000, 1100, 1250, 900)):
+                entry.rating = rating
+            before = sum(entry.rating for entry in entries.values())
+            leaderboard.apply_match(entries, [(user.id, 1, 1, won) for user, won in zip(self.users, outcome)])
+            # each player's change is rounded on its own
+            self.assertLessEqual(abs(sum(entry.rating for entry in entries.values()) - before), 2)
+            self.assertNotEqual([entry.rating for entry in entries.values()], [1000, 1100, 1250, 900])
+
+
+class StatsSummaryTest(TestCase):
+    def setUp(self):
+        from .ingest import ingest_statistics
+        self.user = User.objects.create(username="streaky", email="streaky@example.com")
+        self.other = User.objects.create(username="opponent", email="opponent@example.com")
+
+        def match(minute, user_won):
+            stamp = f'2024-10-21T17:{minute:02d}:00Z'
+            return {
+                'db': {'datetimeStart': stamp, 'datetimeEnd': stamp, 'tournamentId': None, 'prematureEnd': False},
+                'scores': [
+                    {'userId': self.user.id, 'goalsScored': 2, 'goalsReceived': 1, 'datetimeLeft': stamp, 'won': user_won},
+                    {'userId': self.other.id, 'goalsScored': 1, 'goalsReceived': 2, 'datetimeLeft': stamp, 'won': not user_won},
+                ],
+            }
+
+        self.match = match
+        ingest_statistics(0, [match(1, True)])
+        ingest_statistics(0, [match(2, True)])
+        ingest_statistics(0, [match(3, False)])
+        ingest_statistics(1, [match(4, False), match(5, True)])
+
+    def test_match_added_to_a_stored_tournament(self):
+        from . import summary
+        from .ingest import ingest_statistics
+        from .models import Tournament
+        later = self.match(6, False)
+        later['db']['tournamentId'] = Tournament.objects.get().id
+        # the stored final and its winners, from the hot and the archive tables
+        with self.assertNumQueries(16):
+            ingest_statistics(0, [later])
+
+        wins = lambda user: self.client.get('/api/statistics/summary/', {'userId': user.id}).json()['tournamentWins']
+        self.assertEqual((wins(self.user), wins(self.other)), (0, 1))
+        self.assertEqual(summary.check(), [])
+
+    def test_summary_endpoint(self):
+        data = self.client.get('/api/statistics/summary/', {'userId': self.user.id}).json()
+        self.assertEqual(data['gamesPlayed'], 5)
+        self.assertEqual(data['wins'], 3)
+        self.assertEqual(data['goalsScored'], 10)
+        self.assertEqual(data['currentStreak'], 1)
+        self.assertEqual(data['bestStreak'], 2)
+        self.assertEqual(data['tournamentWins'], 1)
+        self.assertEqual(data['lastPlayed'], '2024-10-21T17:05:00Z')
+
+    def test_summary_without_games(self):
+        lonely = User.objects.create(username="lonely", email="lonely@example.com")
+        data = self.client.get('/api/statistics/summary/', {'userId': lonely.id}).json()
+        self.assertEqual(data['gamesPlayed'], 0)
+        self.assertIsNone(data['lastPlayed'])
+
+    def test_check_and_rebuild(self):
+        from . import summary
+        from .models import UserStatsSummary
+        self.assertEqual(summary.check(), [])
+        UserStatsSummary.objects.filter(user=self.user).update(wins=0)
+        self.assertEqual(summary.check(), [(self.user.id, 'wins', 0, 3)])
+        summary.rebuild()
+        self.assertEqual(summary.check(), [])
+
+    def test_final_of_a_tournament_split_across_tables(self):
+        from . import archive, summary
+        from .models import ArchivedMatch, Tournament
+        tournament = Tournament.objects.get()
+        archive.archive_matches(list(Match.objects.filter(tournament=tournament).values_list('id', flat=True)))
+        # a hot match older than the archived final, as data from before the
+        # all-hot-or-all-archived rule can hold
+        stamp = datetime.fromisoformat('2024-10-21T17:00:30+00:00')
+        early = Match.objects.create(tournament=tournament, datetime_start=stamp, datetime_end=stamp)
+        Statistic.objects.create(match=early, user=self.other, datetime_left=stamp, won=True)
+
+        final = ArchivedMatch.objects.filter(tournament=tournament).latest('datetime_start')
+        self.assertEqual(summary.final_match_ids(), {final.id})
+        summaries = summary.compute()
+        self.assertEqual((summaries[self.user.id].tournament_wins, summaries[self.other.id].tournament_wins), (1, 0))
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        from rest_framework.authtoken.models import Token
+        from .authentication import token_cache
+        token_cache.clear()
+        self.user = User.objects.create(username="cached", email="cached@example.com")
+        self.token = Token.objects.create(user=self.user)
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_second_validation_skips_database(self):
+        response = self.client.get('/api/user/validate/', **self.headers)
+        self.assertEqual(response.json(), {'tid': self.user.id, 'username': 'cached'})
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/user/validate/', **self.headers)
+        self.assertEqual(response.json(), {'tid': self.user.id, 'username': 'cached'})
+
+    def test_token_deletion_invalidates(self):
+        self.client.get('/api/user/validate/', **self.headers)
+        self.token.delete()
+        response = self.client.get('/api/user/validate/', **self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_expiry_and_user_invalidation(self):
+        from .cache import LRUCache
+        from .authentication import token_cache, invalidate_user
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', (1, 'a'))
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        self.client.get('/api/user/validate/', **self.headers)
+        invalidate_user(self.user.id)
+        self.assertEqual(len(token_cache), 0)
+
+    def test_stats_are_internal(self):
+        from django.test import override_settings
+        with override_settings(INTERNAL_API_SECRET='stats-secret'):
+            self.assertEqual(self.client.get('/api/user/validate/cache/', **self.headers).status_code, 403)
+            response = self.client.get('/api/user/validate/cache/', HTTP_X_INTERNAL_TOKEN='stats-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', response.json())
+
+
+class PresenceBulkTest(TestCase):
+    def setUp(self):
+        from django.test import override_settings
+
+        self.users = [
+            User.objects.create(username=f"present{i}", email=f"present{i}@example.com", status=False)
+            for i in range(3)
+        ]
+        secret = override_settings(INTERNAL_API_SECRET='game-server-secret')
+        secret.enable()
+        self.addCleanup(secret.disable)
+        self.internal = {'HTTP_X_INTERNAL_TOKEN': 'game-server-secret'}
+
+    def test_only_the_game_server_may_call(self):
+        from django.test import override_settings
+
+        transitions = [{'userId': self.users[0].id, 'online': True, 'timestamp': '2024-10-21T17:00:00Z'}]
+        for headers in ({}, {'HTTP_X_INTERNAL_TOKEN': 'guess'}):
+            self.assertEqual(self.client.get('/api/user/status/bulk/', **headers).status_code, 403)
+            response = self.client.post('/api/user/status/bulk/', {'transitions': transitions}, content_type='application/json', **headers)
+            self.assertEqual(response.status_code, 403)
+        self.assertFalse(User.objects.get(pk=self.users[0].pk).status)
+
+        # An unset secret closes the endpoint instead of matching an empty header
+        with override_settings(INTERNAL_API_SECRET=''):
+            self.assertEqual(self.client.get('/api/user/status/bulk/', HTTP_X_INTERNAL_TOKEN='').status_code, 403)
+        self.assertEqual(self.client.get('/api/user/status/bulk/', **self.internal).status_code, 200)
+
+    def test_flapping_transitions_are_coalesced(self):
+        transitions = [
+            {'userId': self.users[0].id, 'online': True, 'timestamp': '2024-10-21T17:00:00Z'},
+            {'userId': self.users[0].id, 'online': False, 'timestamp': '2024-10-21T17:00:01Z'},
+            {'userId': self.users[0].id, 'online': True, 'timestamp': '2024-10-21T17:00:02Z'},
+            {'userId': self.users[1].id, 'online': True, 'timestamp': '2024-10-21T17:00:03Z'},
+            {'userId': self.users[1].id, 'online': False, 'timestamp': '2024-10-21T17:00:04Z'},
+        ]
+        # the known ids, one UPDATE, the friend event insert
+        with self.assertNumQueries(3):
+            response = self.client.post('/api/user/status/bulk/', {'transitions': transitions}, content_type='application/json', **self.internal)
+        self.assertEqual(response.json(), {'received': 5, 'coalesced': 3, 'rowsWritten': 2})
+
+        first, second, third = User.objects.order_by('id')
+        self.assertTrue(first.status)
+        self.assertEqual(first.last_online.isoformat(), '2024-10-21T17:00:02+00:00')
+        self.assertFalse(second.status)
+        self.assertFalse(third.status)
+
+    def test_invalid_transition(self):
+        response = self.client.post('/api/user/status/bulk/', {'transitions': [{'userId': 'x'}]}, content_type='application/json', **self.internal)
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_users_are_skipped(self):
+        from .models import FriendEvent
+        transitions = [
+            {'userId': self.users[0].id, 'online': True, 'timestamp': '2024-10-21T17:00:00Z'},
+            {'userId': 999999, 'online': True, 'timestamp': '2024-10-21T17:00:00Z'},
+        ]
+        response = self.client.post('/api/user/status/bulk/', {'transitions': transitions}, content_type='application/json', **self.internal)
+        self.assertEqual(response.json(), {'received': 2, 'coalesced': 0, 'rowsWritten': 1})
+        self.assertTrue(User.objects.get(pk=self.users[0].pk).status)
+        self.assertEqual(list(FriendEvent.objects.values_list('user_id', flat=True)), [self.users[0].id])
+
+
+class FriendEventsTest(TestCase):
+    def setUp(self):
+        from .models import Friend
+        self.user = User.objects.create(username="watcher", email="watcher@example.com")
+        self.friend = User.objects.create(username="watched", email="watched@example.com")
+        self.stranger = User.objects.create(username="stranger", email="stranger@example.com")
+        Friend.objects.create(user=self.user, friend=self.friend)
+        # Polled by hand: the hub thread would not see the test's transaction
+        from . import events
+        self.addCleanup(setattr, events, 'default_hub', events.default_hub)
+        events.default_hub = self.hub = events.Hub(threaded=False)
+
+    def collect(self, last_id):
+        from . import events
+        return list(events.stream(self.user.id, last_id, duration=0.05))
+
+    def test_only_friend_deltas_are_streamed(self):
+        from . import events, presence
+        cursor = events.latest_id()
+        presence.apply({self.friend.id: (True, datetime(2024, 10, 21, 17, 0, 0))})
+        presence.apply({self.stranger.id: (True, datetime(2024, 10, 21, 17, 0, 0))})
+        events.publish_friendship(self.user.id, self.stranger.id, added=True)
+        presence.apply({self.stranger.id: (False, datetime(2024, 10, 21, 17, 1, 0))})
+
+        chunks = [chunk for chunk in self.collect(cursor) if chunk.startswith('id:')]
+        self.assertEqual(len(chunks), 3)
+        self.assertIn('event: presence', chunks[0])
+        self.assertIn('"username": "watched"', chunks[0])
+        self.assertIn('event: friend_added', chunks[1])
+        self.assertIn('"tid": %d' % self.stranger.id, chunks[2])
+        self.assertIn('"status": false', chunks[2])
+
+    def test_one_poll_serves_every_stream(self):
+        from itertools import islice
+        from . import events, presence
+        from .models import Friend
+        other = User.objects.create(username="other", email="other@example.com")
+        Friend.objects.create(user=other, friend=self.friend)
+        streams = [events.stream(user.id, clock=lambda: 0) for user in (self.user, other)]
+        for stream in streams:
+            next(stream)
+
+        presence.apply({self.friend.id: (True, datetime(2024, 10, 21, 17, 0, 0))})
+        events.publish_friendship(self.user.id, self.stranger.id, added=True)
+        presence.apply({self.stranger.id: (True, datetime(2024, 10, 21, 17, 1, 0))})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.hub.poll(), 3)
+
+        # The clock stands still, so nothing but events comes out
+        mine, theirs = (list(islice(stream, count)) for stream, count in zip(streams, (3, 1)))
+        self.assertIn('"username": "watched"', mine[0])
+        self.assertIn('event: friend_added', mine[1])
+        self.assertIn('"tid": %d' % self.stranger.id, mine[2])
+        self.assertIn('"username": "watched"', theirs[0])
+        for stream in streams:
+            stream.close()
+        self.assertFalse(self.hub.subscribers)
+
+    def test_stream_ticket(self):
+        from django.test import override_settings
+        from .authentication import issue_jwt
+        response = self.client.post('/api/friend/events/ticket/', HTTP_AUTHORIZATION='Bearer ' + issue_jwt(self.user))
+        ticket = response.json()['ticket']
+        self.assertNotIn(issue_jwt(self.user), ticket)
+        self.assertEqual(self.client.post('/api/friend/events/ticket/').status_code, 401)
+
+        self.assertEqual(self.client.get('/api/friend/events/', {'token': issue_jwt(self.user)}).status_code, 401)
+        self.assertEqual(self.client.get('/api/friend/events/', {'ticket': ticket + 'x'}).status_code, 401)
+        with override_settings(STREAM_TICKET_MAX_AGE=-1):
+            self.assertEqual(self.client.get('/api/friend/events/', {'ticket': ticket}).status_code, 401)
+        response = self.client.get('/api/friend/events/', {'ticket': ticket})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        response.close()
+
+    async def test_asgi_stream_sends_events_as_they_come(self):
+        import asyncio
+        from asgiref.sync import sync_to_async
+        from . import events, presence
+        cursor = await sync_to_async(events.latest_id)()
+        await sync_to_async(presence.apply)({self.friend.id: (True, datetime(2024, 10, 21, 17, 0, 0))})
+
+        response = await self.async_client.get('/api/friend/events/', {'ticket': events.sign_ticket(self.user.id), 'lastEventId': cursor})
+
+        async def first_event():
+            # Iterated the way the ASGI handler sends it
+            async for chunk in response:
+                if chunk.startswith(b'id:'):
+                    return chunk
+
+        chunk = await asyncio.wait_for(first_event(), 5)
+        self.assertIn(b'"username": "watched"', chunk)
+
+
+class UsernameSearchTest(TestCase):
+    def setUp(self):
+        from rest_framework.authtoken.models import Token
+        from .models import Friend
+        import jwt
+        from django.conf import settings
+        self.user = User.objects.create(username="searcher", email="searcher@example.com")
+        for name in ["Alpha", "alphabet", "Betalpha", "malpha", "alp", "gamma"]:
+            User.objects.create(username=name, email=f"{name}@example.com")
+        Friend.objects.create(user=self.user, friend=User.objects.get(username="malpha"))
+
+        session = self.client.session
+        session['user_data'] = {'username': 'searcher'}
+        session.save()
+        self.headers = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'username': 'searcher'}, settings.SECRET_KEY, algorithm='HS256')}
+
+    def search(self, **params):
+        return self.client.get('/api/user/search/', params, **self.headers).json()
+
+    def test_prefix_matches_rank_first_and_friends_are_excluded(self):
+        data = self.search(query='ALPH')
+        self.assertEqual([user['username'] for user in data['users']], ['Alpha', 'alphabet', 'Betalpha'])
+        self.assertIsNone(data['next'])
+
+    def test_cursor_continuation(self):
+        first = self.search(query='alp', limit=2)
+        self.assertEqual([user['username'] for user in first['users']], ['alp', 'Alpha'])
+        second = self.search(query='alp', limit=2, cursor=first['next'])
+        self.assertEqual([user['username'] for user in second['users']], ['alphabet', 'Betalpha'])
+        self.assertIsNone(second['next'])
+
+    def test_renamed_user_is_reindexed(self):
+        gamma = User.objects.get(username="gamma")
+        gamma.username = "alphaomega"
+        gamma.save()
+        self.assertIn('alphaomega', [user['username'] for user in self.search(query='phaom')['users']])
+        self.assertEqual(self.search(query='gamma'), {'detail': 'No User matches the given query.'})
+
+
+class UserListTest(TestCase):
+    def setUp(self):
+        for i in range(5):
+            User.objects.create(username=f"listed{i}", email=f"listed{i}@example.com", password="hash")
+
+    def test_sparse_fields_and_cursor(self):
+        first = self.client.get('/api/users/', {'fields': 'id,username', 'limit': 3})
+        self.assertEqual(first.json()[0], {'id': User.objects.order_by('id').first().id, 'username': 'listed0'})
+        second = self.client.get('/api/users/', {'fields': 'username', 'limit': 3, 'cursor': first['X-Next-Cursor']})
+        self.assertEqual([user['username'] for user in second.json()], ['listed3', 'listed4'])
+        self.assertNotIn('X-Next-Cursor', second)
+
+    def test_password_and_m2m_are_not_listed_by_default(self):
+        with self.assertNumQueries(1):
+            users = self.client.get('/api/users/').json()
+        self.assertNotIn('password', users[0])
+        self.assertNotIn('groups', users[0])
+        self.assertEqual(self.client.get('/api/users/', {'fields': 'password'}).status_code, 400)
+        with self.assertNumQueries(2):
+            users = self.client.get('/api/users/', {'fields': 'id,groups'}).json()
+        self.assertEqual(users[0]['groups'], [])
+
+
+class FastSerializerTest(TestCase):
+    """The compiled serializers must render exactly the bytes of the DRF ones."""
+
+    def setUp(self):
+        from django.contrib.auth.models import Group
+        from .models import Friend
+        self.user = User.objects.create(username="fast", email="fast@example.com", password="hash", avatar="avatars/a.png")
+        self.friend = User.objects.create(username="fäst ☃", email="friend@example.com", status=False)
+        self.user.groups.add(Group.objects.create(name="players"))
+        Friend.objects.create(user=self.user, friend=self.friend)
+        Match.objects.create(datetime_start=datetime(2024, 10, 21, 17, 26, 32), datetime_end=datetime(2024, 10, 21, 18, 26, 32))
+
+    def assertSameBytes(self, compiled, drf_data, rows, request=None):
+        from rest_framework.renderers import JSONRenderer
+        from .fastserializers import render
+        self.assertEqual(render(compiled.many(rows, request)), JSONRenderer().render(drf_data))
+
+    def test_user(self):
+        from rest_framework.test import APIRequestFactory
+        from .fastserializers import user_serializer
+        from .views import USER_LIST_FIELDS
+        users = User.objects.order_by('id')
+        self.assertSameBytes(user_serializer, UserSerializer(users, many=True).data, user_serializer.rows(users))
+
+        request = APIRequestFactory().get('/api/users/')
+        fields = sorted(USER_LIST_FIELDS)
+        compiled = user_serializer.subset(fields)
+        listed = UserSerializer(users, many=True, context={'request': request})
+        for name in set(listed.child.fields) - set(fields):
+            listed.child.fields.pop(name)
+        drf_data = listed.data
+        self.assertSameBytes(compiled, drf_data, compiled.rows(users), request)
+
+    def test_friend(self):
+        from .fastserializers import friend_serializer
+        from .models import Friend
+        friends = Friend.objects.order_by('id')
+        self.assertSameBytes(friend_serializer, FriendSerializer(friends, many=True).data, friend_serializer.rows(friends))
+
+    def test_match(self):
+        from .fastserializers import match_serializer
+        matches = Match.objects.order_by('id')
+        self.assertSameBytes(match_serializer, MatchSerializer(matches, many=True).data, match_serializer.rows(matches))
+
+
+class BenchmarkSeedTest(TestCase):
+    def test_seed_matches_node_payload_shape(self):
+        from . import benchmark, summary
+        from .models import LeaderboardEntry, Tournament
+        users = benchmark.seed(users=20, friends=3, singles=10, tournaments=2, players=4)
+        self.assertEqual(len(users), 20)
+        self.assertEqual(Tournament.objects.count(), 2)
+        self.assertEqual(Match.objects.count(), 10 + 2 * 7)
+        self.assertEqual(Statistic.objects.count(), (10 + 2 * 7) * 4)
+        self.assertEqual(summary.check(), [])
+        self.assertEqual(
+            LeaderboardEntry.objects.count(),
+            Statistic.objects.values('user_id').distinct().count(),
+        )
+
+
+class QueryMetricsTest(TestCase):
+    def setUp(self):
+        from .metrics import registry
+        registry.reset()
+        self.user = User.objects.create(username="metered", email="metered@example.com")
+
+    def test_server_timing_and_metrics(self):
+        from django.test import override_settings
+        response = self.client.get('/api/statistics/', {'userId': self.user.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=[\d.]+$')
+
+        with override_settings(INTERNAL_API_SECRET='scraper-secret'):
+            self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_X_INTERNAL_TOKEN='guess').status_code, 403)
+            text = self.client.get('/api/metrics/', HTTP_X_INTERNAL_TOKEN='scraper-secret').content.decode()
+        self.assertIn('# TYPE api_request_duration_seconds histogram', text)
+        self.assertIn('api_request_duration_seconds_count{method="GET",view="statistic_view"} 1', text)
+        self.assertIn('api_requests_total{method="GET",status="200",view="statistic_view"} 1', text)
+        self.assertIn('api_token_cache_hits_total', text)
+
+    def test_repeated_statements_are_flagged(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from .metrics import registry
+        from .middleware import QueryMetricsMiddleware
+
+        def view(request):
+            for user_id in range(6):
+                list(User.objects.filter(id=user_id))
+            list(User.objects.filter(id__in=[1, 2]))
+            list(User.objects.filter(id__in=[1, 2, 3]))
+            return HttpResponse()
+
+        with self.assertLogs('api.middleware', 'WARNING'):
+            response = QueryMetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertIn('nplusone;desc="1 repeated statements"', response['Server-Timing'])
+        self.assertEqual(registry.counter_value('api_n_plus_one_total', view='unmatched', method='GET'), 1)
+        self.assertEqual(registry.counter_value('api_request_queries_total', view='unmatched', method='GET'), 8)
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            PROFILE_ENABLED=True, PROFILE_SAMPLE_RATES={}, PROFILE_DIR=self.directory, PROFILE_KEEP=2,
+        )
+        self.settings_override.enable()
+        self.user = User.objects.create(username="profiled", email="profiled@example.com")
+
+    def tearDown(self):
+        import shutil
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+
+    def test_signed_header_profiles_matching_view(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from . import profiling
+
+        token = profiling.sign('statistic_summary_view')
+        for _ in range(3):
+            self.client.get('/api/statistics/summary/', {'userId': self.user.id}, HTTP_X_PROFILE_TOKEN=token)
+        self.client.get('/api/statistics/', {'userId': self.user.id}, HTTP_X_PROFILE_TOKEN=token)
+        self.client.get('/api/statistics/summary/', {'userId': self.user.id}, HTTP_X_PROFILE_TOKEN=token + 'x')
+
+        self.assertEqual(len(profiling.dumps()), 2)
+        self.assertEqual(len(profiling.dumps('statistic_summary_view')), 2)
+        summary_path = profiling.directory() / 'statistic_summary_view' / 'summary.txt'
+        self.assertFalse(summary_path.exists())  # left to profile_report, off the request
+
+        output = StringIO()
+        call_command('profile_report', stdout=output)
+        self.assertIn('2 profiles of statistic_summary_view', output.getvalue())
+        self.assertIn('statistic_summary_view', summary_path.read_text())
+
+    def test_sample_rate(self):
+        from django.test import override_settings
+        from . import profiling
+
+        with override_settings(PROFILE_SAMPLE_RATES={'*': 1.0}):
+            self.client.get('/api/statistics/', {'userId': self.user.id})
+        self.assertEqual(len(profiling.dumps('statistic_view')), 1)
+
+    async def test_profiles_in_an_async_chain(self):
+        from asgiref.sync import iscoroutinefunction, sync_to_async
+        from django.test import override_settings
+        from . import profiling
+        with override_settings(PROFILE_SAMPLE_RATES={'*': 1.0}):
+            self.assertTrue(iscoroutinefunction(profiling.ProfilingMiddleware(self.async_view)))
+            response = await self.async_client.get('/api/statistics/summary/', {'userId': self.user.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(await sync_to_async(profiling.dumps)('statistic_summary_view')), 1)
+
+    @staticmethod
+    async def async_view(request):
+        pass
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from django.test import override_settings
+        from .metrics import registry
+        registry.reset()
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.settings_override = override_settings(RATE_LIMIT_DB=self.path, RATE_LIMITS={
+            'login_ip': '5/min', 'login_user': '2/min', 'signup_ip': '1/hour',
+        })
+        self.settings_override.enable()
+
+    def tearDown(self):
+        import os
+        self.settings_override.disable()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_bucket_refill(self):
+        from .ratelimit import BucketStore
+        now = [1000.0]
+        buckets = BucketStore(self.path, clock=lambda: now[0])
+        self.assertEqual(buckets.consume('k', '2/min'), (True, 0))
+        self.assertEqual(buckets.consume('k', '2/min'), (True, 0))
+        allowed, wait = buckets.consume('k', '2/min')
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 30)
+        now[0] += 30
+        self.assertEqual(buckets.consume('k', '2/min'), (True, 0))
+        self.assertFalse(buckets.consume('k', '2/min')[0])
+
+    def test_login_limited_per_username_and_ip(self):
+        from .metrics import registry
+        for _ in range(2):
+            response = self.client.post('/api/login/', {'username': 'nobody', 'password': 'x'}, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/login/', {'username': 'Nobody', 'password': 'x'}, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+        for name in ('a', 'b'):
+            self.assertEqual(self.client.post('/api/login/', {'username': name, 'password': 'x'}, content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post('/api/login/', {'username': 'c', 'password': 'x'}, content_type='application/json').status_code, 429)
+        self.assertEqual(registry.counter_value('api_rate_limit_rejections_total', scope='login', key='ip'), 1)
+
+    def test_signup_limit_only_applies_to_post(self):
+        data = {'username': 'fresh', 'email': 'fresh@example.com', 'password': 'pw'}
+        self.assertEqual(self.client.post('/api/users/', data, content_type='application/json').status_code, 201)
+        data = {'username': 'fresher', 'email': 'fresher@example.com', 'password': 'pw'}
+        self.assertEqual(self.client.post('/api/users/', data, content_type='application/json').status_code, 429)
+        self.assertEqual(self.client.get('/api/users/').status_code, 200)
+
+    def test_search_limited_per_authenticated_user(self):
+        from django.test import override_settings
+        from .authentication import issue_jwt, user_cache
+        user_cache.clear()
+        user = User.objects.create(username="searcher", email="searcher@example.com")
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(user)}'}
+        with override_settings(RATE_LIMITS={'search_ip': '100/min', 'search_user': '2/min'}):
+            for address in ('203.0.113.1', '203.0.113.2'):
+                self.assertEqual(self.client.get('/api/user/search/', {'query': 'se'}, REMOTE_ADDR=address, **headers).status_code, 200)
+            # no session, another address: still the same user's bucket
+            self.client.cookies.clear()
+            response = self.client.get('/api/user/search/', {'query': 'se'}, REMOTE_ADDR='203.0.113.3', **headers)
+            self.assertEqual(response.status_code, 429)
+
+    def test_forged_forwarded_for_keeps_the_bucket(self):
+        # nginx appends the address it saw after whatever the client sent
+        data = {'username': 'fresh', 'email': 'fresh@example.com', 'password': 'pw'}
+        response = self.client.post('/api/users/', data, content_type='application/json', HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertEqual(response.status_code, 201)
+        data = {'username': 'fresher', 'email': 'fresher@example.com', 'password': 'pw'}
+        for forged in ('10.0.0.1', '10.0.0.2, 10.0.0.3'):
+            response = self.client.post(
+                '/api/users/', data, content_type='application/json', HTTP_X_FORWARDED_FOR=f'{forged}, 203.0.113.9'
+            )
+            self.assertEqual(response.status_code, 429)
+        response = self.client.post('/api/users/', data, content_type='application/json', HTTP_X_FORWARDED_FOR='198.51.100.7')
+        self.assertEqual(response.status_code, 201)
+
+
+class SessionModeTest(TestCase):
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'sessions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-sessions'},
+    }
+
+    def setUp(self):
+        from .authentication import issue_jwt, user_cache
+        user_cache.clear()
+        user = User.objects.create(username="sessioned", email="sessioned@example.com")
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(user)}'}
+
+    def test_cached_sessions_only_write_on_change_or_refresh(self):
+        from django.test import override_settings
+        with override_settings(CACHES=self.CACHES, SESSION_ENGINE='django.contrib.sessions.backends.cached_db'):
+            session = self.client.session
+            session['user_data'] = {'username': 'sessioned'}
+            session.save()
+            self.set_session_cookie(session.session_key)
+
+            # the user lookup, then the expiry slide: one UPDATE in a savepoint
+            with self.assertNumQueries(4):
+                self.client.get('/api/user/data/', **self.headers)
+            with self.assertNumQueries(0):
+                response = self.client.get('/api/user/data/', **self.headers)
+            self.assertEqual(response.json(), {'username': 'sessioned'})
+
+            with override_settings(SESSION_REFRESH_INTERVAL=0), self.assertNumQueries(3):
+                self.client.get('/api/user/data/', **self.headers)
+
+    def test_signed_mode_converts_database_sessions(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.contrib.sessions.models import Session
+        from django.test import override_settings
+        legacy = SessionStore()
+        legacy['user_data'] = {'username': 'sessioned'}
+        legacy.save()
+
+        with override_settings(SESSION_ENGINE='api.sessions'):
+            self.set_session_cookie(legacy.session_key)
+            response = self.client.get('/api/user/data/', **self.headers)
+            self.assertEqual(response.json(), {'username': 'sessioned'})
+            self.assertNotEqual(response.cookies['sessionid'].value, legacy.session_key)
+            self.assertFalse(Session.objects.exists())
+
+            with self.assertNumQueries(0):
+                response = self.client.get('/api/user/data/', **self.headers)
+            self.assertEqual(response.json(), {'username': 'sessioned'})
+
+    def set_session_cookie(self, key):
+        from django.conf import settings
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = key
+
+
+class JWTAuthenticationTest(TestCase):
+    def setUp(self):
+        from .authentication import issue_jwt, user_cache
+        user_cache.clear()
+        self.user = User.objects.create(username="bearer", email="bearer@example.com")
+        self.friend = User.objects.create(username="buddy", email="buddy@example.com")
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(self.user)}'}
+
+    def test_cached_user_saves_a_query(self):
+        from .models import Friend
+        Friend.objects.create(user=self.user, friend=self.friend)
+        response = self.client.get('/api/friend/', **self.headers)
+        self.assertEqual(response.json()['friends'][0]['friend']['username'], 'buddy')
+        with self.assertNumQueries(1):
+            self.client.get('/api/friend/', **self.headers)
+
+    def test_expired_and_invalid_tokens(self):
+        import jwt
+        from django.conf import settings
+        expired = jwt.encode({'user_id': self.user.id, 'exp': 1}, settings.SECRET_KEY, algorithm='HS256')
+        response = self.client.get('/api/friend/', HTTP_AUTHORIZATION=f'Bearer {expired}')
+        self.assertEqual((response.status_code, response.json()), (401, {'error': 'Token expired.'}))
+        response = self.client.get('/api/friend/', HTTP_AUTHORIZATION='Bearer nonsense')
+        self.assertEqual((response.status_code, response.json()), (401, {'error': 'Invalid token.'}))
+        self.assertEqual(self.client.get('/api/friend/').status_code, 401)
+
+    def test_saving_or_deleting_user_invalidates(self):
+        from .authentication import user_cache
+        self.client.get('/api/friend/', **self.headers)
+        self.assertEqual(len(user_cache), 1)
+
+        response = self.client.post('/api/user/update/', {'username': 'renamed'}, content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(user_cache), 0)
+        self.client.get('/api/friend/', **self.headers)
+        self.assertEqual(user_cache.get(self.user.id).username, 'renamed')
+
+        self.user.delete()
+        response = self.client.get('/api/friend/', **self.headers)
+        self.assertEqual((response.status_code, response.json()), (401, {'error': 'User not found'}))
+
+    def test_logout_revokes_every_token(self):
+        from .authentication import issue_jwt
+        other_device = {'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(self.user)}'}
+        self.assertEqual(self.client.get('/api/friend/', **self.headers).status_code, 200)
+
+        session = self.client.session
+        session['user_data'] = {'username': 'bearer', 'jwtToken': self.headers['HTTP_AUTHORIZATION'][7:]}
+        session.save()
+        self.assertEqual(self.client.post('/api/logout/').status_code, 200)
+
+        for headers in (self.headers, other_device):
+            response = self.client.get('/api/friend/', **headers)
+            self.assertEqual((response.status_code, response.json()), (401, {'error': 'Token revoked.'}))
+        self.user.refresh_from_db()
+        fresh = {'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(self.user)}'}
+        self.assertEqual(self.client.get('/api/friend/', **fresh).status_code, 200)
+
+    def test_logout_without_a_session_token_uses_the_username(self):
+        session = self.client.session
+        session['user_data'] = {'username': 'bearer'}
+        session.save()
+        self.client.post('/api/logout/')
+        self.assertEqual(self.client.get('/api/friend/', **self.headers).status_code, 401)
+
+
+class LoginPipelineTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.hashers import make_password
+        from django.test import override_settings
+        self.settings_override = override_settings(RATE_LIMIT_ENABLED=False)
+        self.settings_override.enable()
+        self.user = User.objects.create(username="loginner", email="loginner@example.com", password=make_password('secret'))
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def login(self, password='secret', **extra):
+        return self.client.post('/api/login/', {'username': 'loginner', 'password': password, **extra}, content_type='application/json')
+
+    def test_wrong_password_is_rejected(self):
+        response = self.login('wrong')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid credentials'}))
+
+    def test_token_is_joined_into_the_user_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        first = self.login()
+        self.assertEqual(first.status_code, 200)
+
+        with CaptureQueriesContext(connection) as captured:
+            second = self.login()
+        self.assertEqual(second.json()['token'], first.json()['token'])
+        tables = ' '.join(query['sql'] for query in captured)
+        self.assertEqual(tables.count('FROM "api_user"'), 1)
+        self.assertNotIn('otp_totp_totpdevice', tables)
+
+    def test_unconfirmed_device_is_confirmed_and_checked(self):
+        from django_otp.plugins.otp_totp.models import TOTPDevice
+        User.objects.filter(id=self.user.id).update(has_2fa=True)
+        device = TOTPDevice.objects.create(user=self.user, name='loginner', confirmed=False)
+        self.assertEqual(self.login().json(), {'error': '2FA token is required'})
+        device.refresh_from_db()
+        self.assertTrue(device.confirmed)
+        self.assertEqual(self.login(otp_token='000000').json(), {'error': 'Invalid 2FA token'})
+
+    def test_full_pool_turns_logins_away(self):
+        from unittest import mock
+        from . import login
+        busy = login.HashPool(workers=1, backlog=0)
+        busy.slots.acquire()
+        with mock.patch.object(login, '_pool', busy):
+            response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_timed_out_check_keeps_its_slot_until_done(self):
+        import threading
+        from unittest import mock
+        from . import login
+        release = threading.Event()
+        finished = threading.Event()
+
+        def slow_check(password, encoded):
+            release.wait(5)
+            finished.set()
+            return True
+
+        pool = login.HashPool(workers=1, backlog=0, timeout=0.05)
+        self.addCleanup(pool.executor.shutdown)
+        with mock.patch.object(login, 'check_password', slow_check):
+            with self.assertRaises(login.PoolBusy):
+                pool.check('secret', 'hash')
+            # bcrypt is still running on the worker, so its slot is still taken
+            self.assertFalse(pool.slots.acquire(blocking=False))
+            release.set()
+            finished.wait(5)
+            pool.executor.submit(lambda: None).result(5)  # the done callback ran before this job started
+            self.assertTrue(pool.check('secret', 'hash'))
+
+
+class SanitizerTest(TestCase):
+    ALPHABET = list("<>&\"';-/*\n\r\t\x0b\x1c   sScRiIpPtT09.,@!?_()[]{}+=~:%é漢ſ\x00") + [
+        '<script>', '</script>', '<SCRIPT>', '/*', '*/', '--',
+    ]
+
+    def assert_matches_legacy(self, value):
+        from .management.commands.bench_sanitizer import legacy_bleach
+        from .sanitizer import bleachThe, bleach_many
+        for context in ('default', 'url', 'query', 'other'):
+            expected = legacy_bleach(value, context)
+            self.assertEqual(bleachThe(value, context), expected, (value, context))
+            self.assertEqual(bleach_many([value, value], context), [expected, expected], (value, context))
+
+    def test_matches_legacy_on_random_strings(self):
+        try:
+            from hypothesis import given, settings, strategies
+        except ImportError:
+            import random
+            rng = random.Random(18)
+            for _ in range(3000):
+                pieces = [rng.choice(self.ALPHABET) for _ in range(rng.randint(0, 24))]
+                pieces += [chr(rng.randrange(0x110000)) for _ in range(rng.randint(0, 2))]
+                rng.shuffle(pieces)
+                self.assert_matches_legacy(''.join(pieces))
+            return
+
+        @settings(max_examples=2000, deadline=None)
+        @given(strategies.lists(strategies.one_of(strategies.sampled_from(self.ALPHABET), strategies.characters())).map(''.join))
+        def check(value):
+            self.assert_matches_legacy(value)
+        check()
+
+    def test_every_character_is_filtered_like_the_regex(self):
+        for code in list(range(0x3000)) + list(range(0x3000, 0x110000, 997)):
+            self.assert_matches_legacy(f"a{chr(code)} {chr(code)}")
+
+    def test_non_strings(self):
+        from .sanitizer import bleachThe, bleach_many
+        self.assertEqual(bleachThe(None), "")
+        self.assertEqual(bleach_many([None, ' a  b ', 5]), ["", "a b", bleachThe(5)])
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        from .benchmark import build_payload
+        from .ingest import ingest_statistics
+        self.users = [User.objects.create(username=f"exported{i}", email=f"exported{i}@example.com") for i in range(3)]
+        ids = [user.id for user in self.users]
+        ingest_statistics(0, build_payload(ids[:2], 0, 1, 2)['matches'])
+        ingest_statistics(1, build_payload(ids, 1, 3, 2)['matches'])
+        ingest_statistics(0, build_payload(ids[1:], 0, 1, 2)['matches'])
+
+    def ndjson(self, content):
+        import json
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def test_ndjson_per_user_and_cursor(self):
+        response = self.client.get('/api/export/matches/', {'userId': self.users[0].id})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = self.ndjson(b''.join(response.streaming_content))
+        match_ids = {row['matchId'] for row in rows if row['userId'] == self.users[0].id}
+        self.assertEqual({row['matchId'] for row in rows}, match_ids)
+        self.assertEqual([row['statisticId'] for row in rows], sorted(row['statisticId'] for row in rows))
+
+        after = rows[1]['statisticId']
+        rest = self.client.get('/api/export/matches/', {'userId': self.users[0].id, 'after': after})
+        self.assertEqual(self.ndjson(b''.join(rest.streaming_content)), rows[2:])
+
+    async def test_asgi_export_is_an_async_stream(self):
+        from asgiref.sync import sync_to_async
+        expected = await sync_to_async(lambda: b''.join(self.client.get('/api/export/matches/', {'userId': self.users[0].id}).streaming_content))()
+        response = await self.async_client.get('/api/export/matches/', {'userId': self.users[0].id})
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), expected)
+
+    def test_gzipped_csv_per_tournament(self):
+        import csv
+        import gzip
+        from .models import Tournament
+        tournament = Tournament.objects.get()
+        response = self.client.get('/api/export/matches/', {'tournamentId': tournament.id, 'format': 'csv', 'gzip': '1'})
+        text = gzip.decompress(b''.join(response.streaming_content)).decode()
+        records = list(csv.DictReader(text.splitlines()))
+        self.assertEqual(len(records), 6)
+        self.assertEqual({record['tournamentId'] for record in records}, {str(tournament.id)})
+
+    def test_global_export_needs_staff(self):
+        self.assertEqual(self.client.get('/api/export/matches/').status_code, 403)
+        self.assertEqual(self.client.get('/api/export/matches/', {'format': 'xml', 'userId': 1}).status_code, 400)
+
+    def test_staff_tokens_get_global_exports(self):
+        from rest_framework.authtoken.models import Token
+        from .authentication import issue_jwt, token_cache, user_cache
+        token_cache.clear()
+        user_cache.clear()
+        staff = User.objects.create(username="exporter", email="exporter@example.com", is_staff=True)
+        key = Token.objects.create(user=staff).key
+        # validated once through the token cache first, whose users carry no is_staff
+        self.client.get('/api/user/validate/', HTTP_AUTHORIZATION=f'Token {key}')
+        for header in (f'Bearer {issue_jwt(staff)}', f'Token {key}'):
+            response = self.client.get('/api/export/matches/', HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(self.ndjson(b''.join(response.streaming_content))), 10)
+
+        member = Token.objects.create(user=self.users[0]).key
+        self.assertEqual(self.client.get('/api/export/matches/', HTTP_AUTHORIZATION=f'Token {member}').status_code, 403)
+        response = self.client.get('/api/export/matches/', HTTP_AUTHORIZATION='Token nonsense')
+        self.assertEqual((response.status_code, response.json()), (401, {'error': 'Invalid token.'}))
+
+    def test_command_resumes_interrupted_export(self):
+        import os
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        from . import export
+        handle, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+
+        complete = b''.join(export.stream())
+        lines = complete.splitlines(keepends=True)
+        with open(path, 'wb') as f:
+            f.write(b''.join(lines[:3]) + lines[3][:10])  # cut off mid-row
+
+        call_command('export_matches', output=path, resume=True, stdout=StringIO())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), complete)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        from .ingest import ingest_statistics
+        self.user = User.objects.create(username="veteran", email="veteran@example.com")
+        self.other = User.objects.create(username="rookie", email="rookie@example.com")
+
+        def match(month, user_won):
+            stamp = f'2024-{month:02d}-10T12:00:00Z'
+            return {
+                'db': {'datetimeStart': stamp, 'datetimeEnd': stamp, 'tournamentId': None, 'prematureEnd': False},
+                'scores': [
+                    {'userId': self.user.id, 'goalsScored': 3, 'goalsReceived': month % 3, 'datetimeLeft': stamp, 'won': user_won},
+                    {'userId': self.other.id, 'goalsScored': month % 3, 'goalsReceived': 3, 'datetimeLeft': stamp, 'won': not user_won},
+                ],
+            }
+
+        self.match = match
+        ingest_statistics(0, [match(1, True)])
+        ingest_statistics(1, [match(2, False), match(3, True)])  # archived as a whole
+        ingest_statistics(0, [match(4, True)])
+        ingest_statistics(1, [match(5, True), match(8, False)])  # ends after the cutoff, stays hot
+        ingest_statistics(0, [match(9, True)])
+        self.cutoff = datetime.fromisoformat('2024-07-01T00:00:00+00:00')
+
+    def history(self, **params):
+        return self.client.get('/api/statistics/', {'userId': self.user.id, **params})
+
+    def pages(self, limit):
+        pages, before = [], None
+        while True:
+            response = self.history(limit=limit, **({'before': before} if before else {}))
+            pages.append(response.json())
+            before = response.get('X-Next-Before')
+            if before is None:
+                return pages
+
+    def test_archiving_keeps_history_and_aggregates(self):
+        from . import archive, leaderboard, summary
+        from .models import ArchivedMatch, LeaderboardEntry
+        fields = ['user_id'] + leaderboard.ENTRY_FIELDS
+        history, pages = self.history().json(), self.pages(2)
+        ratings = list(LeaderboardEntry.objects.order_by('user_id').values(*fields))
+
+        self.assertEqual(list(archive.run(self.cutoff, batch_size=2)), [(2, 4), (2, 4)])
+        self.assertEqual(ArchivedMatch.objects.count(), 4)
+        self.assertEqual(Match.objects.count(), 3)
+        self.assertEqual(list(archive.run(self.cutoff)), [])
+
+        self.assertEqual(self.history().json(), history)
+        self.assertEqual(self.pages(2), pages)
+        self.assertEqual(summary.check(), [])
+        self.assertEqual(archive.check(), [])
+        leaderboard.rebuild()
+        self.assertEqual(list(LeaderboardEntry.objects.order_by('user_id').values(*fields)), ratings)
+
+        rollup = self.user.archive_rollup
+        self.assertEqual((rollup.games_played, rollup.wins), (4, 3))
+
+    def test_late_ingest_merges_with_archive(self):
+        from . import archive
+        from .ingest import ingest_statistics
+        list(archive.run(self.cutoff))
+        ingest_statistics(0, [self.match(6, True)])
+        ingest_statistics(0, [self.match(2, True)])  # older than archived matches, but hot
+        started = [group['matches'][0]['started'] for group in self.history().json()]
+        self.assertEqual(len(started), 7)
+        self.assertEqual(started, sorted(started, reverse=True))
+
+    def test_archived_tournaments_take_no_new_matches(self):
+        from . import archive
+        from .ingest import IngestError, ingest_statistics
+        from .models import ArchivedMatch
+        list(archive.run(self.cutoff))
+        tournament_id = ArchivedMatch.objects.filter(tournament__isnull=False).values_list('tournament_id', flat=True).first()
+        history = self.history().json()
+
+        late = self.match(10, True)
+        late['db']['tournamentId'] = tournament_id
+        with self.assertRaises(IngestError) as caught:
+            ingest_statistics(0, [late])
+        self.assertEqual(caught.exception.errors, {'tournamentId': [f'Tournament {tournament_id} is archived']})
+        self.assertFalse(Match.objects.filter(tournament_id=tournament_id).exists())
+        self.assertEqual(self.history().json(), history)
+        self.assertEqual(len(self.pages(1)), len(history))
+
+    def test_match_ingested_during_archiving_moves_with_its_tournament(self):
+        from . import archive
+        from .ingest import ingest_statistics
+        from .models import ArchivedMatch
+        match_ids = archive.next_batch(datetime.fromisoformat('2024-12-01T00:00:00+00:00'), batch_size=100)
+        archive.archive_matches(match_ids)
+        match_ids = archive.next_batch(datetime.fromisoformat('2024-12-01T00:00:00+00:00'), batch_size=100)
+        tournament_id = Match.objects.get(id=match_ids[0]).tournament_id
+        late = self.match(10, True)
+        late['db']['tournamentId'] = tournament_id
+        ingest_statistics(0, [late])  # after the batch was picked
+
+        archive.archive_matches(match_ids)
+        self.assertFalse(Match.objects.filter(tournament_id=tournament_id).exists())
+        self.assertEqual(ArchivedMatch.objects.filter(tournament_id=tournament_id).count(), 3)
+        self.assertEqual(archive.check(), [])
+
+    def test_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('archive_matches', older_than_days=0, stdout=out)
+        self.assertIn('Archived 7 matches and 14 statistics', out.getvalue())
+        self.assertEqual(Statistic.objects.count(), 0)
+        call_command('archive_matches', check=True, stdout=out)
+
+
+class AvatarTest(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        from .authentication import issue_jwt, user_cache
+        user_cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings = override_settings(MEDIA_ROOT=media, AVATAR_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.media = media
+        self.users = [User.objects.create(username=f"pictured{i}", email=f"pictured{i}@example.com") for i in range(2)]
+        self.headers = [{'HTTP_AUTHORIZATION': f'Bearer {issue_jwt(user)}'} for user in self.users]
+
+    def image(self, name='me.png', size=(300, 200)):
+        from io import BytesIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buffer = BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def files(self):
+        import os
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media)
+            for root, _, names in os.walk(self.media) for name in names
+        )
+
+    def test_upload_renders_variants_and_dedups(self):
+        from PIL import Image
+        from django.core.files.storage import default_storage
+        response = self.client.post('/api/user/update/', {'avatar': self.image()}, **self.headers[0])
+        self.assertEqual(response.status_code, 200)
+        self.users[0].refresh_from_db()
+        digest = self.users[0].avatar.name.split('/')[1]
+        self.assertEqual(self.users[0].avatar.name, f'avatars/{digest}/256.webp')
+        for size in (64, 128, 256):
+            with default_storage.open(f'avatars/{digest}/{size}.webp') as f:
+                self.assertEqual(Image.open(f).size, (size, size))
+        files = self.files()
+        self.assertEqual(len(files), 4)
+
+        # Same picture from another user: no new files, variants right away
+        response = self.client.post('/api/user/update/', {'avatar': self.image('copy.png')}, **self.headers[1])
+        self.assertEqual(sorted(response.json()['avatars']), ['128', '256', '64'])
+        self.assertTrue(response.json()['avatars']['64'].endswith(f'/media/avatars/{digest}/64.webp'))
+        self.assertEqual(self.files(), files)
+
+    def test_rejects_non_images(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        upload = SimpleUploadedFile('evil.png', b'<script>', content_type='image/png')
+        response = self.client.post('/api/user/update/', {'avatar': upload}, **self.headers[0])
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Not an image'}))
+        self.assertEqual(self.files(), [])
+
+    def test_backfill_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        user = self.users[0]
+        user.avatar = self.image('legacy.png', (80, 120))
+        user.save()
+        out = StringIO()
+        call_command('process_avatars', stdout=out)
+        call_command('process_avatars', stdout=out)
+        user.refresh_from_db()
+        self.assertTrue(user.avatar.name.endswith('/256.webp'))
+        self.assertIn('Processed 1 avatars, 0 already done', out.getvalue())
+        self.assertIn('Processed 0 avatars, 1 already done', out.getvalue())
+
+
+def serve_stub(handler):
+    """Run a local HTTP server for the handler class in a thread. Returns (server, base URL)."""
+    import threading
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class AvatarMirrorTest(TestCase):
+    """api.mirror against a stub image server on localhost."""
+
+    @classmethod
+    def setUpClass(cls):
+        from http.server import BaseHTTPRequestHandler
+        from io import BytesIO
+        from PIL import Image
+        super().setUpClass()
+        cls.hits = []
+        cls.images = {}
+        for color in ('red', 'blue', 'green'):
+            buffer = BytesIO()
+            Image.new('RGB', (400, 300), color).save(buffer, 'JPEG')
+            cls.images[f'/{color}.jpg'] = buffer.getvalue()
+
+        hits, images = cls.hits, cls.images
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits.append((self.path, self.headers.get('If-None-Match')))
+                if self.path not in images:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(images[self.path])))
+                self.end_headers()
+                self.wfile.write(images[self.path])
+
+            def log_message(self, *args):
+                pass
+
+        cls.server, cls.base = serve_stub(Handler)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test import override_settings
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings = override_settings(MEDIA_ROOT=media, MIRROR_ALLOWED_HOSTS=['127.0.0.1'])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.hits.clear()
+
+    def register(self, name):
+        from . import mirror
+        return mirror.register(f'{self.base}/{name}')
+
+    def test_fetches_once_then_serves_locally(self):
+        from PIL import Image
+        from io import BytesIO
+        path = self.register('red.jpg')
+        first = self.client.get(path)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Content-Type'], 'image/webp')
+        self.assertIn('max-age=', first['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(first.content)).size, (256, 256))
+
+        second = self.client.get(path)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        self.assertEqual(len(self.hits), 1)
+
+    def test_upstream_wait_is_off_the_sync_thread(self):
+        import threading
+        from unittest import mock
+        from . import mirror
+        threads = []
+
+        def fetch(entry):
+            threads.append(threading.current_thread())
+            return mirror_fetch(entry)
+
+        mirror_fetch = mirror.fetch
+        with mock.patch.object(mirror, 'fetch', fetch):
+            self.assertEqual(self.client.get(self.register('green.jpg')).status_code, 200)
+        # The test client runs thread-sensitive code on the main thread
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_revalidates_conditionally_and_serves_stale(self):
+        from django.test import override_settings
+        from .models import RemoteAvatar
+        path = self.register('blue.jpg')
+        content = self.client.get(path).content
+        with override_settings(MIRROR_REVALIDATE=0):
+            self.assertEqual(self.client.get(path).content, content)
+            self.assertEqual(self.hits[-1], ('/blue.jpg', '"v1"'))
+            RemoteAvatar.objects.update(url=f'{self.base}/gone.jpg')
+            with self.assertLogs('api.mirror', 'WARNING'):
+                self.assertEqual(self.client.get(path).content, content)
+
+    def test_unknown_hosts_and_failures(self):
+        from . import mirror
+        self.assertIsNone(mirror.register('https://example.com/me.jpg'))
+        self.assertEqual(self.client.get('/api/avatars/remote/nope/').status_code, 404)
+        with self.assertLogs('api.mirror', 'WARNING'):
+            response = self.client.get(self.register('missing.jpg'))
+        self.assertEqual((response.status_code, response['Location']), (302, f'{self.base}/missing.jpg'))
+
+    def test_evicts_least_recently_used(self):
+        from django.test import override_settings
+        from .models import RemoteAvatar
+        paths = [self.register(name) for name in ('red.jpg', 'blue.jpg', 'green.jpg')]
+        with override_settings(MIRROR_MAX_ENTRIES=2):
+            for path in paths:
+                self.client.get(path)
+        self.assertEqual(RemoteAvatar.objects.exclude(file='').count(), 2)
+        self.assertEqual(RemoteAvatar.objects.get(file='').url, f'{self.base}/red.jpg')
+        self.client.get(paths[0])
+        self.assertEqual(len(self.hits), 4)
+
+    def test_eviction_reads_only_the_overflow(self):
+        from django.test import override_settings
+        from . import mirror
+        from .models import RemoteAvatar
+        for name in ('red.jpg', 'blue.jpg', 'green.jpg'):
+            self.client.get(self.register(name))
+        with self.assertNumQueries(1):
+            self.assertEqual(mirror.evict(), 0)
+        # the totals, the oldest copy (the chunked read stops there), one UPDATE
+        with override_settings(MIRROR_MAX_ENTRIES=2), self.assertNumQueries(3):
+            self.assertEqual(mirror.evict(), 1)
+        self.assertEqual(RemoteAvatar.objects.get(file='').url, f'{self.base}/red.jpg')
+
+    def test_fetch_locks_do_not_grow(self):
+        from . import mirror
+        locks = list(mirror._locks)
+        paths = [self.register(name) for name in ('red.jpg', 'blue.jpg', 'green.jpg')]
+        for path in paths:
+            self.client.get(path)
+        self.assertEqual(mirror._locks, locks)
+        key = paths[0].split('/')[-2]
+        self.assertIs(mirror._lock_for(key), mirror._lock_for(key))
+
+
+class OAuthClientTest(TestCase):
+    """api.oauth42 and the 42 callback against a stub OAuth provider on localhost."""
+
+    @classmethod
+    def setUpClass(cls):
+        import json
+        import time
+        from http.server import BaseHTTPRequestHandler
+        super().setUpClass()
+        cls.hits = []
+        cls.script = {}  # path -> [(status, delay)] served before the normal answer
+        hits, script = cls.hits, cls.script
+        answers = {
+            '/oauth/token': {'access_token': 'stub-token'},
+            '/v2/me': {'login': 'student', 'email': 'student@42.fr', 'image': {'link': None}},
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def answer(self):
+                path = self.path.split('?')[0]
+                length = int(self.headers.get('Content-Length') or 0)
+                hits.append((self.command, path, self.rfile.read(length).decode()))
+                status, delay = script[path].pop(0) if script.get(path) else (200, 0)
+                time.sleep(delay)
+                body = json.dumps(answers.get(path, {}) if status == 200 else {'error': 'stub'}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:  # the client timed out and left
+                    pass
+
+            do_GET = do_POST = answer
+
+            def log_message(self, *args):
+                pass
+
+        cls.server, cls.base = serve_stub(Handler)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        from django.test import override_settings
+        from . import oauth42
+        provider = {'BASE_DOMAIN': self.base, 'CLIENT_ID': 'uid', 'CLIENT_SECRET': 'secret'}
+        settings = override_settings(
+            OAUTH2_PROVIDER=provider, OAUTH_BACKOFF=0, OAUTH_RETRIES=1,
+            OAUTH_TIMEOUT=(1, 0.3), OAUTH_BREAKER_THRESHOLD=2, OAUTH_BREAKER_RESET=60,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        oauth42.reset()
+        self.addCleanup(oauth42.reset)
+        self.hits.clear()
+        self.script.clear()
+
+    def callback(self):
+        return self.client.get('/api/42/login/callback/', {'code': 'abc'})
+
+    def paths(self):
+        return [path for _, path, _ in self.hits]
+
+    def test_callback_logs_in(self):
+        response = self.callback()
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('jwtToken', response.cookies)
+        self.assertTrue(User.objects.filter(username='student').exists())
+        self.assertEqual(self.paths(), ['/oauth/token', '/v2/me'])
+        self.assertIn('code=abc', self.hits[0][2])
+
+    def test_only_the_profile_request_is_retried(self):
+        self.script['/v2/me'] = [(502, 0)]
+        self.assertEqual(self.callback().status_code, 302)
+        self.assertEqual(self.paths(), ['/oauth/token', '/v2/me', '/v2/me'])
+
+        self.hits.clear()
+        self.script['/oauth/token'] = [(502, 0)]
+        response = self.callback()
+        self.assertEqual((response.status_code, response.json()), (502, {'error': 'Failed to obtain access token'}))
+        self.assertEqual(self.paths(), ['/oauth/token'])
+
+    def test_read_timeout(self):
+        self.script['/v2/me'] = [(200, 0.6), (200, 0.6)]
+        response = self.callback()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.paths(), ['/oauth/token', '/v2/me', '/v2/me'])
+
+    def test_circuit_breaker(self):
+        from . import oauth42
+        self.script['/oauth/token'] = [(500, 0), (500, 0)]
+        with self.assertLogs('api.oauth42', 'WARNING'):
+            self.assertEqual(self.callback().status_code, 500)
+            self.assertEqual(self.callback().status_code, 500)
+
+        # Open: no upstream call at all
+        response = self.callback()
+        self.assertEqual((response.status_code, response.json()), (503, {'error': '42 login is temporarily unavailable'}))
+        self.assertEqual(len(self.hits), 2)
+
+        # After the reset timeout one trial call goes through and closes it
+        oauth42.breaker().opened_at -= 60
+        self.assertEqual(self.callback().status_code, 302)
+        self.assertEqual(oauth42.breaker().state, 'closed')
+
+    def test_async_fallback_without_httpx(self):
+        import asyncio
+        from unittest import mock
+        from . import oauth42
+        self.script['/v2/me'] = [(502, 0)]
+        with mock.patch.object(oauth42, 'httpx', None):
+            profile = asyncio.run(oauth42.afetch_profile('stub-token'))
+        self.assertEqual(profile['login'], 'student')
+        self.assertEqual(self.paths(), ['/v2/me', '/v2/me'])
+
+    def run_httpx(self, coroutine):
+        """Run a coroutine function on the httpx client, the one production uses, and close it afterwards."""
+        import asyncio
+        from . import oauth42
+        if oauth42.httpx is None:
+            self.skipTest('httpx is not installed')
+
+        async def run():
+            try:
+                return await coroutine()
+            finally:
+                await oauth42.async_client().aclose()
+
+        return asyncio.run(run())
+
+    def test_httpx_retries(self):
+        import socket
+        from unittest import mock
+        from django.test import override_settings
+        from . import oauth42
+        # A token POST that timed out reading may have been used: not retried
+        self.script['/oauth/token'] = [(200, 0.6)]
+        with self.assertRaises(oauth42.ProviderUnavailable):
+            self.run_httpx(lambda: oauth42.aexchange_code('abc', 'https://localhost/cb'))
+        self.assertEqual(self.paths(), ['/oauth/token'])
+
+        # The profile GET is
+        self.hits.clear()
+        self.script['/v2/me'] = [(200, 0.6)]
+        profile = self.run_httpx(lambda: oauth42.afetch_profile('stub-token'))
+        self.assertEqual(profile['login'], 'student')
+        self.assertEqual(self.paths(), ['/v2/me', '/v2/me'])
+
+        # So is a token POST that never reached the provider
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            closed = f'http://127.0.0.1:{s.getsockname()[1]}'
+        provider = {'BASE_DOMAIN': closed, 'CLIENT_ID': 'uid', 'CLIENT_SECRET': 'secret'}
+        with override_settings(OAUTH2_PROVIDER=provider), mock.patch.object(oauth42, 'backoff', return_value=0) as backoff:
+            with self.assertRaises(oauth42.ProviderUnavailable):
+                self.run_httpx(lambda: oauth42.aexchange_code('abc', 'https://localhost/cb'))
+        self.assertEqual(backoff.call_count, 1)
+
+    def test_httpx_client_errors_pass_through(self):
+        from . import oauth42
+        self.script['/oauth/token'] = [(401, 0)]
+        with self.assertRaises(oauth42.OAuthError) as raised:
+            self.run_httpx(lambda: oauth42.aexchange_code('abc', 'https://localhost/cb'))
+        self.assertEqual(raised.exception.status, 401)
+        self.assertEqual(self.paths(), ['/oauth/token'])
+        self.assertEqual((oauth42.breaker().state, oauth42.breaker().failures), ('closed', 0))
+
+    def test_httpx_circuit_breaker(self):
+        from . import oauth42
+        self.script['/oauth/token'] = [(500, 0), (500, 0)]
+        with self.assertLogs('api.oauth42', 'WARNING'):
+            for _ in range(2):
+                with self.assertRaises(oauth42.OAuthError):
+                    self.run_httpx(lambda: oauth42.aexchange_code('abc', 'https://localhost/cb'))
+        with self.assertRaises(oauth42.ProviderUnavailable):
+            self.run_httpx(lambda: oauth42.aexchange_code('abc', 'https://localhost/cb'))
+        self.assertEqual(len(self.hits), 2)
+
+    def test_interrupted_trial_frees_the_breaker(self):
+        import asyncio
+        from django.test import override_settings
+        from . import oauth42
+        circuit = oauth42.breaker()
+        circuit.opened_at = circuit.clock() - 60
+
+        # Cancelled while waiting on the provider
+        self.script['/v2/me'] = [(200, 0.6)]
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_httpx(lambda: asyncio.wait_for(oauth42.afetch_profile('stub-token'), 0.1))
+        self.assertEqual(circuit.allow(), 'trial')
+        circuit.end_trial()
+
+        # Failed with something that is not an HTTP error
+        provider = {'BASE_DOMAIN': 'http://[::1', 'CLIENT_ID': 'uid', 'CLIENT_SECRET': 'secret'}
+        with override_settings(OAUTH2_PROVIDER=provider):
+            with self.assertRaises(oauth42.httpx.InvalidURL):
+                self.run_httpx(lambda: oauth42.afetch_profile('stub-token'))
+        self.assertEqual(circuit.allow(), 'trial')
+
+
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        from rest_framework.authtoken.models import Token
+        from .authentication import token_cache
+        token_cache.clear()
+        self.user = User.objects.create(username="async", email="async@example.com", status=False)
+        self.token = Token.objects.create(user=self.user)
+        self.headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_routed_when_enabled(self):
+        from django.conf import settings
+        from django.urls import resolve
+        from . import views
+        if not settings.ASYNC_VIEWS:
+            self.skipTest('ASYNC_VIEWS is off')
+        self.assertIs(resolve('/api/user/validate/').func, views.validate_token_async)
+        self.assertIs(resolve('/api/42/login/callback/').func, views.login_with_42_callback_async)
+
+    def test_validate_token(self):
+        response = self.client.get('/api/user/validate/', **self.headers)
+        self.assertEqual(response.json(), {'tid': self.user.id, 'username': 'async'})
+        self.assertEqual(self.client.get('/api/user/validate/').json(), {'tid': None, 'username': ''})
+
+        response = self.client.get('/api/user/validate/', HTTP_AUTHORIZATION='Token nope')
+        self.assertEqual((response.status_code, response.json()), (401, {'detail': 'Invalid token.'}))
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+        self.assertEqual(self.client.post('/api/user/validate/', **self.headers).status_code, 405)
+
+    def test_user_status(self):
+        response = self.client.get('/api/user/status/', {'status': 'true'}, **self.headers)
+        self.assertEqual(response.json(), {'success': True})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.status)
+
+    def test_statistics_post_errors(self):
+        response = self.client.post('/api/statistics/', '{', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/statistics/', {'matches': []}, content_type='application/json')
+        self.assertEqual(response.json(), {'error': 'Type is required'})
+
+
+class TwoFactorQRTest(TestCase):
+    def setUp(self):
+        from django.test import override_settings
+        from .qr import qr_cache
+        settings = override_settings(RATE_LIMIT_ENABLED=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        qr_cache.clear()
+        self.user = User.objects.create(username="qr", email="qr@example.com")
+
+    def generate(self, **data):
+        return self.client.post('/api/2fa/generate/', {'username': 'qr', **data})
+
+    def test_render_is_cached_per_device(self):
+        from django_otp.plugins.otp_totp.models import TOTPDevice
+        from .qr import qr_cache
+        first = self.generate().json()
+        self.assertTrue(first['qr_code'].startswith('data:image/png;base64,'))
+        self.assertEqual(self.generate().json(), first)
+        self.assertEqual(qr_cache.stats()['hits'], 1)
+
+        # A replaced device is rendered afresh and the old render is dropped
+        TOTPDevice.objects.filter(user=self.user).delete()
+        self.assertEqual(len(qr_cache), 0)
+        self.assertNotEqual(self.generate().json()['qr_code'], first['qr_code'])
+
+    def test_svg(self):
+        from urllib.parse import unquote
+        qr_code = self.generate(format='svg').json()['qr_code']
+        self.assertTrue(qr_code.startswith('data:image/svg+xml,'))
+        self.assertIn("<path stroke='black' d='M5 5.5h7", unquote(qr_code))
+        self.assertEqual(self.generate(format='gif').status_code, 400)
@@ -1,26 +1,44 @@
+from django.conf import settings
 from django.urls import path, include, re_path
 from oauth2_provider import urls as oauth2_urls
 from . import views
 
+
+def either(sync_view, async_view):
+    """The async version of a view when ASYNC_VIEWS is on (see the end of views.py)."""
+    return async_view if getattr(settings, 'ASYNC_VIEWS', False) else sync_view
+
+
 urlpatterns = [
     path('users/', views.user_view, name='user_view'),
 	path('users/<str:username>/', views.user_view, name='user_view_by_username'),
 	path('user/data/', views.get_user_data, name='user_data'),
-    path('user/validate/', views.validate_token_view, name='validate_token_view'),
-	path('user/status/', views.user_status_view, name='user_status_view'),
-    path('statistics/', views.statistic_view, name='statistic_view'),
+    path('user/validate/', either(views.validate_token_view, views.validate_token_async), name='validate_token_view'),
+    path('user/validate/cache/', views.token_cache_view, name='token_cache_view'),
+	path('user/status/', either(views.user_status_view, views.user_status_async), name='user_status_view'),
+	path('user/status/bulk/', views.user_status_bulk_view, name='user_status_bulk_view'),
+    path('statistics/', either(views.statistic_view, views.statistic_async), name='statistic_view'),
+    path('statistics/summary/', views.statistic_summary_view, name='statistic_summary_view'),
+    path('avatars/remote/<str:key>/', views.remote_avatar_view, name='remote_avatar_view'),
+    path('export/matches/', views.export_matches_view, name='export_matches_view'),
+    path('leaderboard/', views.leaderboard_view, name='leaderboard_view'),
+    path('leaderboard/rank/', views.leaderboard_rank_view, name='leaderboard_rank_view'),
+    path('leaderboard/around/', views.leaderboard_around_view, name='leaderboard_around_view'),
     path('login/', views.login_view, name='login_view'),
 	path('auth/42/login/', views.login_with_42, name='login_with_42'),
-    path('42/login/callback/', views.login_with_42_callback, name='login_with_42_callback'),
+    path('42/login/callback/', either(views.login_with_42_callback, views.login_with_42_callback_async), name='login_with_42_callback'),
 	path('2fa/generate/', views.setup_2fa, name='2fa_setup'),
 	path('2fa/enable/', views.enable_2fa, name='2fa_enable'),
 	path('logout/', views.logout_view, name='logout_view'),
+    path('metrics/', views.metrics_view, name='metrics_view'),
 	path('o/', include(oauth2_urls)),
 ]
 
 # Friend-related endpoints
 urlpatterns += [
     path('friend/', views.fetch_friends, name='fetch_friends'),
+    path('friend/events/', views.friend_events, name='friend_events'),
+    path('friend/events/ticket/', views.friend_events_ticket, name='friend_events_ticket'),
     path('user/search/', views.search_users, name='search_users'),
     re_path(r'^api/user/search/?$', views.search_users, name='search_users'),
     path('friend/add/', views.add_friend, name='add_friend'),
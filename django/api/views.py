@@ -1,36 +1,52 @@
-import requests
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.authtoken.models import Token
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from .models import User, Match, Statistic, Friend, Tournament
-from .serializers import UserSerializer, MatchSerializer, StatisticSerializer, FriendSerializer, TournamentSerializer
+from .models import User, Match, Statistic, Friend, Tournament, LeaderboardEntry, UserStatsSummary, RemoteAvatar
+from .serializers import UserSerializer, MatchSerializer, StatisticSerializer, FriendSerializer, PresenceTransitionSerializer
 from django.contrib.auth.hashers import make_password, check_password
 from django.shortcuts import get_object_or_404, redirect
-from django.http import JsonResponse, HttpRequest, HttpResponseRedirect
+from django.http import JsonResponse, HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed, HttpResponseNotModified, StreamingHttpResponse, Http404
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.http import require_GET
 from django.utils.timezone import now
 
 from django.conf import settings
 from django_otp.plugins.otp_totp.models import TOTPDevice
-from rest_framework_simplejwt.tokens import RefreshToken
-import qrcode
-import io
-import base64
-from django.conf import settings
 
 import json
-import jwt
-from rest_framework.exceptions import PermissionDenied
-from .sanitizer import bleachThe
-from rest_framework.throttling import AnonRateThrottle
-from rest_framework.decorators import throttle_classes
+from .sanitizer import bleachThe, bleach_many
+from .ingest import ingest_statistics, IngestError
+from .history import match_history, format_cursor, parse_cursor
+from .fastserializers import user_serializer, friend_serializer, render as render_json
+from . import leaderboard, summary, presence, events, search, login, export, avatars, mirror, oauth42, qr
+from rest_framework.decorators import throttle_classes, authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from .authentication import CachedTokenAuthentication, JWTAuthentication, token_cache, invalidate_token, invalidate_user, issue_jwt, decode_jwt, resolve_user, atoken_user, IsInternalService, jwt_user_id, revoke_jwts
+from .middleware import session_exempt
+from .metrics import registry
+from .ratelimit import LoginThrottle, TwoFactorThrottle, SearchThrottle, SignupThrottle
+from asgiref.sync import sync_to_async
 import logging
 
 
 djangoPort = 8000
 reactPort = 3000
 
+MAX_HISTORY_PAGE_SIZE = 100
+MAX_LEADERBOARD_PAGE_SIZE = 100
+MAX_USER_PAGE_SIZE = 200
+
+# Fields GET /api/users/ may return; the password hash is never listed
+USER_LIST_FIELDS = {
+    'id', 'username', 'email', 'status', 'wins', 'losses', 'avatar', 'last_online',
+    'last_login', 'is_active', 'is_staff', 'is_superuser', 'has_2fa', 'groups', 'user_permissions',
+}
+USER_LIST_DEFAULT_FIELDS = ['id', 'username', 'status', 'avatar', 'last_online']
+
 def get_scheme(request):
     protocol = 'https:'
     # protocol = 'http:'
@@ -44,8 +60,7 @@ def get_scheme(request):
 logger = logging.getLogger(__name__)
 
 @api_view(['POST'])
-@throttle_classes([AnonRateThrottle])  # rate-limiting for anons
-# @throttle_classes([UserRateThrottle]) # or should we add it for authenticated users?
+@throttle_classes([TwoFactorThrottle])
 def setup_2fa(request):
     try:
         username = request.data['username']
@@ -54,6 +69,10 @@ def setup_2fa(request):
             logger.warning("Setup 2FA request missing username.")
             return Response({"error": "Username is required"}, status=400)
 
+        qr_format = request.data.get('format', 'png')
+        if qr_format not in qr.FORMATS:
+            return Response({"error": f"format must be one of {', '.join(qr.FORMATS)}"}, status=400)
+
         user = get_object_or_404(User, username=username)
 
         existing_device = TOTPDevice.objects.filter(
@@ -70,29 +89,19 @@ def setup_2fa(request):
             device = TOTPDevice.objects.create(
                 user=user, name=username, confirmed=False)
 
-        try:
-            # Generate a QR code for the TOTP device
-            qr_code_data = device.config_url
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(qr_code_data)
-            qr.make(fit=True)
-
-            # Convert QR code to an image
-            img = io.BytesIO()
-            qr.make_image(fill="black", back_color="white").save(
-                img, format="PNG")
-            img.seek(0)
-
-            # Encode QR code as Base64
-            qr_code_base64 = base64.b64encode(img.getvalue()).decode()
+        # config_url needs the username; the device belongs to the user we already have
+        device.user = user
 
+        try:
+            # Rendered once per device and format, see api.qr
+            qr_code = qr.render(device.config_url, qr_format, device)
         except Exception as e:
             logger.error("QR Code generation failed: %s", str(e), exc_info=True)
             return Response({"error": "Failed to generate QR code"}, status=500)
 
         # Return the QR code as a response
         return Response({
-            "qr_code": f"data:image/png;base64,{qr_code_base64}",
+            "qr_code": qr_code,
             "manual_entry_key": device.key
         }, status=200)
 
@@ -168,120 +177,88 @@ def login_with_42_callback(request):
         if not code:
             return JsonResponse({'error': 'Missing authorization code'}, status=400)
 
-        access_token_url = "https://api.intra.42.fr/oauth/token"
-        data = {
-            'grant_type': 'authorization_code',
-            'client_id': settings.OAUTH2_PROVIDER['CLIENT_ID'],
-            'client_secret': settings.OAUTH2_PROVIDER['CLIENT_SECRET'],
-            'code': code,
-            # 'redirect_uri': 'http://localhost:8000/api/42/login/callback/',
-            # 'redirect_uri': f"{protocol}//{hostname}:{djangoPort}/api/42/login/callback/",
-            'redirect_uri': f"{protocol}//{hostname}/api/42/login/callback/",
-        }
+        # 'redirect_uri': 'http://localhost:8000/api/42/login/callback/',
+        # 'redirect_uri': f"{protocol}//{hostname}:{djangoPort}/api/42/login/callback/",
+        redirect_uri = f"{protocol}//{hostname}/api/42/login/callback/"
 
-        # Post request to get the access token
-        token_response = requests.post(access_token_url, data=data)
-        if not token_response.ok:
-            return JsonResponse({'error': 'Failed to obtain access token'}, status=token_response.status_code)
-
-        token_data = token_response.json()
-        access_token = token_data.get('access_token')
-        if not access_token:
-            return JsonResponse({'error': 'Missing access token in response'}, status=400)
-
-        user_info_url = 'https://api.intra.42.fr/v2/me'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        user_info_response = requests.get(user_info_url, headers=headers)
-        if not user_info_response.ok:
-            return JsonResponse({'error': 'Failed to fetch user information'},
-                                status=user_info_response.status_code)
-
-        user_info_data = user_info_response.json()
-        username = bleachThe(user_info_data.get('login'))
-        email = bleachThe(user_info_data.get('email'))
-        api_avatar = user_info_data.get('image', {}).get('link', None)
-        # Empty password as it is OAuth-based login
-        password = make_password('')
-
-        user = User.objects.filter(username=username).first()
-        if not user:
-            user_data = {'email': email,
-                         'username': username, 'password': password}
-            serializer = UserSerializer(data=user_data)
-            if serializer.is_valid():
-                user = serializer.save()
-            else:
-                return JsonResponse({'error': 'User creation failed',
-                                    'details': serializer.errors}, status=400)
-
-        # Create or retrieve the token for the user
-        token, _ = Token.objects.get_or_create(user=user)
-        payload = {
-            'username': user.username,
-            'email': user.email,
-            # Add other necessary claims here (e.g., username, roles)
-        }
-        jwt_token = jwt.encode(
-            payload,
-            settings.SECRET_KEY,
-            algorithm='HS256'
-        )
-
-        # Construct the full avatar URL
-        if user.avatar and user.avatar.url:
-            avatar_url = f"{protocol}//{hostname}{user.avatar.url}"
-            # avatar_url = f"{protocol}//{hostname}:{djangoPort}{user.avatar.url}"
-        elif api_avatar and str(api_avatar).startswith("http"):
-            avatar_url = api_avatar
-        else:
-            avatar_url = None
+        try:
+            access_token = oauth42.exchange_code(code, redirect_uri)
+            user_info_data = oauth42.fetch_profile(access_token)
+        except oauth42.OAuthError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
 
-        request.session.flush()
-        request.session['user_data'] = {
-            'username': username,
-            'email': email,
-            'avatar': avatar_url,
-            'token': token.key,
-            'jwtToken': jwt_token,
-        }
-        request.session.modified = True
+        return finish_42_login(request, user_info_data)
 
-        response = HttpResponseRedirect(f"{protocol}//{hostname}")
+    return redirect(f"{protocol}//{hostname}?")
 
-        response.set_cookie('authToken', token.key)
-        response.set_cookie('jwtToken', jwt_token)
 
-        return response
+def finish_42_login(request, user_info_data):
+    """Find or create the user of a 42 profile, log them in and redirect to the frontend."""
+    protocol, hostname = get_scheme(request)
 
-    return redirect(f"{protocol}//{hostname}?")
+    username = bleachThe(user_info_data.get('login'))
+    email = bleachThe(user_info_data.get('email'))
+    api_avatar = user_info_data.get('image', {}).get('link', None)
+    # Empty password as it is OAuth-based login
+    password = make_password('')
+
+    user = User.objects.filter(username=username).first()
+    if not user:
+        user_data = {'email': email,
+                     'username': username, 'password': password}
+        serializer = UserSerializer(data=user_data)
+        if serializer.is_valid():
+            user = serializer.save()
+        else:
+            return JsonResponse({'error': 'User creation failed',
+                                'details': serializer.errors}, status=400)
+
+    # Create or retrieve the token for the user
+    token, _ = Token.objects.get_or_create(user=user)
+    jwt_token = issue_jwt(user)
+
+    # Construct the full avatar URL
+    if user.avatar and user.avatar.url:
+        avatar_url = f"{protocol}//{hostname}{user.avatar.url}"
+        # avatar_url = f"{protocol}//{hostname}:{djangoPort}{user.avatar.url}"
+    elif api_avatar and str(api_avatar).startswith("http"):
+        # Served through the local mirror when the host is allowed, see remote_avatar_view
+        mirrored = mirror.register(api_avatar)
+        avatar_url = f"{protocol}//{hostname}{mirrored}" if mirrored else api_avatar
+    else:
+        avatar_url = None
 
+    request.session.flush()
+    request.session['user_data'] = {
+        'username': username,
+        'email': email,
+        'avatar': avatar_url,
+        'token': token.key,
+        'jwtToken': jwt_token,
+    }
+    request.session.modified = True
 
-@api_view(['GET'])
-def get_user_data(request):
-    authorization_header = request.headers.get('Authorization')
-    if not authorization_header:
-        return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
+    response = HttpResponseRedirect(f"{protocol}//{hostname}")
+
+    response.set_cookie('authToken', token.key)
+    response.set_cookie('jwtToken', jwt_token)
+
+    return response
 
-    # Extract the JWT token from the header
-    token = request.headers['Authorization'].split(' ')[1]
-    try:
-        payload = jwt.decode(
-            token,
-            settings.SECRET_KEY,
-            algorithms=['HS256']  # Adjust algorithm as needed
-        )
-    except jwt.ExpiredSignatureError:
-        return JsonResponse({'error': 'Token expired.'}, status=401)
-    except jwt.InvalidTokenError:
-        return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
 
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def get_user_data(request):
     user_data = request.session.get('user_data')
     if not user_data:
         return JsonResponse({'error': 'No user data found', 'session': request.session.get('user_data')}, status=404)
     return JsonResponse(user_data)
 
 
+@session_exempt
 @api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication])
 def validate_token_view(request):
     try:
         user = request.user
@@ -295,6 +272,7 @@ def validate_token_view(request):
 
 
 @api_view(['POST'])
+@throttle_classes([LoginThrottle])
 def login_view(request):
     # global djangoPort
     protocol, hostname = get_scheme(request)
@@ -303,43 +281,31 @@ def login_view(request):
         try:
             username = bleachThe(request.data['username'].strip())
             password = request.data['password'].strip()
-            user = get_object_or_404(User, username=username)
-
-            if check_password(password, user.password):
-                if user.has_2fa:
-                    totp_device = TOTPDevice.objects.filter(
-                        user=user, confirmed=True).first()
-                    if not totp_device:
-                        # Retrieve the unconfirmed TOTP device
-                        totp_device = TOTPDevice.objects.filter(
-                            user=user, confirmed=False).first()
-                        if not totp_device:
-                            return Response({'error': 'No 2FA device found'}, status=status.HTTP_401_UNAUTHORIZED)
-                        totp_device.confirmed = True
-                        totp_device.save()
-
-                    if totp_device:  # If user has a TOTP device, validate the token
-                        otp_token = request.data.get('otp_token')
-                        if not otp_token:  # If no 2FA token is provided, return an error
-                            return Response({'error': '2FA token is required'}, status=status.HTTP_401_UNAUTHORIZED)
-                        # Validate the token
-                        if not totp_device.verify_token(otp_token):
-                            return Response({'error': 'Invalid 2FA token'}, status=status.HTTP_401_UNAUTHORIZED)
-
-            token, _ = Token.objects.get_or_create(
-                user=user)  # Efficient token retrieval
-
-            payload = {
-                'username': user.username,
-                'email': user.email,
-                # Add other necessary claims here (e.g., username, roles)
-            }
-
-            jwtToken = jwt.encode(
-                payload,
-                settings.SECRET_KEY,
-                algorithm='HS256'
-            )
+            user = login.load_user(username)
+            if user is None:
+                return Response({'error': 'Invalid credentials'}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                password_ok = login.pool().check(password, user.password)
+            except login.PoolBusy:
+                return Response({'error': 'Too many logins, try again'}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+            if not password_ok:
+                return Response({'error': 'Invalid credentials'}, status=status.HTTP_400_BAD_REQUEST)
+
+            if user.has_2fa:
+                totp_device = login.login_device(user)
+                if not totp_device:
+                    return Response({'error': 'No 2FA device found'}, status=status.HTTP_401_UNAUTHORIZED)
+                otp_token = request.data.get('otp_token')
+                if not otp_token:  # If no 2FA token is provided, return an error
+                    return Response({'error': '2FA token is required'}, status=status.HTTP_401_UNAUTHORIZED)
+                # Validate the token
+                if not totp_device.verify_token(otp_token):
+                    return Response({'error': 'Invalid 2FA token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+            token = login.auth_token(user)
+
+            jwtToken = issue_jwt(user)
             serializer = UserSerializer(user)
 
             avatar_url = user.avatar.url if user.avatar else None
@@ -348,14 +314,14 @@ def login_view(request):
                 avatar_url = f"{protocol}//{hostname}{avatar_url}"
                 # avatar_url = f"{protocol}//{hostname}:{djangoPort}{avatar_url}"
 
+            safe_username, safe_email = bleach_many([user.username, user.email])
             request.session['user_data'] = {
-                'username': bleachThe(user.username),
-                'email': bleachThe(user.email),
+                'username': safe_username,
+                'email': safe_email,
                 'avatar': avatar_url,
                 'token': token.key,
                 'jwtToken': jwtToken,
             }
-            request.session.save()
 
             return Response({
                 'user': serializer.data,
@@ -370,16 +336,36 @@ def login_view(request):
 
 
 @api_view(['GET', 'POST'])
+@throttle_classes([SignupThrottle])
 def user_view(request, username=None):
     if request.method == 'GET':
         if username:
-            user = get_object_or_404(User, username=username)
-            serializer = UserSerializer(user)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            rows = user_serializer.rows(User.objects.filter(username=username))
+            if not rows:
+                raise Http404
+            return HttpResponse(render_json(user_serializer.to_representation(rows[0])), content_type='application/json', status=status.HTTP_200_OK)
         else:
-            users = User.objects.all()
-            serializer = UserSerializer(users, many=True, context={'request': request})
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            fields = request.GET.get('fields', None)
+            fields = fields.split(',') if fields else USER_LIST_DEFAULT_FIELDS
+            unknown = set(fields) - USER_LIST_FIELDS
+            if unknown:
+                return Response({'error': f"Unknown fields: {', '.join(sorted(unknown))}"}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                limit = query_int(request, 'limit', 50, 1, MAX_USER_PAGE_SIZE)
+                cursor = query_int(request, 'cursor', 0)
+            except ValueError:
+                return Response({'error': 'limit and cursor must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Only load the requested columns; many-to-many fields only when asked for
+            compiled = user_serializer.subset(fields)
+            rows = compiled.rows(User.objects.filter(id__gt=cursor).order_by('id')[:limit + 1])
+
+            data = compiled.many(rows[:limit], request)
+            response = HttpResponse(render_json(data), content_type='application/json', status=status.HTTP_200_OK)
+            if len(rows) > limit:
+                response['X-Next-Cursor'] = str(rows[limit - 1]['id'])
+            return response
     elif request.method == 'POST':
         userData = request.data.copy()
         userData['password'] = make_password(userData['password'])
@@ -390,24 +376,38 @@ def user_view(request, username=None):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@session_exempt
 @api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication])
 def user_status_view(request):
     try:
         user = request.user
         is_online = True if request.GET.get('status', None) == 'true' else False
 
-        user.status = is_online
-
-        if is_online is False:
-            iso_timestamp = now().isoformat()
-            user.last_online = iso_timestamp
-
-        user.save()
+        # Only touch the presence columns instead of rewriting the whole row
+        presence.apply({user.id: (is_online, now())})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return JsonResponse({'success': True}, status=status.HTTP_200_OK)
 
+
+@session_exempt
+@api_view(['GET', 'POST'])
+@authentication_classes([])
+@permission_classes([IsInternalService])
+def user_status_bulk_view(request):
+    if request.method == 'GET':
+        return Response(presence.metrics.as_dict(), status=status.HTTP_200_OK)
+
+    serializer = PresenceTransitionSerializer(data=request.data.get('transitions', []), many=True)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    result = presence.record_transitions(serializer.validated_data)
+    return Response(result, status=status.HTTP_200_OK)
+
+
 @api_view(['GET', 'POST'])
 def statistic_view(request):
     if request.method == 'GET':
@@ -419,222 +419,287 @@ def statistic_view(request):
 
         user = get_object_or_404(User, id=user_id)
 
-        user_matches = Match.objects.filter(statistic__user=user).distinct()
-        statistics = Statistic.objects.filter(match__in=user_matches).select_related('match__tournament', 'user')
-
-        # Group statistics by match
-        match_stats = {}
-        for stat in statistics:
-            match = stat.match
-            match_id = match.id
-
-            if match_id not in match_stats:
-                match_stats[match_id] = {
-                    'matchId': match_id,
-                    'started': match.datetime_start,
-                    'ended': match.datetime_end,
-                    'prematureEnd': match.premature_end,
-                    'tournamentId': match.tournament.id if match.tournament else None,
-                    'scores': []
-                }
-
-            match_stats[match_id]['scores'].append({
-                'username': stat.user.username,
-                'tid': stat.user.id,
-                'scored': stat.goals_scored,
-                'received': stat.goals_received,
-                'left': stat.datetime_left,
-                'won': stat.won,
-            })
-
-        # Group matches by tournament
-        result = []
-        tournament_matches = {}
-
-        for match_data in match_stats.values():
-            tournament_id = match_data['tournamentId']
-
-            match_obj = {
-                'matchId': match_data['matchId'],
-                'started': match_data['started'],
-                'ended': match_data['ended'],
-                'prematureEnd': match_data['prematureEnd'],
-                'scores': match_data['scores']
-            }
+        before = request.GET.get('before', None)
+        if before is not None:
+            # A '+' in an unencoded UTC offset arrives as a space
+            before = parse_cursor(before.replace(' ', '+'))
+            if before is None:
+                return Response({'error': 'Invalid before cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = request.GET.get('limit', None)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return Response({'error': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+            limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+
+        result, next_before = match_history(user, before, limit)
+
+        response = JsonResponse(result, status=status.HTTP_200_OK, safe=False)
+        if next_before is not None:
+            response['X-Next-Before'] = format_cursor(next_before)
+        return response
 
-            if tournament_id == None:
-                result.append({
-                    'tournamentId': None,
-                    'matches': [match_obj]
-                })
-                continue
+    if request.method == 'POST':
 
-            if tournament_id not in tournament_matches:
-                tournament_matches[tournament_id] = []
+        gameType = request.data.get('type', None)
 
-            tournament_matches[tournament_id].append(match_obj)
+        if gameType == None:
+            return Response({'error': 'Type is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Format the result in the desired structure
-        for tournament_id, matches in tournament_matches.items():
-            result.append({
-                'tournamentId': tournament_id,
-                'matches': matches
-            })
+        matches = request.data.get('matches', [])
 
-        for tournament in result:
-            tournament['matches'].sort(key=lambda x: x['started'], reverse=True)
+        try:
+            data = record_statistics(gameType, matches)
+        except IngestError as e:
+            return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        result.sort(key=lambda x: x['matches'][0]['started'], reverse=True)
+        return Response(data, status=status.HTTP_201_CREATED)
 
-        return JsonResponse(result, status=status.HTTP_200_OK, safe=False)
 
-    if request.method == 'POST':
+def record_statistics(game_type, matches):
+    """Ingest a finished game's matches; returns the serialized statistics or raises IngestError."""
+    return StatisticSerializer(ingest_statistics(game_type, matches), many=True).data
 
-        gameType = request.data.get('type', None)
 
-        if gameType == None:
-            return Response({'error': 'Type is required'}, status=status.HTTP_400_BAD_REQUEST)
+@api_view(['GET'])
+def statistic_summary_view(request):
+    user_id = request.GET.get('userId', None)
+    if user_id == None:
+        return Response({'error': 'User ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    user_summary = UserStatsSummary.objects.filter(user_id=user_id).first()
+    if user_summary is None:
+        # Users without games have no summary row yet
+        get_object_or_404(User, id=user_id)
+        user_summary = summary.new_summary(int(user_id))
+
+    return JsonResponse(summary.serialize(user_summary), status=status.HTTP_200_OK)
+
+
+@session_exempt
+async def remote_avatar_view(request, key):
+    # Async so a fetch from the upstream does not hold a sync thread, see mirror.arefresh
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    entry = await RemoteAvatar.objects.filter(key=key).afirst()
+    if entry is None:
+        return JsonResponse({'error': 'Unknown avatar'}, status=404)
+
+    result = await mirror.arefresh(entry)
+    registry.inc('api_avatar_mirror_total', result=result)
+    if not entry.file:
+        return HttpResponseRedirect(entry.url)
+    if result == 'hit':
+        await sync_to_async(mirror.touch)(entry)
+
+    headers = {
+        'Cache-Control': f"public, max-age={getattr(settings, 'MIRROR_MAX_AGE', 604800)}",
+        'ETag': mirror.etag(entry),
+    }
+    if request.headers.get('If-None-Match') == headers['ETag']:
+        return HttpResponseNotModified(headers=headers)
+    data = await sync_to_async(mirror.read, thread_sensitive=False)(entry)
+    if data is None:
+        return HttpResponseRedirect(entry.url)
+    return HttpResponse(data, content_type='image/webp', headers=headers)
+
+
+# Plain Django view: DRF would treat ?format= as a renderer override
+@require_GET
+def export_matches_view(request):
+    format = request.GET.get('format', 'ndjson')
+    if format not in export.FORMATS:
+        return JsonResponse({'error': f"format must be one of {', '.join(export.FORMATS)}"}, status=400)
 
-        matches = request.data.get('matches', [])
+    try:
+        user_id = query_int(request, 'userId', None, 1)
+        tournament_id = query_int(request, 'tournamentId', None, 1)
+        after = query_int(request, 'after', None)
+    except ValueError:
+        return JsonResponse({'error': 'userId, tournamentId and after must be integers'}, status=400)
+
+    # Per-user and per-tournament rows are public through statistic_view already
+    if user_id is None and tournament_id is None:
+        try:
+            user = header_user(request)
+        except AuthenticationFailed as e:
+            return JsonResponse(e.detail if isinstance(e.detail, dict) else {'error': e.detail}, status=401)
+        if not user.is_staff:
+            return JsonResponse({'error': 'Global exports are restricted to staff'}, status=403)
+
+    compress = request.GET.get('gzip') in ('1', 'true')
+    content_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    filename = f"matches.{format}"
+    if compress:
+        content_type, filename = 'application/gzip', filename + '.gz'
+
+    dump = export.astream if served_async(request) else export.stream
+    response = StreamingHttpResponse(
+        dump(format, compress, user_id=user_id, tournament_id=tournament_id, after=after),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
-        if gameType == 1:
-            instance = Tournament.objects.create()
-            tournamentId = instance.id
 
-            for matchData in matches:
-                matchData['db']['tournamentId'] = tournamentId
+# Cached tokens resolve to bare users without is_staff, so tokens are looked up in full here
+HEADER_AUTHENTICATORS = (JWTAuthentication(), TokenAuthentication())
 
-        matchData = [data['db'] for data in matches]
 
-        serializer = MatchSerializer(data=matchData, many=True)
-        if serializer.is_valid():
-            instances = serializer.save()
+def header_user(request):
+    """
+    The user of a plain Django view's request: from its Bearer JWT or
+    Token header, else from the session. Raises AuthenticationFailed on a
+    header that does not check out.
+    """
+    for authenticator in HEADER_AUTHENTICATORS:
+        result = authenticator.authenticate(request)
+        if result is not None:
+            return result[0]
+    return request.user
 
-            for index, instance in enumerate(instances):
-                scores = matches[index]['scores']
-                matchId = instance.id
 
-                for score in scores:
-                    score['matchId'] = matchId
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+def served_async(request):
+    """
+    Whether the response is sent by the ASGI handler. Streams must then be
+    async iterators: Django drains sync ones into a list before sending, and
+    a WSGI server in turn would buffer async ones.
+    """
+    return isinstance(request, ASGIRequest)
 
-        scores = [
-            {
-                **score,
-                'datetimeLeft': score.get('datetimeLeft'),
-                'won': score.get('won', False)
-            }
-            for matchData in matches for score in matchData['scores']
-        ]
 
-        serializer = StatisticSerializer(data=scores, many=True)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+def query_int(request, name, default, minimum=0, maximum=None):
+    value = request.GET.get(name, None)
+    if value is None:
+        return default
+    value = max(minimum, int(value))
+    return value if maximum is None else min(value, maximum)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['GET'])
+def leaderboard_view(request):
+    try:
+        offset = query_int(request, 'offset', 0)
+        limit = query_int(request, 'limit', 20, 1, MAX_LEADERBOARD_PAGE_SIZE)
+    except ValueError:
+        return Response({'error': 'offset and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'total': LeaderboardEntry.objects.count(),
+        'players': leaderboard.top(offset, limit),
+    }, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
-def fetch_friends(request):
+def leaderboard_rank_view(request):
+    user_id = request.GET.get('userId', None)
+    if user_id == None:
+        return Response({'error': 'User ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    entry = get_object_or_404(LeaderboardEntry.objects.select_related('user'), user_id=user_id)
+    return Response(leaderboard.serialize(entry, leaderboard.rank_of(entry)), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def leaderboard_around_view(request):
+    user_id = request.GET.get('userId', None)
+    if user_id == None:
+        return Response({'error': 'User ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+
     try:
-        authorization_header = request.headers.get('Authorization')
-        # Check for the 'Authorization' header
-        if not authorization_header:
-            return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
+        count = query_int(request, 'count', 5, 0, MAX_LEADERBOARD_PAGE_SIZE)
+    except ValueError:
+        return Response({'error': 'count must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Extract the JWT token from the header
-        token = request.headers['Authorization'].split(' ')[1]
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']  # Adjust algorithm as needed
-            )
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'error': 'Token expired.'}, status=401)
-        except jwt.InvalidTokenError:
-            return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
-
-        username = bleachThe(request.session.get('user_data', {}).get('username', None))
-        user = get_object_or_404(User, username=username)
-        if not user:
-            return Response({'error': 'User not found'}, status=404)
+    entry = get_object_or_404(LeaderboardEntry.objects.select_related('user'), user_id=user_id)
+    return Response({'players': leaderboard.around(entry, count)}, status=status.HTTP_200_OK)
 
-        friends = Friend.objects.filter(user=user)
-        serializer = FriendSerializer(friends, many=True)
-        return Response({'friends': serializer.data}, status=200)
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def fetch_friends(request):
+    try:
+        user = request.user
+
+        rows = friend_serializer.rows(Friend.objects.filter(user=user))
+        return HttpResponse(render_json({'friends': friend_serializer.many(rows)}), content_type='application/json', status=200)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
-@api_view(['GET'])
-def search_users(request):
-    try:
-        authorization_header = request.headers.get('Authorization')
-        # Check for the 'Authorization' header
-        if not authorization_header:
-            return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
+@api_view(['POST'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def friend_events_ticket(request):
+    return Response({'ticket': events.sign_ticket(request.user.id)})
+
 
-        # Extract the JWT token from the header
-        token = request.headers['Authorization'].split(' ')[1]
+# Plain Django view: EventSource cannot send an Authorization header, so
+# browsers pass a short-lived ticket from friend_events_ticket as ?ticket=
+# instead of their JWT, which would end up in access logs.
+@require_GET
+def friend_events(request):
+    authorization_header = request.headers.get('Authorization')
+    ticket = request.GET.get('ticket', None)
+    if authorization_header:
         try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']  # Adjust algorithm as needed
-            )
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'error': 'Token expired.'}, status=401)
-        except jwt.InvalidTokenError:
-            return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
+            user_id = resolve_user(decode_jwt(authorization_header.split(' ')[1]), request.session).id
+        except AuthenticationFailed as e:
+            return JsonResponse(e.detail, status=401)
+    elif ticket:
+        user_id = events.ticket_user_id(ticket)
+        if user_id is None or not User.objects.filter(id=user_id, is_active=True).exists():
+            return JsonResponse({'error': 'Invalid or expired ticket.'}, status=401)
+    else:
+        return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
 
+    last_id = request.headers.get('Last-Event-ID', request.GET.get('lastEventId', None))
+    try:
+        last_id = int(last_id) if last_id is not None else None
+    except ValueError:
+        last_id = None
+
+    stream = events.astream if served_async(request) else events.stream
+    response = StreamingHttpResponse(stream(user_id, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # keep nginx from buffering the stream
+    return response
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+@throttle_classes([SearchThrottle])
+def search_users(request):
+    try:
         query = request.GET.get('query', '').strip()
         if not query:
             return Response({'error': 'Query parameter is required'}, status=400)
 
-        username = request.session.get('user_data', {}).get('username', None)
-        user = get_object_or_404(User, username=username)
-        users = User.objects.filter(username__icontains=query).exclude(id=user.id)
-        friends = Friend.objects.filter(user=user).values_list('friend__id', flat=True)
-        users = users.exclude(id__in=friends)
+        try:
+            limit = query_int(request, 'limit', search.DEFAULT_LIMIT, 1, search.MAX_LIMIT)
+            results, next_cursor = search.search(request.user, query, limit, request.GET.get('cursor', None))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
 
-        if not users.exists():
+        if not results:
             return Response({'detail': 'No User matches the given query.'}, status=200)
 
-        results = [{'id': user.id, 'username': user.username} for user in users]
-        return Response({'users': results}, status=200)
+        return Response({'users': results, 'next': next_cursor}, status=200)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
 @api_view(['POST'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
 def add_friend(request):
     try:
-        authorization_header = request.headers.get('Authorization')
-        # Check for the 'Authorization' header
-        if not authorization_header:
-            return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
-
-        # Extract the JWT token from the header
-        token = request.headers['Authorization'].split(' ')[1]
-
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']  # Adjust algorithm as needed
-            )
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'error': 'Token expired.'}, status=401)
-        except jwt.InvalidTokenError:
-            return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
-
-        username = bleachThe(request.session.get('user_data', {}).get('username', None))
-        user = get_object_or_404(User, username=username)
-        if not user:
-            return Response({'error': 'User not found'}, status=404)
+        user = request.user
         friend_username = bleachThe(request.data.get('username'))
         if not friend_username:
             return Response({'error': 'Username is required'}, status=400)
@@ -644,36 +709,18 @@ def add_friend(request):
         if Friend.objects.filter(user=user, friend=friend).exists():
             return Response({'error': f'{friend_username} is already your friend!'}, status=400)
         Friend.objects.create(user=user, friend=friend)
+        events.publish_friendship(user.id, friend.id, added=True)
         return Response({'message': f'{friend_username} added as a friend!'}, status=201)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
 @api_view(['POST'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
 def remove_friend(request):
     try:
-        authorization_header = request.headers.get('Authorization')
-        # Check for the 'Authorization' header
-        if not authorization_header:
-            return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
-
-        # Extract the JWT token from the header
-        token = request.headers['Authorization'].split(' ')[1]
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']  # Adjust algorithm as needed
-            )
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'error': 'Token expired.'}, status=401)
-        except jwt.InvalidTokenError:
-            return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
-
-        username = bleachThe(request.session.get('user_data', {}).get('username', None))
-        user = get_object_or_404(User, username=username)
-        if not user:
-            return Response({'error': 'User not found'}, status=404)
+        user = request.user
         friend_username = request.data.get('username')
         if not friend_username:
             return Response({'error': 'Username is required'}, status=400)
@@ -684,49 +731,53 @@ def remove_friend(request):
         if not friend_relation.exists():
             return Response({'error': f'{friend_username} is not in your friend list!'}, status=400)
         friend_relation.delete()
+        events.publish_friendship(user.id, friend.id, added=False)
         return Response({'message': f'{friend_username} removed from your friends!'}, status=200)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([IsInternalService])
+def token_cache_view(request):
+    return Response(token_cache.stats(), status=200)
+
+
+@require_GET
+def metrics_view(request):
+    # Scrapers send INTERNAL_API_SECRET in X-Internal-Token, like the game server
+    if not IsInternalService().has_permission(request, None):
+        return JsonResponse({'detail': IsInternalService.message}, status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @api_view(['POST'])
 def logout_view(request):
+    user_data = request.session.get('user_data', {})
+    invalidate_token(user_data.get('token', None))
+    # Revokes the user's JWTs everywhere, not only the one kept in this session
+    user_id = jwt_user_id(user_data.get('jwtToken', ''))
+    if user_id is None and user_data.get('username'):
+        user_id = User.objects.filter(username=user_data['username']).values_list('id', flat=True).first()
+    if user_id is not None:
+        revoke_jwts(user_id)
     request.session.flush()
     return Response({"message": "Logged out successfully"})
 
 
 @api_view(['POST'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
 def update_profile(request):
     # global djangoPort
     protocol, hostname = get_scheme(request)
 
     try:
-        authorization_header = request.headers.get('Authorization')
-        # Check for the 'Authorization' header
-        if not authorization_header:
-            return JsonResponse({'error': 'Authorization header is missing.'}, status=401)
-
-        # Extract the JWT token from the header
-        token = request.headers['Authorization'].split(' ')[1]
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']  # Adjust algorithm as needed
-            )
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'error': 'Token expired.'}, status=401)
-        except jwt.InvalidTokenError:
-            return JsonResponse({'error': 'Invalid token.', 'token': token}, status=401)
-
-        if not request.session.get('user_data'):
-            return Response({'error': 'User not logged in or session expired'}, status=401)
-
-        old_username = bleachThe(request.session['user_data'].get('username', None))
-        if not old_username:
-            return Response({'error': 'User not logged in or session expired'}, status=401)
-
-        user = get_object_or_404(User, username=old_username)
+        user = request.user
+        old_username = user.username
+        # request.user may come from the user cache, so only the changed columns are written
+        changed = []
 
         if not request.data and request.FILES:
             return Response({'message': 'No change made'}, status=200)
@@ -738,8 +789,7 @@ def update_profile(request):
                 if User.objects.filter(username=new_username).exists():
                     return Response({'error': 'Username already taken'}, status=400)
                 user.username = new_username
-                request.session['user_data']['username'] = new_username
-                request.session.modified = True
+                changed.append('username')
 
         if 'email' in data:
             new_email = bleachThe(data['email'].strip())
@@ -750,14 +800,27 @@ def update_profile(request):
                 return Response({'error': 'Email already in use'}, status=400)
 
             user.email = new_email
+            changed.append('email')
 
         if 'password' in data:
             user.password = make_password(data['password'].strip())
+            changed.append('password')
 
+        pending_avatar = None
         if 'avatar' in request.FILES:
-            user.avatar = request.FILES['avatar']
+            try:
+                pending_avatar = avatars.upload(user, request.FILES['avatar'])
+            except avatars.InvalidAvatar as e:
+                return Response({'error': str(e)}, status=400)
+            changed.append('avatar')
 
-        user.save()
+        user.save(update_fields=changed)
+        if pending_avatar is not None:
+            # The variants are rendered off the request; the original is served until they exist
+            avatars.submit(user.id, *pending_avatar)
+
+        if user.username != old_username:
+            invalidate_user(user.id)
 
         avatar_url = user.avatar.url if user.avatar else None
         if avatar_url and not avatar_url.startswith("http"):
@@ -772,8 +835,108 @@ def update_profile(request):
 
         return Response({
             'message': 'User updated successfully!',
-            'avatar': avatar_url
+            'avatar': avatar_url,
+            # Per-size variants, empty while they are being rendered
+            'avatars': {
+                size: url if url.startswith("http") else f"{protocol}//{hostname}{url}"
+                for size, url in avatars.urls(user.avatar.name).items()
+            },
         }, status=200)
 
     except Exception as e:
         return Response({'error': str(e)}, status=500)
+
+
+# Async versions of the endpoints the game server calls in bursts and of
+# the OAuth callback, routed instead of the sync ones when ASYNC_VIEWS is
+# set (see urls.py). Served over ASGI they wait on the database and the
+# 42 API without holding a worker thread each. DRF's api_view is sync
+# only, so these are plain Django views answering the same JSON.
+
+def not_authenticated(e):
+    response = JsonResponse({'detail': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    response['WWW-Authenticate'] = 'Token'
+    return response
+
+
+@session_exempt
+async def validate_token_async(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        user = await atoken_user(request)
+    except AuthenticationFailed as e:
+        return not_authenticated(e)
+    if user is None:
+        return JsonResponse({'tid': None, 'username': ''}, status=status.HTTP_200_OK)
+    return JsonResponse({'tid': user.id, 'username': user.username}, status=status.HTTP_200_OK)
+
+
+@session_exempt
+async def user_status_async(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        user = await atoken_user(request)
+    except AuthenticationFailed as e:
+        return not_authenticated(e)
+    try:
+        if user is not None:
+            is_online = request.GET.get('status', None) == 'true'
+            await presence.aapply({user.id: (is_online, now())})
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return JsonResponse({'success': True}, status=status.HTTP_200_OK)
+
+
+async def statistic_async(request):
+    if request.method not in ('GET', 'POST'):
+        return HttpResponseNotAllowed(['GET', 'POST'])
+    # Reads and non-JSON bodies keep going through the DRF view
+    if request.method == 'GET' or request.content_type != 'application/json':
+        return await sync_to_async(statistic_view)(request)
+
+    try:
+        await atoken_user(request)
+    except AuthenticationFailed as e:
+        return not_authenticated(e)
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'detail': 'JSON parse error'}, status=status.HTTP_400_BAD_REQUEST)
+    if not isinstance(body, dict):
+        return JsonResponse({'detail': 'Expected a JSON object'}, status=status.HTTP_400_BAD_REQUEST)
+
+    game_type = body.get('type', None)
+    if game_type is None:
+        return JsonResponse({'error': 'Type is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # The ingest transaction runs on the sync thread like any ORM write
+    try:
+        data = await sync_to_async(record_statistics)(game_type, body.get('matches', []))
+    except IngestError as e:
+        return JsonResponse(e.errors, status=status.HTTP_400_BAD_REQUEST, safe=False)
+    return JsonResponse(data, status=status.HTTP_201_CREATED, safe=False)
+
+# Like every DRF view, token-authenticated and without CSRF checks
+statistic_async.csrf_exempt = True
+
+
+async def login_with_42_callback_async(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    protocol, hostname = get_scheme(request)
+
+    code = request.GET.get('code')
+    if not code:
+        return JsonResponse({'error': 'Missing authorization code'}, status=400)
+    redirect_uri = f"{protocol}//{hostname}/api/42/login/callback/"
+
+    try:
+        access_token = await oauth42.aexchange_code(code, redirect_uri)
+        user_info_data = await oauth42.afetch_profile(access_token)
+    except oauth42.OAuthError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+
+    return await sync_to_async(finish_42_login)(request, user_info_data)
@@ -71,13 +71,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.QueryMetricsMiddleware',
+    'api.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'api.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-	'django_otp.middleware.OTPMiddleware',
+    'api.middleware.OTPMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -107,6 +109,12 @@ CORS_ALLOW_HEADERS = [
     "authorization",
 ]
 
+# Pagination cursors of GET /api/statistics/ and GET /api/users/
+CORS_EXPOSE_HEADERS = [
+    "X-Next-Before",
+    "X-Next-Cursor",
+]
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -211,15 +219,114 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
     ],
+    # nginx appends the client address to X-Forwarded-For; throttles key on that entry, not on what the client sent
+    'NUM_PROXIES': 1,
 }
 
 AUTH_USER_MODEL = 'api.User'
 
+# The session cache is shared by all workers through the filesystem
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('SESSION_CACHE_LOCATION', os.path.join(BASE_DIR, 'cache', 'sessions')),
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
+# Shared with the game server (nodejs), which sends it in X-Internal-Token on internal-only endpoints
+INTERNAL_API_SECRET = os.getenv('INTERNAL_API_SECRET', '')
+
+# Per-process cache of validated auth tokens (api.authentication)
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 60))  # seconds
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+
+# JWTs carry the user id; api.authentication.JWTAuthentication resolves it through a per-process cache
+JWT_TTL = int(os.getenv('JWT_TTL', 1209600))  # seconds, same as the session cookie
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 30))  # seconds
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+
+# Per-process LRU of rendered 2FA QR codes (api.qr)
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', 1024))
+
+# Uploaded avatars are stored by content hash and rendered to square WebP variants on a worker pool (api.avatars)
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_WORKERS = int(os.getenv('AVATAR_WORKERS', 2))  # 0 renders in the request
+AVATAR_MAX_PIXELS = 24_000_000
+
+# 42 OAuth calls (api.oauth42): pooled, bounded by (connect, read) timeouts, retried with jitter,
+# failing fast for OAUTH_BREAKER_RESET seconds after OAUTH_BREAKER_THRESHOLD consecutive failures
+OAUTH_TIMEOUT = (3.05, 10)
+OAUTH_RETRIES = int(os.getenv('OAUTH_RETRIES', 2))
+OAUTH_BACKOFF = 0.2  # seconds, doubled per retry before jitter
+OAUTH_BREAKER_THRESHOLD = int(os.getenv('OAUTH_BREAKER_THRESHOLD', 5))
+OAUTH_BREAKER_RESET = int(os.getenv('OAUTH_BREAKER_RESET', 30))  # seconds
+
+# Async versions of the burst endpoints and the 42 callback (end of api/views.py); they only
+# pay off under the ASGI server the Dockerfile starts
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'true').lower() == 'true'
+
+# Remote (42 intra) avatars are mirrored locally on first request (api.mirror)
+MIRROR_ALLOWED_HOSTS = [host for host in os.getenv('MIRROR_ALLOWED_HOSTS', 'cdn.intra.42.fr').split(',') if host]
+MIRROR_SIZE = 256
+MIRROR_TIMEOUT = (3, 10)  # connect, read seconds
+MIRROR_REVALIDATE = int(os.getenv('MIRROR_REVALIDATE', 86400))  # seconds between conditional upstream checks
+MIRROR_MAX_AGE = int(os.getenv('MIRROR_MAX_AGE', 604800))  # Cache-Control max-age for clients
+MIRROR_MAX_ENTRIES = int(os.getenv('MIRROR_MAX_ENTRIES', 10000))
+MIRROR_MAX_BYTES = int(os.getenv('MIRROR_MAX_BYTES', 256 * 1024 * 1024))
+
+# Matches older than this move to the archive tables (api.archive, manage.py archive_matches)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+
+# Requests repeating one SQL statement this often are logged as N+1 (api.middleware)
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 5))
+
+# Password checks run on a bounded pool (api.login); logins beyond workers + backlog get a 503
+LOGIN_HASH_EXECUTOR = os.getenv('LOGIN_HASH_EXECUTOR', 'thread')  # thread or process
+LOGIN_HASH_WORKERS = int(os.getenv('LOGIN_HASH_WORKERS', os.cpu_count() or 2))
+LOGIN_HASH_BACKLOG = int(os.getenv('LOGIN_HASH_BACKLOG', 16))
+LOGIN_HASH_TIMEOUT = int(os.getenv('LOGIN_HASH_TIMEOUT', 10))  # seconds
+
+# Shared token buckets (api.ratelimit), "<count>/<s|min|hour|day>" per scope and key kind
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', os.path.join(BASE_DIR, 'ratelimit.sqlite3'))
+RATE_LIMITS = {
+    'login_ip': '30/min',
+    'login_user': '10/min',
+    '2fa_ip': '10/min',
+    '2fa_user': '5/min',
+    'search_ip': '120/min',
+    'search_user': '60/min',
+    'signup_ip': '20/hour',
+}
+
+# Sampled request profiling (api.profiling); PROFILE_SAMPLE_RATES is "url_name=rate,..." with * as the default
+PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'false').lower() == 'true'
+PROFILE_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, rate in (item.split('=') for item in os.getenv('PROFILE_SAMPLE_RATES', '').split(',') if item)
+}
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+
 
 #session settings
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'  # Store sessions in the database
+# db: database only, cache: session cache in front of the database, signed: signed cookie (api.sessions)
+SESSION_MODE = os.getenv('SESSION_MODE', 'cache')
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cached_db',
+    'signed': 'api.sessions',
+}[SESSION_MODE]
+SESSION_CACHE_ALIAS = 'sessions'
 SESSION_COOKIE_NAME = 'sessionid'
-SESSION_SAVE_EVERY_REQUEST = True
+# Sessions are saved when changed; api.middleware.SessionMiddleware slides the expiry of
+# unchanged ones at most once per SESSION_REFRESH_INTERVAL seconds
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_REFRESH_INTERVAL = int(os.getenv('SESSION_REFRESH_INTERVAL', 300))
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
 SESSION_COOKIE_SECURE = False
 SESSION_COOKIE_SAMESITE = None
@@ -739,7 +739,7 @@ async function initConnection(socket) {
 
 		data.players[player.id] = player;
 
-		setPlayerStatus(socket, true);
+		setPlayerStatus(player, true);
 
 		updateState();
 
@@ -751,20 +751,47 @@ async function initConnection(socket) {
 	return null;
 }
 
-function setPlayerStatus(socket, status) {
-	const { cookie: cookieHeader } = socket.handshake.headers
-	const cookies = cookie.parse(cookieHeader);
+// Presence transitions are sent to django in batches; django keeps only the
+// newest transition per player, so connect/disconnect flaps cost one write.
+const presenceFlushDelay = 500;
+let presenceQueue = [];
+let presenceTimer = null;
+
+function setPlayerStatus(player, status) {
+	presenceQueue.push({
+		userId: player.tid,
+		online: status,
+		timestamp: new Date().toISOString(),
+	});
 
-	const options = {
-		method: 'GET',
-		headers: {
-			'Authorization': `Token ${cookies.authToken}`,
-			'Content-Type': 'application/json',
-			'Cookie': cookieHeader
-		},
-	};
+	if (presenceTimer == null)
+		presenceTimer = setTimeout(flushPlayerStatus, presenceFlushDelay);
+}
+
+async function flushPlayerStatus() {
+	const transitions = presenceQueue;
+
+	presenceQueue = [];
+	presenceTimer = null;
+
+	if (transitions.length === 0)
+		return;
+
+	try {
+		const response = await fetch('http://django:8000/api/user/status/bulk/', {
+			method: 'POST',
+			headers: {
+				'Content-Type': 'application/json',
+				'X-Internal-Token': process.env.INTERNAL_API_SECRET || '',
+			},
+			body: JSON.stringify({ transitions }),
+		});
 
-	fetch(`http://django:8000/api/user/status/?status=${status}`, options);
+		if (!response.ok)
+			throw new Error('Failed to post player status');
+	} catch (error) {
+		console.error('Error posting player status:', error);
+	}
 }
 
 function startSingleGame(room, players, counter) {
@@ -1142,7 +1169,7 @@ io.on('connection', async socket => {
 		if (player == null)
 			return;
 
-		setPlayerStatus(socket, false);
+		setPlayerStatus(player, false);
 
 		const room = getRoomFromPlayer(player);
 
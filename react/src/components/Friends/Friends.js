@@ -58,6 +58,57 @@ function Friends(props) {
 		updateFriendsList();
 	}, [stateId]);
 
+	// Presence and friendship deltas pushed by django instead of refetching the list.
+	// The stream is opened with a short-lived ticket rather than the JWT, so each
+	// reconnect asks for a new one and resumes after the last event it saw.
+	useEffect(() => {
+		let source = null;
+		let retry = null;
+		let lastEventId = null;
+		let closed = false;
+
+		const onPresence = event => {
+			const friend = JSON.parse(event.data);
+			setFriends(friends => friends.map(current => current.tid === friend.tid ? { ...current, ...friend } : current));
+		};
+
+		const track = handler => event => {
+			lastEventId = event.lastEventId || lastEventId;
+			handler(event);
+		};
+
+		const connect = async () => {
+			const ticket = await fetchEventsTicket();
+			if (closed)
+				return;
+			if (!ticket) {
+				retry = setTimeout(connect, 5000);
+				return;
+			}
+
+			const params = new URLSearchParams({ ticket });
+			if (lastEventId)
+				params.set('lastEventId', lastEventId);
+			source = new EventSource(`${protocol}//${hostname}/api/friend/events/?${params}`, { withCredentials: true });
+
+			source.addEventListener('presence', track(onPresence));
+			source.addEventListener('friend_added', track(updateFriendsList));
+			source.addEventListener('friend_removed', track(updateFriendsList));
+			source.onerror = () => {
+				source.close();
+				retry = setTimeout(connect, 1000);
+			};
+		};
+
+		connect();
+
+		return () => {
+			closed = true;
+			clearTimeout(retry);
+			source?.close();
+		};
+	}, []);
+
 	const titleAction = (
 		<div className={scss.search} title='Search Friends' onClick={onSearch}>
 			<Icon type='search' size='12' />
@@ -102,6 +153,22 @@ async function fetchFriends() {
 	}
 }
 
+async function fetchEventsTicket() {
+	try {
+		const response = await fetchWithCredentials(`${protocol}//${hostname}/api/friend/events/ticket/`, "POST", {
+			headers: {
+				'Authorization': `Bearer ${Cookies.get('jwtToken')}`,
+			},
+		});
+		if (!response.ok)
+			return null;
+		const data = await response.json();
+		return data.ticket;
+	} catch (error) {
+		return null;
+	}
+}
+
 function getFriendsComponent(friends, title, selected, removeFriend) {
 	if (friends.length === 0)
 		return null;